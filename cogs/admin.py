@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import HTSUSCode, SKU, Container, Invoice, InvoiceLine, CostPool, AllocatedCost, CalculationHistory, CalculationLineItem, SavedResults
+from .models import HTSUSCode, SKU, Container, Invoice, InvoiceLine, CostPool, AllocatedCost, PackedAllocation, RecalcMark, CalculationHistory, CalculationLineItem, SavedResults, Job, UploadRecord
  
 # Custom ModelAdmin for Invoice to display new fields
 class InvoiceAdmin(admin.ModelAdmin):
@@ -29,6 +29,8 @@ admin.site.register(Invoice, InvoiceAdmin)
 admin.site.register(InvoiceLine)
 admin.site.register(CostPool)
 admin.site.register(AllocatedCost)
+admin.site.register(PackedAllocation)
+admin.site.register(RecalcMark)
 
 @admin.register(CalculationHistory)
 class CalculationHistoryAdmin(admin.ModelAdmin):
@@ -55,3 +57,18 @@ class SavedResultsAdmin(admin.ModelAdmin):
         if obj:  # Editing an existing object
             return self.readonly_fields + ['other_costs']
         return self.readonly_fields
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'kind', 'status', 'progress_done', 'progress_total', 'attempts', 'created_at', 'finished_at']
+    list_filter = ['kind', 'status']
+    readonly_fields = ['created_at', 'started_at', 'finished_at', 'heartbeat_at']
+
+
+@admin.register(UploadRecord)
+class UploadRecordAdmin(admin.ModelAdmin):
+    list_display = ['file_name', 'kind', 'sha256', 'job', 'created_at']
+    list_filter = ['kind']
+    search_fields = ['file_name', 'sha256']
+    readonly_fields = ['created_at']
@@ -0,0 +1,176 @@
+"""Vectorized kernel for allocating one cost pool over invoice lines.
+
+``allocate`` takes the quantity, price and volume columns of the lines as
+arrays and computes every line's amount with numpy instead of walking the
+lines with per-line ``Decimal`` arithmetic.  It keeps the rounding contract
+of the per-line version (``reference_allocation``) exactly:
+
+* a line's amount is ``amount_total * weight / normalizer``, computed in
+  the default 28-digit ``Decimal`` context and rounded half-even to the
+  cent, where the weight is ``price * quantity`` (PRICE, PRICE_QUANTITY),
+  ``volume * quantity`` (VOLUME, a float as before) or ``quantity``;
+* ``amount_total`` minus the sum of the rounded amounts is added to the
+  line with the largest rounded amount, the first one on ties.
+
+Amounts are computed in float64, which is exact to well under a cent
+everywhere except right next to a half-cent boundary.  Lines within a
+conservative tolerance of one are recomputed with ``Decimal``, so the
+result is identical to the per-line version, not merely close.
+
+Methods are compared by value (``CostPool.Method`` is a ``TextChoices``) so
+this module stays free of Django imports.
+"""
+from dataclasses import dataclass
+from decimal import Decimal
+
+import numpy as np
+
+PRICE_METHODS = ('PRICE', 'PRICE_QUANTITY')
+VOLUME = 'VOLUME'
+QUANTITY = 'QUANTITY'
+WEIGHTED_METHODS = (*PRICE_METHODS, VOLUME, QUANTITY)
+CENT = Decimal('0.01')
+
+# Relative error of the float64 amount is a few ulp (~1e-15); anything
+# this close to a half cent is settled with Decimal instead.
+HALF_CENT_RELATIVE_TOLERANCE = 1e-12
+HALF_CENT_ABSOLUTE_TOLERANCE = 1e-9
+# Products price_cents * quantity above this are kept as Python ints.
+INT64_SAFE = 2 ** 62
+
+
+@dataclass
+class Allocation:
+    """Result of ``allocate``: per-line rounded cents plus the penny fix.
+
+    ``cents`` is ``None`` when the normalizer is zero; the pool is then
+    split equally without rounding (``equal_share``), as before.
+    """
+    cents: np.ndarray = None
+    fix_index: int = None
+    fix_amount: Decimal = Decimal(0)
+    equal_share: Decimal = None
+    count: int = 0
+
+    def amounts(self):
+        """The allocated amounts as ``Decimal`` values, in line order."""
+        if self.cents is None:
+            return [self.equal_share] * self.count
+        amounts = [Decimal(cents) * CENT for cents in self.cents.tolist()]
+        if self.fix_index is not None:
+            amounts[self.fix_index] += self.fix_amount
+        return amounts
+
+
+def _price_cents(prices):
+    # Prices are DecimalField(max_digits=10, decimal_places=2) values, given
+    # as Decimal or float; at that size float64 rounds back to the exact cent.
+    return np.rint(np.asarray(prices, dtype=np.float64) * 100).astype(np.int64)
+
+
+def weight_to_decimal(method):
+    """The function converting a weight or normalizer of ``method`` to the ``Decimal`` the per-line version used."""
+    if method in PRICE_METHODS:
+        return lambda value: Decimal(int(value)).scaleb(-2)
+    if method == VOLUME:
+        return lambda value: Decimal(float(value))
+    if method == QUANTITY:
+        return lambda value: Decimal(int(value))
+    return Decimal
+
+
+def line_weights(method, quantity, price=None, volume=None):
+    """Return ``(weights, normalizer, weight_to_decimal)`` for ``method``.
+
+    ``weights`` is an array in the unit the kernel works in (cents of
+    ``price * quantity``, units, or float cc); ``normalizer`` is their sum
+    as the per-line version computed it, converted by ``weight_to_decimal``
+    to the ``Decimal`` the per-line version divided by.
+    """
+    quantity = np.asarray(quantity, dtype=np.int64)
+    if method in PRICE_METHODS:
+        cents = _price_cents(price)
+        if len(cents) and np.abs(cents.astype(float) * quantity).max() >= INT64_SAFE:
+            weights = cents.astype(object) * quantity.astype(object)
+        else:
+            weights = cents * quantity
+    elif method == VOLUME:
+        weights = np.asarray(volume, dtype=np.float64) * quantity
+    elif method == QUANTITY:
+        weights = quantity
+    else:
+        weights = np.zeros(len(quantity), dtype=np.int64)
+    # Sequential sum (float for VOLUME), exactly as sum() over the lines gave it.
+    return weights, sum(weights.tolist()), weight_to_decimal(method)
+
+
+def allocate_cents(amount_total, weights, normalizer, to_decimal):
+    """Each line's share of ``amount_total`` in whole cents, before the penny fix.
+
+    ``weights`` may be any run of the lines, as long as ``normalizer`` is
+    the sum over all of them; ``cogs.services`` allocates in chunks this way.
+    """
+    normalizer_decimal = to_decimal(normalizer)
+    # Amounts in cents; float64 is good to ~1e-15 relative.
+    exact = float(amount_total) * 100 * (weights.astype(np.float64) / float(normalizer))
+    cents = np.rint(exact)
+    tolerance = np.abs(exact) * HALF_CENT_RELATIVE_TOLERANCE + HALF_CENT_ABSOLUTE_TOLERANCE
+    near_half = np.flatnonzero(np.abs(np.abs(exact - np.floor(exact)) - 0.5) <= tolerance)
+    cents = cents.astype(np.int64)
+    for index in near_half.tolist():
+        share = to_decimal(weights[index]) / normalizer_decimal
+        cents[index] = int(round(amount_total * share, 2).scaleb(2))
+    return cents
+
+
+def allocate(amount_total, method, quantity, price=None, volume=None):
+    """Allocate ``amount_total`` (a ``Decimal``) over lines given as columns.
+
+    ``price`` (``Decimal`` or float values) is needed for the price methods
+    and ``volume`` for VOLUME.  Returns an ``Allocation``.
+    """
+    count = len(quantity)
+    if method not in WEIGHTED_METHODS:
+        # EQUALLY: the per-line version used a zero normalizer for it.
+        return Allocation(equal_share=amount_total / count if count else None, count=count)
+    weights, normalizer, to_decimal = line_weights(method, quantity, price, volume)
+    if to_decimal(normalizer) == 0:
+        return Allocation(equal_share=amount_total / count if count else None, count=count)
+
+    cents = allocate_cents(amount_total, weights, normalizer, to_decimal)
+    allocation = Allocation(cents=cents, count=count)
+    residual = amount_total - Decimal(sum(cents.tolist())).scaleb(-2)
+    if residual != 0:
+        allocation.fix_index = int(np.argmax(cents))
+        allocation.fix_amount = residual
+    return allocation
+
+
+def reference_allocation(amount_total, method, quantity, price=None, volume=None):
+    """The per-line ``Decimal`` allocation ``allocate`` replaces, kept as its specification.
+
+    Used by the tests and ``manage.py benchmark_allocation``.
+    """
+    count = len(quantity)
+    if method in PRICE_METHODS:
+        weights = [p * q for p, q in zip(price, quantity)]
+        normalizer = sum(weights)
+    elif method == VOLUME:
+        weights = [v * q for v, q in zip(volume, quantity)]
+        normalizer = Decimal(sum(weights))
+        weights = [Decimal(w) for w in weights]
+    elif method == QUANTITY:
+        weights = [Decimal(q) for q in quantity]
+        normalizer = Decimal(sum(quantity))
+    else:
+        normalizer = Decimal(0)
+
+    if normalizer == 0:
+        return [amount_total / count] * count if count else []
+
+    amounts = [round(amount_total * (weight / normalizer), 2) for weight in weights]
+    residual = amount_total - sum(amounts, Decimal(0))
+    if residual != 0 and amounts:
+        largest = max(range(count), key=lambda index: (amounts[index], -index))
+        amounts[largest] += residual
+    return amounts
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class CogsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'cogs'
+
+    def ready(self):
+        # Keeps the HTSRateDetail interval index current on save/delete.
+        from . import rates  # noqa: F401
+        # Marks stale allocations on save/delete.
+        from . import dirty  # noqa: F401
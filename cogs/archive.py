@@ -0,0 +1,158 @@
+"""Zip uploads of many invoice CSV files.
+
+Suppliers send one CSV per invoice, often 200+ files per vessel.  The CSV
+members of an uploaded archive are read by the parent, validated and
+parsed in spawned worker processes (``parse_member``, run through
+``cogs.worker``) and come back in archive order with a bounded number in
+flight.  The parent feeds every parsed row to a single ``InvoiceIngestor``,
+so containers, SKUs and invoices shared between files are resolved once,
+an invoice split over several files becomes one invoice, and the whole
+archive commits in one transaction.  If any file has problems nothing is written; the remaining
+files are still checked so the per-file status is complete.
+"""
+import multiprocessing
+import posixpath
+import zipfile
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+from django.core.files.base import ContentFile
+
+from . import worker
+from .ingestion import IngestionResult, InvoiceIngestor
+from .readers import csv_dict_reader, iter_batches
+from .validation import MAX_REPORTED_ERRORS, validate_invoice_file
+
+MEMBER_EXTENSIONS = ('.csv',)
+
+
+class ArchiveRejected(Exception):
+    """Raised by ``ingest_archive`` when a member file is invalid; nothing was written."""
+
+    def __init__(self, files, errors):
+        super().__init__(f'{sum(f["status"] == "invalid" for f in files)} of {len(files)} files have problems')
+        self.files = files
+        self.errors = errors
+
+
+@dataclass
+class ParsedMember:
+    name: str
+    rows: int = 0
+    errors: list = field(default_factory=list)
+    parsed: list = field(default_factory=list)
+
+
+def list_members(archive):
+    """Split the files of a ``ZipFile`` into ``(csv_names, skipped_names)``, in archive order.
+
+    Directories and the metadata macOS and editors add to archives
+    (``__MACOSX/``, dot files) are ignored altogether.
+    """
+    members, skipped = [], []
+    for info in archive.infolist():
+        base = posixpath.basename(info.filename)
+        if info.is_dir() or info.filename.startswith('__MACOSX/') or base.startswith('.'):
+            continue
+        (members if base.lower().endswith(MEMBER_EXTENSIONS) else skipped).append(info.filename)
+    return members, skipped
+
+
+def _unreadable(name, error):
+    return ParsedMember(name, errors=[{'row': None, 'column': '', 'value': '', 'message': f'Unreadable file: {error}'}])
+
+
+def parse_member(name, data):
+    """Validate and parse the bytes ``data`` of archive member ``name``.
+
+    Runs in a worker process; only the parsed rows (or the row errors)
+    travel back to the parent.
+    """
+    source = ContentFile(data, name=name)
+    report = validate_invoice_file(source)
+    if not report.is_valid:
+        return ParsedMember(name, report.rows, errors=report.errors[:MAX_REPORTED_ERRORS])
+    source.seek(0)
+    parse_row = InvoiceIngestor().parse_row
+    parsed = [parse_row(row) for row in csv_dict_reader(source)]
+    return ParsedMember(name, len(parsed), parsed=parsed)
+
+
+def _read_members(archive, names):
+    for name in names:
+        try:
+            yield name, archive.read(name)
+        except (zipfile.BadZipFile, zipfile.LargeZipFile, NotImplementedError) as e:
+            # Corrupt member or unsupported compression.
+            yield name, e
+
+
+def iter_parsed_members(archive, names, workers=1):
+    """Yield a ``ParsedMember`` per name of the ``ZipFile`` in order, parsing up to ``workers`` files at once."""
+    workers = min(workers, len(names))
+    if workers <= 1:
+        for name, data in _read_members(archive, names):
+            yield _unreadable(name, data) if isinstance(data, Exception) else parse_member(name, data)
+        return
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=worker.init_worker) as pool:
+        pending = deque()
+        for name, data in _read_members(archive, names):
+            if isinstance(data, Exception):
+                future = Future()
+                future.set_result(_unreadable(name, data))
+            else:
+                future = pool.submit(worker.parse_archive_member, name, data)
+            pending.append(future)
+            # Bound the parsed files held in memory while keeping every worker busy.
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def ingest_archive(archive, names, country_origin=None, workers=1, progress=None, replace_lines=False):
+    """Import the invoice CSV members ``names`` of a ``ZipFile`` in one transaction.
+
+    Returns ``(files, result)``: a status dict per file, in archive order,
+    and the overall ``IngestionResult``.  Raises ``ArchiveRejected`` if any
+    file is invalid.  ``progress(done, total)`` is called after each file.
+    ``replace_lines`` is passed on to ``InvoiceIngestor``.
+    """
+    ingestor = InvoiceIngestor(country_origin=country_origin, replace_lines=replace_lines)
+    result = IngestionResult()
+    files = []
+    errors = []
+
+    def batches():
+        for done, member in enumerate(iter_parsed_members(archive, names, workers), start=1):
+            status = {'file': member.name, 'rows': member.rows}
+            files.append(status)
+            if member.errors:
+                status.update(status='invalid', error_count=len(member.errors))
+                errors.extend({'file': member.name, **error} for error in member.errors)
+            elif errors:
+                # An earlier file failed; only check the rest.
+                status['status'] = 'valid'
+            else:
+                created, unchanged = result.lines_created, result.lines_unchanged
+                yield from iter_batches(member.parsed, ingestor.batch_size)
+                status.update(
+                    status='imported',
+                    lines_created=result.lines_created - created,
+                    lines_unchanged=result.lines_unchanged - unchanged,
+                )
+            if progress:
+                progress(done, len(names))
+        if errors:
+            for status in files:
+                if status['status'] == 'imported':
+                    status['status'] = 'valid'
+                    del status['lines_created'], status['lines_unchanged']
+            # Raised inside the ingestion transaction, so it rolls back.
+            raise ArchiveRejected(files, errors)
+
+    ingestor.ingest_parsed(batches(), result)
+    return files, result
@@ -0,0 +1,266 @@
+"""Dirty tracking for incremental recalculation.
+
+Stored allocations go stale when one of their inputs changes.  Every such
+change leaves a ``RecalcMark``:
+
+* ``POOL``: a manual cost pool was created, or its scope, method or amount
+  changed; the pool is reallocated.
+* ``TARIFF``: an input of an invoice's HTSUS tariff changed (its date,
+  entry or rate settings, or the rate of an SKU or HTS code on its lines);
+  the tariff is recomputed and its pool reallocated.
+* ``LINES``: lines of an invoice were added, edited or removed, or the
+  invoice moved to another container.  Its tariff is recomputed and every
+  manual pool spread over its lines is reallocated: the pools of the
+  invoice, of its container and those spanning every line.
+* ``CONTAINER``: an invoice left a container (moved or deleted); the
+  container's pools are reallocated.
+
+Receivers below mark single-object saves and deletes.  The bulk paths,
+which bypass signals, mark their own writes: invoice ingestion, catalogue
+upserts (``cogs.upsert``) and HTS schedule imports (``cogs.hts_delta``).
+There is one mark per kind and key, dated by the oldest change it stands
+for.  Country ``section_301_rate`` is applied when results are read and
+never stored, so changing it marks nothing.
+
+``cogs.recalc.recalculate_dirty`` takes the marks with ``claim`` and
+reallocates only what they name, in the same transaction.  Allocating a
+pool or recomputing a tariff directly clears its ``POOL``/``TARIFF`` mark.
+"""
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from tariff.models import Entry
+from .models import CostPool, HTSRateDetail, HTSUSCode, Invoice, InvoiceLine, RecalcMark, SKU
+
+Kind = RecalcMark.Kind
+
+# Marks per INSERT and keys per IN list.
+MARK_BATCH_SIZE = 500
+
+# Fields of each model whose change makes allocations stale.  CostPool's
+# other fields (its name, the shipment details) do not affect any amount.
+WATCHED_FIELDS = {
+    Invoice: ('container_id', 'invoice_date', 'entry_id', 'apply_db_htsus_rate', 'manual_htsus_rate_pct'),
+    InvoiceLine: ('invoice_id',),
+    SKU: ('htsus_code_id', 'htsus_rate_pct'),
+    HTSUSCode: ('rate_pct', 'has_complex_rates'),
+    CostPool: ('scope', 'method', 'amount_total', 'container_id', 'invoice_id', 'auto_compute'),
+}
+
+_state = threading.local()
+
+
+def _chunks(keys):
+    keys = list(keys)
+    for start in range(0, len(keys), MARK_BATCH_SIZE):
+        yield keys[start:start + MARK_BATCH_SIZE]
+
+
+def _write(marks):
+    RecalcMark.objects.bulk_create(
+        [RecalcMark(kind=kind, key=key) for kind, key in marks],
+        batch_size=MARK_BATCH_SIZE, ignore_conflicts=True,
+    )
+
+
+@contextmanager
+def collecting():
+    """Gather the marks made inside the block and write them once at its end.
+
+    For code that saves or deletes many objects, whose receivers would
+    otherwise write one mark each.  Nothing is written if the block raises.
+    """
+    if getattr(_state, 'pending', None) is not None:
+        yield
+        return
+    _state.pending = set()
+    try:
+        yield
+        pending = _state.pending
+    finally:
+        _state.pending = None
+    _write(pending)
+
+
+def mark(kind, keys):
+    """Record a ``kind`` change of the objects with ids ``keys``."""
+    marks = {(kind, key) for key in keys if key is not None}
+    pending = getattr(_state, 'pending', None)
+    if pending is not None:
+        pending |= marks
+    elif marks:
+        _write(marks)
+
+
+def clear(kind, keys):
+    """Drop the ``kind`` marks of ``keys``, whose changes have just been applied."""
+    keys = {key for key in keys if key is not None}
+    pending = getattr(_state, 'pending', None)
+    if pending is not None:
+        pending -= {(kind, key) for key in keys}
+    for chunk in _chunks(keys):
+        RecalcMark.objects.filter(kind=kind, key__in=chunk).delete()
+
+
+def skus_changed(sku_ids):
+    """Mark the tariffs of the invoices with lines of the SKUs ``sku_ids``."""
+    for chunk in _chunks(sku_ids):
+        mark(Kind.TARIFF, InvoiceLine.objects.filter(sku_id__in=chunk).values_list('invoice_id', flat=True).distinct())
+
+
+def hts_codes_changed(code_ids):
+    """Mark the tariffs of the invoices with lines of SKUs classified under ``code_ids``."""
+    for chunk in _chunks(code_ids):
+        mark(Kind.TARIFF, InvoiceLine.objects.filter(sku__htsus_code_id__in=chunk).values_list(
+            'invoice_id', flat=True).distinct())
+
+
+def rows_changed(model, unique_field, keys):
+    """Mark what depends on the ``model`` rows whose ``unique_field`` is in ``keys``, for bulk writers."""
+    if model not in (SKU, HTSUSCode):
+        return
+    for chunk in _chunks(keys):
+        pks = model.objects.filter(**{f'{unique_field}__in': chunk}).values_list('pk', flat=True)
+        (skus_changed if model is SKU else hts_codes_changed)(pks)
+
+
+@dataclass
+class Changes:
+    """Claimed marks, as sets of ids per kind."""
+    pools: set = field(default_factory=set)
+    tariffs: set = field(default_factory=set)
+    lines: set = field(default_factory=set)
+    containers: set = field(default_factory=set)
+
+    def marks(self):
+        for kind, keys in ((Kind.POOL, self.pools), (Kind.TARIFF, self.tariffs),
+                           (Kind.LINES, self.lines), (Kind.CONTAINER, self.containers)):
+            yield from ((kind, key) for key in keys)
+
+
+def claim():
+    """Delete every pending mark and return them as ``Changes``.
+
+    Call it inside the transaction that applies the changes: if that
+    fails the marks are back.  Marks made meanwhile by other transactions
+    are kept for the next run.
+    """
+    marks = list(RecalcMark.objects.select_for_update().values_list('pk', 'kind', 'key'))
+    for chunk in _chunks(pk for pk, _, _ in marks):
+        RecalcMark.objects.filter(pk__in=chunk).delete()
+    changes = Changes()
+    sets = {Kind.POOL: changes.pools, Kind.TARIFF: changes.tariffs,
+            Kind.LINES: changes.lines, Kind.CONTAINER: changes.containers}
+    for _, kind, key in marks:
+        sets[kind].add(key)
+    return changes
+
+
+def restore(changes):
+    """Put claimed ``changes`` back, e.g. after a recalculation spanning several transactions failed."""
+    _write(list(changes.marks()))
+
+
+# --- receivers ---
+
+def _remember_inputs(sender, instance, raw=False, **kwargs):
+    if raw or instance._state.adding or instance.pk is None:
+        return
+    instance._recalc_inputs = sender.objects.filter(pk=instance.pk).values(*WATCHED_FIELDS[sender]).first()
+
+
+for _model in WATCHED_FIELDS:
+    pre_save.connect(_remember_inputs, sender=_model, dispatch_uid=f'cogs.dirty.{_model.__name__}')
+
+
+def _changed(instance):
+    """``{field: value before}`` for the watched fields the save changed; ``None`` for a new row."""
+    before = instance.__dict__.pop('_recalc_inputs', None)
+    if before is None:
+        return None
+    meta = instance._meta
+    return {
+        name: value for name, value in before.items()
+        if meta.get_field(name).to_python(getattr(instance, name)) != value
+    }
+
+
+@receiver(post_save, sender=Invoice)
+def _invoice_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    changed = _changed(instance)
+    if changed is None:
+        # A new invoice gets its (empty) tariff pool.
+        mark(Kind.TARIFF, [instance.pk])
+    elif 'container_id' in changed:
+        mark(Kind.LINES, [instance.pk])
+        mark(Kind.CONTAINER, [changed['container_id']])
+    elif changed:
+        mark(Kind.TARIFF, [instance.pk])
+
+
+@receiver(post_delete, sender=Invoice)
+def _invoice_deleted(sender, instance, **kwargs):
+    # Its own pools are gone; those of its container and all lines remain.
+    mark(Kind.LINES, [instance.pk])
+    mark(Kind.CONTAINER, [instance.container_id])
+
+
+@receiver(post_save, sender=InvoiceLine)
+def _line_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    changed = _changed(instance)
+    mark(Kind.LINES, [instance.invoice_id, *(changed or {}).values()])
+
+
+@receiver(post_delete, sender=InvoiceLine)
+def _line_deleted(sender, instance, **kwargs):
+    mark(Kind.LINES, [instance.invoice_id])
+
+
+@receiver(post_save, sender=SKU)
+def _sku_saved(sender, instance, raw=False, **kwargs):
+    # A new SKU is on no line yet.
+    if not raw and _changed(instance):
+        skus_changed([instance.pk])
+
+
+@receiver(post_save, sender=HTSUSCode)
+def _hts_code_saved(sender, instance, raw=False, **kwargs):
+    if not raw and _changed(instance):
+        hts_codes_changed([instance.pk])
+
+
+@receiver(pre_delete, sender=HTSUSCode)
+def _hts_code_deleted(sender, instance, **kwargs):
+    # Before SET_NULL unlinks its SKUs.
+    hts_codes_changed([instance.pk])
+
+
+@receiver(post_save, sender=HTSRateDetail)
+@receiver(post_delete, sender=HTSRateDetail)
+def _rate_detail_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        hts_codes_changed([instance.hts_code_id])
+
+
+@receiver(post_save, sender=Entry)
+@receiver(pre_delete, sender=Entry)
+def _entry_changed(sender, instance, raw=False, **kwargs):
+    # The entry's country of origin selects country-specific rates.
+    if not raw:
+        mark(Kind.TARIFF, Invoice.objects.filter(entry_id=instance.pk).values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=CostPool)
+def _pool_saved(sender, instance, raw=False, **kwargs):
+    changed = _changed(instance)
+    # HTSUS pools follow their invoice's TARIFF mark.
+    if not raw and not instance.auto_compute and (changed is None or changed):
+        mark(Kind.POOL, [instance.pk])
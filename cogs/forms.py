@@ -10,6 +10,11 @@ class InvoiceUploadForm(forms.Form):
         widget=forms.Select(attrs={"class": "form-select"}),
         label="Country of Origin"
     )
+    replace_lines = forms.BooleanField(
+        required=False,
+        widget=forms.CheckboxInput(attrs={"class": "form-check-input"}),
+        label="Replace existing lines"
+    )
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
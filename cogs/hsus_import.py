@@ -0,0 +1,71 @@
+"""Row parsing for the ``import_hsus_data`` management command.
+
+Kept free of Django imports so that shards of the file can be parsed and
+validated in plain worker processes; only the parent process talks to the
+database.
+"""
+from dataclasses import dataclass, field
+from decimal import Decimal, InvalidOperation
+
+COLUMNS = ('HTSUS_Code', 'HTSUS_Description', 'HTSUS_Rate_Pct', 'SKU', 'SKU_Name', 'SKU_HTSUS_Rate_Pct')
+
+
+@dataclass
+class ParsedShard:
+    rows: int = 0
+    hts_rows: list = field(default_factory=list)
+    sku_rows: list = field(default_factory=list)
+    problems: list = field(default_factory=list)
+
+
+def _decimal(value):
+    try:
+        return Decimal(value)
+    except (InvalidOperation, TypeError):
+        return None
+
+
+def parse_shard(header, records):
+    """Validate raw CSV ``records`` (lists of cells) of a shard under ``header``.
+
+    Rules match the original row-by-row command: rows without an HTSUS code,
+    HTSUS rate or SKU are skipped; a row with an invalid HTSUS rate is
+    skipped entirely; a row with an invalid SKU rate still updates its HTSUS
+    code but not the SKU.  SKU rows carry the HTSUS code, which the caller
+    resolves to an id.
+    """
+    shard = ParsedShard(rows=len(records))
+    for record in records:
+        row = dict(zip(header, record))
+        htsus_code_str = row.get('HTSUS_Code')
+        htsus_rate_pct_str = row.get('HTSUS_Rate_Pct')
+        sku_str = row.get('SKU')
+
+        if not htsus_code_str or not htsus_rate_pct_str or not sku_str:
+            shard.problems.append(f"Skipping row due to missing required data: {row}")
+            continue
+
+        htsus_rate_pct = _decimal(htsus_rate_pct_str)
+        if htsus_rate_pct is None:
+            shard.problems.append(f"Invalid HTSUS_Rate_Pct for HTSUS_Code {htsus_code_str}: {htsus_rate_pct_str}")
+            continue
+        shard.hts_rows.append({
+            'code': htsus_code_str,
+            'description': row.get('HTSUS_Description') or '',
+            'rate_pct': htsus_rate_pct,
+        })
+
+        sku_htsus_rate_pct_str = row.get('SKU_HTSUS_Rate_Pct')
+        sku_htsus_rate_pct = None
+        if sku_htsus_rate_pct_str:
+            sku_htsus_rate_pct = _decimal(sku_htsus_rate_pct_str)
+            if sku_htsus_rate_pct is None:
+                shard.problems.append(f"Invalid SKU_HTSUS_Rate_Pct for SKU {sku_str}: {sku_htsus_rate_pct_str}")
+                continue
+        shard.sku_rows.append({
+            'sku': sku_str,
+            'name': row.get('SKU_Name') or '',
+            'htsus_code': htsus_code_str,
+            'htsus_rate_pct': sku_htsus_rate_pct,
+        })
+    return shard
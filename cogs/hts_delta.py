@@ -0,0 +1,208 @@
+"""Incremental (delta) import of HTS schedule revisions.
+
+Each ``HTSUSCode`` stores a checksum of the description and rate it was last
+imported with.  ``import_schedule`` loads the stored ``code -> checksum``
+map once, makes a single pass over the incoming rows and writes only codes
+that are new, changed, restored or (for a full schedule) no longer listed,
+with ``bulk_create``/``bulk_update`` in batches.  Everything else is left
+untouched, so a revision that changes a few hundred rates writes a few
+hundred rows.
+
+The returned change set lists every code whose rate changed as
+``{'code', 'old_rate', 'new_rate', 'change'}`` (retiring a code keeps its
+rate, so retirements are not listed); ``affected_invoices`` turns it into
+the invoices whose tariff needs recalculating; the import marks
+them for the next recalculation (see ``cogs.dirty``).
+"""
+from dataclasses import dataclass, field
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import dirty
+from .ingestion import LOOKUP_CHUNK_SIZE
+from .models import HTS_RATE_QUANTUM, HTSUSCode, Invoice, schedule_checksum
+
+DELTA_BATCH_SIZE = 1000
+
+
+def _normalize_rate(rate):
+    return None if rate is None else Decimal(rate).quantize(HTS_RATE_QUANTUM)
+
+
+@dataclass
+class ScheduleDelta:
+    created: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    retired: int = 0
+    restored: int = 0
+    changes: list = field(default_factory=list)
+
+    def as_result(self):
+        return {
+            'created': self.created,
+            'updated': self.updated,
+            'unchanged': self.unchanged,
+            'retired': self.retired,
+            'restored': self.restored,
+            'changes': self.changes,
+        }
+
+
+def _rate_str(rate):
+    return None if rate is None else str(_normalize_rate(rate))
+
+
+class ScheduleImporter:
+    def __init__(self, retire_missing=False, batch_size=DELTA_BATCH_SIZE):
+        self.retire_missing = retire_missing
+        self.batch_size = batch_size
+        self.delta = ScheduleDelta()
+        self._seen = set()
+        # code -> (rate before this import, kind of change) for touched codes
+        self._first = {}
+        self._changes = {}
+        self._to_create = {}
+        self._to_update = {}
+
+    def run(self, rows):
+        with transaction.atomic():
+            self._load_stored()
+            for row in rows:
+                self._apply_row(row)
+                if len(self._to_create) + len(self._to_update) >= self.batch_size:
+                    self._flush()
+            self._flush()
+            if self.retire_missing:
+                self._retire()
+            self.delta.changes = list(self._changes.values())
+            # bulk_update sends no signals; see cogs.dirty.
+            dirty.mark(dirty.Kind.TARIFF, affected_invoices(self.delta.changes))
+        return self.delta
+
+    def _load_stored(self):
+        # code -> [id, checksum, rate_pct, retired]; the whole schedule is a
+        # few tens of thousands of short rows.
+        self._stored = {}
+        for pk, code, checksum, description, rate_pct, retired_at in HTSUSCode.objects.values_list(
+            'id', 'code', 'checksum', 'description', 'rate_pct', 'retired_at'
+        ):
+            # Codes created before checksums existed are fingerprinted on the fly.
+            checksum = checksum or schedule_checksum(description, rate_pct)
+            self._stored[code] = [pk, checksum, rate_pct, retired_at is not None]
+
+    def _note_change(self, code, new_rate):
+        old_rate, change = self._first[code]
+        if change == 'updated' and _normalize_rate(old_rate) == _normalize_rate(new_rate):
+            # Description-only edits do not affect any tariff.
+            self._changes.pop(code, None)
+            return
+        self._changes[code] = {
+            'code': code,
+            'old_rate': _rate_str(old_rate),
+            'new_rate': _rate_str(new_rate),
+            'change': change,
+        }
+
+    def _apply_row(self, row):
+        code, description, rate_pct = row['code'], row['description'], row['rate_pct']
+        checksum = schedule_checksum(description, rate_pct)
+        repeat = code in self._seen
+        self._seen.add(code)
+
+        # A code listed again before its batch was flushed: last row wins.
+        pending = self._to_create.get(code) or self._to_update.get(code)
+        if pending is not None:
+            pending.description, pending.rate_pct, pending.checksum = description, rate_pct, checksum
+            self._stored[code][1:3] = [checksum, rate_pct]
+            self._note_change(code, rate_pct)
+            return
+
+        stored = self._stored.get(code)
+        if stored is None:
+            self._to_create[code] = HTSUSCode(code=code, description=description, rate_pct=rate_pct, checksum=checksum)
+            self._stored[code] = [None, checksum, rate_pct, False]
+            self._first[code] = (None, 'created')
+            self.delta.created += 1
+            self._note_change(code, rate_pct)
+            return
+
+        pk, stored_checksum, stored_rate, retired = stored
+        if stored_checksum == checksum and not retired:
+            if not repeat:
+                self.delta.unchanged += 1
+            return
+
+        self._to_update[code] = HTSUSCode(
+            id=pk, code=code, description=description, rate_pct=rate_pct, checksum=checksum, retired_at=None,
+        )
+        stored[1:] = [checksum, rate_pct, False]
+        if code not in self._first:
+            if retired:
+                self._first[code] = (None, 'restored')
+                self.delta.restored += 1
+            else:
+                self._first[code] = (stored_rate, 'updated')
+                self.delta.updated += 1
+        self._note_change(code, rate_pct)
+
+    def _flush(self):
+        if self._to_create:
+            created = HTSUSCode.objects.bulk_create(self._to_create.values(), batch_size=self.batch_size)
+            for obj in created:
+                self._stored[obj.code][0] = obj.pk
+            self._to_create = {}
+        if self._to_update:
+            HTSUSCode.objects.bulk_update(
+                self._to_update.values(), ['description', 'rate_pct', 'checksum', 'retired_at'],
+                batch_size=self.batch_size,
+            )
+            self._to_update = {}
+
+    def _retire(self):
+        retired = [
+            pk
+            for code, (pk, _, _, is_retired) in self._stored.items()
+            if code not in self._seen and not is_retired
+        ]
+        now = timezone.now()
+        for start in range(0, len(retired), self.batch_size):
+            HTSUSCode.objects.filter(pk__in=retired[start:start + self.batch_size]).update(retired_at=now)
+        # Not rate changes: the code and its rate stay in place, so no
+        # tariff changes.
+        self.delta.retired = len(retired)
+
+
+def import_schedule(rows, retire_missing=False, batch_size=DELTA_BATCH_SIZE):
+    """Apply an HTS schedule (``{'code', 'description', 'rate_pct'}`` rows) as a delta.
+
+    With ``retire_missing`` the rows are taken as the complete schedule and
+    stored codes they do not list are retired (``retired_at`` is set; the
+    code and its rate stay in place for SKUs and past invoices).  A retired
+    code that reappears is restored.  Returns a ``ScheduleDelta``.
+    """
+    return ScheduleImporter(retire_missing, batch_size).run(rows)
+
+
+def affected_invoices(changes):
+    """Ids of the invoices whose HTSUS tariff may change because of ``changes``.
+
+    Only rate changes of codes in use matter: invoices that fall back to
+    database rates (they apply them, or have no manual rate), as
+    ``AllocationService.compute_htsus_pools`` does, and have lines whose SKU
+    points at a changed code without a SKU-level rate override.  The codes
+    are looked up in chunks to stay under SQLite's parameter limit.
+    """
+    codes = [change['code'] for change in changes if change['old_rate'] != change['new_rate']]
+    uses_db_rates = Q(apply_db_htsus_rate=True) | Q(manual_htsus_rate_pct__isnull=True)
+    invoice_ids = set()
+    for start in range(0, len(codes), LOOKUP_CHUNK_SIZE):
+        invoice_ids.update(Invoice.objects.filter(
+            uses_db_rates
+            & Q(lines__sku__htsus_code__code__in=codes[start:start + LOOKUP_CHUNK_SIZE])
+            & Q(lines__sku__htsus_rate_pct__isnull=True)
+        ).values_list('pk', flat=True).distinct())
+    return sorted(invoice_ids)
@@ -0,0 +1,272 @@
+"""Set-based ingestion of invoice CSV rows.
+
+``InvoiceIngestor`` replaces the per-row ``get_or_create`` loop that
+``invoice_upload`` used to run.  All container IDs, SKUs and invoice numbers
+in a file are resolved with a handful of ``IN`` queries, the missing ones are
+created with ``bulk_create`` and the ``InvoiceLine`` rows are inserted in
+batches, all inside a single transaction.  Rows can be fed straight from
+``readers.iter_csv_batches`` so large files are never loaded whole.
+"""
+from collections import defaultdict
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from decimal import Decimal
+
+from django.db import transaction
+
+from . import dirty
+from .models import Container, SKU, Invoice, InvoiceLine
+from .readers import iter_batches
+from .uploads import line_hash
+
+logger = logging.getLogger(__name__)
+
+INVOICE_DATE_FORMATS = ('%Y-%m-%d', '%m/%d/%y', '%d.%m.%Y', '%m/%d/%Y')
+
+# Keep IN lists below SQLite's historical 999 bound-parameter limit.
+LOOKUP_CHUNK_SIZE = 500
+INSERT_BATCH_SIZE = 1000
+
+
+def parse_invoice_date(value):
+    """Parse an ``Invoice date`` cell using the supported formats, in order."""
+    for fmt in INVOICE_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date()
+        except (ValueError, TypeError):
+            continue
+    raise ValueError(f"Date format for {value} not supported")
+
+
+def fetch_values_in(queryset, field, values, chunk_size=LOOKUP_CHUNK_SIZE):
+    """Yield rows of ``queryset`` whose ``field`` is in ``values``, chunking the IN list."""
+    values = list(values)
+    for start in range(0, len(values), chunk_size):
+        chunk = values[start:start + chunk_size]
+        yield from queryset.filter(**{f'{field}__in': chunk})
+
+
+@dataclass
+class IngestionResult:
+    rows: int = 0
+    containers_created: int = 0
+    skus_created: int = 0
+    invoices_created: int = 0
+    lines_created: int = 0
+    lines_unchanged: int = 0
+    lines_deleted: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+
+class InvoiceIngestor:
+    """Bulk loader producing exactly the rows the legacy per-row upload did.
+
+    Semantics kept from the row-by-row version:
+
+    * every ``Container ID`` and ``SKU`` in the file exists afterwards;
+    * an invoice number that is already in the database keeps its stored
+      date, container, country and PO; a new one takes them from the first
+      row that mentions it;
+    * one ``InvoiceLine`` is created per CSV row of a new invoice, in file
+      order.
+
+    For an invoice that already has lines only the difference is applied:
+    rows whose ``row_hash`` matches an existing line are skipped and the
+    others are inserted.  Identical rows are matched by count, so a row
+    listed twice keeps two lines.  Re-uploading a file therefore no longer
+    duplicates its lines, while an invoice split across several files keeps
+    the lines of each.  With ``replace_lines`` the file is taken as the new
+    content of the invoices it lists, and their existing lines with no
+    matching row are deleted at the end.
+
+    Rows are consumed in batches, so only the current batch plus the
+    key -> id maps of the containers, SKUs and invoices seen so far are held
+    in memory.  Unlike the old loop, a bad row aborts the whole file instead
+    of leaving the rows before it committed.  Invoices whose lines changed
+    get a ``LINES`` mark for the next recalculation (see ``cogs.dirty``).
+    """
+
+    def __init__(self, country_origin=None, batch_size=INSERT_BATCH_SIZE, replace_lines=False):
+        self.country_origin = country_origin
+        self.batch_size = batch_size
+        self.replace_lines = replace_lines
+        self._container_ids = {}
+        self._sku_ids = {}
+        self._invoice_ids = {}
+        # invoice id -> row hash -> ids of not yet matched lines, for the
+        # invoices that had lines before this upload.
+        self._existing_lines = {}
+
+    def ingest(self, rows):
+        """Ingest an iterable of CSV ``DictReader`` rows."""
+        return self.ingest_batches(iter_batches(rows, self.batch_size))
+
+    def ingest_batches(self, batches):
+        """Ingest an iterable of row batches inside one transaction."""
+        return self.ingest_parsed([self.parse_row(row) for row in batch] for batch in batches)
+
+    def ingest_parsed(self, batches, result=None):
+        """Ingest batches of rows already converted by ``parse_row``, inside one transaction.
+
+        Pass ``result`` to follow the counters while ``batches`` is consumed,
+        e.g. to attribute lines to the file they came from.
+        """
+        start = time.perf_counter()
+        if result is None:
+            result = IngestionResult()
+
+        with transaction.atomic(), dirty.collecting():
+            for batch in batches:
+                self.write_batch(batch, result)
+            if self.replace_lines:
+                self._delete_unmatched_lines(result)
+
+        result.elapsed = time.perf_counter() - start
+        logger.info(
+            "Ingested %d invoice rows in %.2fs (%.0f rows/sec)",
+            result.rows, result.elapsed, result.rows_per_sec,
+        )
+        return result
+
+    def write_batch(self, parsed, result):
+        """Resolve the keys of one batch of parsed rows and insert its lines."""
+        self._resolve_containers(parsed, result)
+        self._resolve_skus(parsed, result)
+        self._resolve_invoices(parsed, result)
+
+        lines = []
+        for row in parsed:
+            invoice_id = self._invoice_ids[row['invoice_number']]
+            existing = self._existing_lines.get(invoice_id)
+            if existing and existing.get(row['row_hash']):
+                existing[row['row_hash']].pop()
+                result.lines_unchanged += 1
+                continue
+            lines.append(InvoiceLine(
+                invoice_id=invoice_id,
+                sku_id=self._sku_ids[row['sku']],
+                quantity=row['quantity'],
+                price_vendor=row['price_vendor'],
+                total_vendor=row['total_vendor'],
+                unit_volume_cc=row['unit_volume_cc'],
+                row_hash=row['row_hash'],
+            ))
+        InvoiceLine.objects.bulk_create(lines, batch_size=self.batch_size)
+        # bulk_create sends no signals; deleted lines are marked by cogs.dirty.
+        dirty.mark(dirty.Kind.LINES, {line.invoice_id for line in lines})
+        result.rows += len(parsed)
+        result.lines_created += len(lines)
+
+    def parse_row(self, row):
+        """Convert one CSV ``DictReader`` row into typed values."""
+        parsed = {
+            'invoice_date': parse_invoice_date(row.get('Invoice date')),
+            'container_id': row.get('Container ID'),
+            'sku': row.get('SKU'),
+            'invoice_number': row.get('Invoice#'),
+            'po_number': row.get('PO#'),
+            'quantity': int(float(row.get('Quantity'))),
+            'price_vendor': Decimal(row.get('Price')),
+            'total_vendor': Decimal(row.get('Total')),
+            'unit_volume_cc': float(row.get('Volume')),
+        }
+        parsed['row_hash'] = line_hash(
+            parsed['sku'], parsed['quantity'], parsed['price_vendor'],
+            parsed['total_vendor'], parsed['unit_volume_cc'],
+        )
+        return parsed
+
+    def _resolve_containers(self, parsed, result):
+        wanted = [key for key in dict.fromkeys(row['container_id'] for row in parsed)
+                  if key not in self._container_ids]
+        if not wanted:
+            return
+        queryset = Container.objects.values_list('container_id', 'id')
+        self._container_ids.update(fetch_values_in(queryset, 'container_id', wanted))
+        missing = [key for key in wanted if key not in self._container_ids]
+        if missing:
+            Container.objects.bulk_create([Container(container_id=key) for key in missing], batch_size=self.batch_size)
+            self._container_ids.update(fetch_values_in(queryset, 'container_id', missing))
+            result.containers_created += len(missing)
+
+    def _resolve_skus(self, parsed, result):
+        wanted = [key for key in dict.fromkeys(row['sku'] for row in parsed)
+                  if key not in self._sku_ids]
+        if not wanted:
+            return
+        queryset = SKU.objects.values_list('sku', 'id')
+        self._sku_ids.update(fetch_values_in(queryset, 'sku', wanted))
+        missing = [key for key in wanted if key not in self._sku_ids]
+        if missing:
+            SKU.objects.bulk_create([SKU(sku=key) for key in missing], batch_size=self.batch_size)
+            self._sku_ids.update(fetch_values_in(queryset, 'sku', missing))
+            result.skus_created += len(missing)
+
+    def _resolve_invoices(self, parsed, result):
+        # First row wins for the defaults of a new invoice, as with get_or_create.
+        first_rows = {}
+        for row in parsed:
+            if row['invoice_number'] not in self._invoice_ids:
+                first_rows.setdefault(row['invoice_number'], row)
+        if not first_rows:
+            return
+
+        queryset = Invoice.objects.values_list('invoice_number', 'id')
+        found = []
+        for number, pk in fetch_values_in(queryset, 'invoice_number', first_rows):
+            if number in self._invoice_ids:
+                count = Invoice.objects.filter(invoice_number=number).count()
+                raise Invoice.MultipleObjectsReturned(
+                    f"get() returned more than one Invoice -- it returned {count}!"
+                )
+            self._invoice_ids[number] = pk
+            found.append(pk)
+        if found:
+            self._load_existing_lines(found)
+
+        missing = [
+            Invoice(
+                invoice_number=number,
+                invoice_date=row['invoice_date'],
+                container_id=self._container_ids[row['container_id']],
+                country_origin=self.country_origin,
+                po_number=row['po_number'],
+            )
+            for number, row in first_rows.items()
+            if number not in self._invoice_ids
+        ]
+        if missing:
+            Invoice.objects.bulk_create(missing, batch_size=self.batch_size)
+            # invoice_number is not unique, but none of these existed before
+            # the insert and we are inside the same transaction.
+            self._invoice_ids.update(
+                fetch_values_in(queryset, 'invoice_number', [i.invoice_number for i in missing])
+            )
+            result.invoices_created += len(missing)
+
+    def _load_existing_lines(self, invoice_ids):
+        queryset = InvoiceLine.objects.values_list(
+            'invoice_id', 'id', 'row_hash',
+            'sku__sku', 'quantity', 'price_vendor', 'total_vendor', 'unit_volume_cc',
+        )
+        for invoice_id, pk, row_hash, *values in fetch_values_in(queryset, 'invoice_id', invoice_ids):
+            # Lines imported before row hashes existed are hashed on the fly.
+            row_hash = row_hash or line_hash(*values)
+            self._existing_lines.setdefault(invoice_id, defaultdict(list))[row_hash].append(pk)
+
+    def _delete_unmatched_lines(self, result):
+        stale = [
+            pk
+            for by_hash in self._existing_lines.values()
+            for pks in by_hash.values()
+            for pk in pks
+        ]
+        for start in range(0, len(stale), LOOKUP_CHUNK_SIZE):
+            InvoiceLine.objects.filter(pk__in=stale[start:start + LOOKUP_CHUNK_SIZE]).delete()
+        result.lines_deleted += len(stale)
@@ -0,0 +1,212 @@
+"""DB-backed background job queue.
+
+Views call ``enqueue`` and return immediately; ``manage.py run_workers``
+claims queued jobs and runs their handlers in a process pool.  Handlers are
+plain functions taking the ``Job`` and returning a JSON-serializable result
+dict; they do their database writes inside a transaction so that a job
+interrupted by a crash can simply be run again.
+
+With ``settings.COGS_JOBS_EAGER`` enabled (the default when ``DEBUG`` is on)
+jobs run inline in the request, which keeps ``runserver`` usable without a
+worker process.
+"""
+import logging
+import os
+import socket
+import uuid
+from datetime import timedelta
+from importlib import import_module
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+# kind -> dotted path of the handler; imported lazily so that apps can
+# register handlers without import cycles between them.
+JOB_HANDLERS = {
+    'invoice_upload': 'cogs.tasks.process_invoice_upload',
+    'invoice_archive_upload': 'cogs.tasks.process_invoice_archive',
+    'htsus_bulk_upload': 'cogs.tasks.process_htsus_upload',
+    'recalculate_costs': 'cogs.tasks.recalculate_costs',
+    'financial_upload': 'consolidation_app.tasks.process_financial_upload',
+    'budget_upload': 'consolidation_app.tasks.process_budget_upload',
+}
+
+UPLOAD_DIR = 'jobs'
+
+# Set in pool worker processes; progress is sent to the supervising process
+# because the handler's own connection is usually inside a transaction.
+_progress_queue = None
+
+
+class JobError(Exception):
+    """Raised by a handler to fail its job with a user-facing message.
+
+    ``result`` is stored on the failed job, e.g. for a table of row errors.
+    """
+
+    def __init__(self, message, result=None):
+        super().__init__(message)
+        self.result = result or {}
+
+
+def get_handler(kind):
+    module_path, _, name = JOB_HANDLERS[kind].rpartition('.')
+    return getattr(import_module(module_path), name)
+
+
+def save_upload(uploaded_file):
+    """Persist an uploaded file for a job and return its storage name."""
+    name = f"{UPLOAD_DIR}/{uuid.uuid4().hex}_{os.path.basename(uploaded_file.name)}"
+    return default_storage.save(name, uploaded_file)
+
+
+def enqueue(kind, payload=None, user=None, run_after=None):
+    """Queue a job of ``kind``, to be claimed once ``run_after`` has passed; runs it straight away in eager mode."""
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    job = Job.objects.create(
+        kind=kind,
+        payload=payload or {},
+        user=user if user is not None and user.is_authenticated else None,
+        run_after=run_after,
+    )
+    if settings.COGS_JOBS_EAGER:
+        if claim_job(job, worker='eager', when_due=False):
+            execute_job(job.pk)
+        job.refresh_from_db()
+    return job
+
+
+def _due(now):
+    return Q(run_after__isnull=True) | Q(run_after__lte=now)
+
+
+def claim_job(job, worker='', when_due=True):
+    """Atomically move ``job`` from QUEUED to RUNNING; False if someone else got it.
+
+    Also False if ``job`` is not due yet, checked in the same update so
+    that a ``run_after`` pushed back since ``job`` was selected wins;
+    ``when_due=False`` claims it regardless.
+    """
+    now = timezone.now()
+    queued = Job.objects.filter(pk=job.pk, status=Job.Status.QUEUED)
+    if when_due:
+        queued = queued.filter(_due(now))
+    claimed = queued.update(
+        status=Job.Status.RUNNING,
+        worker=worker,
+        attempts=F('attempts') + 1,
+        started_at=now,
+        heartbeat_at=now,
+    )
+    return claimed == 1
+
+
+def claim_next_job(worker=''):
+    """Claim the oldest queued job that is due, or return None if there is none."""
+    for job in Job.objects.filter(_due(timezone.now()), status=Job.Status.QUEUED).order_by('created_at', 'id')[:10]:
+        if claim_job(job, worker):
+            return job
+    return None
+
+
+def requeue_stale_jobs(stale_after=None):
+    """Requeue RUNNING jobs whose worker stopped sending heartbeats.
+
+    Jobs that already used ``COGS_JOB_MAX_ATTEMPTS`` attempts are failed
+    instead.  Returns the number of jobs touched.
+    """
+    stale_after = stale_after or settings.COGS_JOB_STALE_SECONDS
+    cutoff = timezone.now() - timedelta(seconds=stale_after)
+    stale = Job.objects.filter(status=Job.Status.RUNNING, heartbeat_at__lt=cutoff)
+    failed = stale.filter(attempts__gte=settings.COGS_JOB_MAX_ATTEMPTS).update(
+        status=Job.Status.FAILED,
+        error='Worker stopped responding',
+        finished_at=timezone.now(),
+    )
+    requeued = stale.update(status=Job.Status.QUEUED, worker='')
+    if failed or requeued:
+        logger.warning("Requeued %d and failed %d stale jobs", requeued, failed)
+    return failed + requeued
+
+
+def release_jobs(job_ids, error):
+    """Put jobs whose worker process died back on the queue, or fail them when out of attempts."""
+    running = Job.objects.filter(pk__in=job_ids, status=Job.Status.RUNNING)
+    running.filter(attempts__gte=settings.COGS_JOB_MAX_ATTEMPTS).update(
+        status=Job.Status.FAILED,
+        error=error,
+        finished_at=timezone.now(),
+    )
+    running.update(status=Job.Status.QUEUED, worker='')
+
+
+def heartbeat(job_ids):
+    Job.objects.filter(pk__in=job_ids, status=Job.Status.RUNNING).update(heartbeat_at=timezone.now())
+
+
+def report_progress(job, done, total=None, message=''):
+    """Record handler progress for the status endpoint."""
+    if _progress_queue is not None:
+        _progress_queue.put((job.pk, done, total, message))
+    else:
+        save_progress(job.pk, done, total, message)
+
+
+def save_progress(job_id, done, total=None, message=''):
+    Job.objects.filter(pk=job_id).update(
+        progress_done=done,
+        progress_total=total,
+        progress_message=message[:255],
+        heartbeat_at=timezone.now(),
+    )
+
+
+def execute_job(job_id):
+    """Run the handler of a claimed job and store its outcome."""
+    job = Job.objects.get(pk=job_id)
+    try:
+        result = get_handler(job.kind)(job)
+    except Exception as e:
+        if not isinstance(e, JobError):
+            logger.exception("Job %s failed", job_id)
+        Job.objects.filter(pk=job_id).update(
+            status=Job.Status.FAILED,
+            error=str(e),
+            result=getattr(e, 'result', None) or {},
+            finished_at=timezone.now(),
+        )
+        status = Job.Status.FAILED
+    else:
+        Job.objects.filter(pk=job_id).update(
+            status=Job.Status.SUCCEEDED,
+            result=result or {},
+            finished_at=timezone.now(),
+        )
+        status = Job.Status.SUCCEEDED
+    _delete_job_files(job)
+    return status
+
+
+def _delete_job_files(job):
+    for name in job.payload.get('files', []):
+        try:
+            default_storage.delete(name)
+        except OSError:
+            logger.warning("Could not delete job file %s", name)
+
+
+def set_progress_queue(progress_queue):
+    """Send progress through ``progress_queue`` instead of writing it directly (pool workers)."""
+    global _progress_queue
+    _progress_queue = progress_queue
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
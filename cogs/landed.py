@@ -0,0 +1,193 @@
+"""Per-line landed cost, as the results page shows it.
+
+``landed_cost_rows`` turns invoice lines and the cost allocated to them
+into the dicts ``results.html`` renders.  The results view feeds it the
+stored ``AllocatedCost`` rows; ``AllocationService.what_if`` feeds it
+allocations computed in memory for hypothetical pools.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+import numpy as np
+
+from tariff.models import Country
+
+from .models import Invoice, InvoiceLine, SKU
+from .money import CENT_PLACES, multiply, round_divide, to_decimals, to_fixed, to_units
+
+# Pools with their own column; every other pool is an "other cost".
+FREIGHT_POOL = 'Freight Cost'
+HTSUS_POOL = 'HTSUS Tariff'
+# Vendor cost (cents) times a rate (1/10000 percent) is exact in 10**-8 dollars.
+TARIFF_PLACES = 8
+
+
+def load_lines(lines):
+    """The lines of the queryset ``lines`` with their invoice (and container) and SKU (and HTS code).
+
+    Each invoice and SKU is loaded once and shared by its lines rather than
+    joined into every line's row, which keeps large result sets cheap.
+    """
+    lines = list(lines)
+    invoices = Invoice.objects.select_related('container').in_bulk({line.invoice_id for line in lines})
+    skus = SKU.objects.select_related('htsus_code').in_bulk({line.sku_id for line in lines})
+    # The fields' cache setters skip the descriptors' checks, which are
+    # noticeable over thousands of lines.
+    cache_invoice = InvoiceLine.invoice.field.set_cached_value
+    cache_sku = InvoiceLine.sku.field.set_cached_value
+    for line in lines:
+        cache_invoice(line, invoices[line.invoice_id])
+        cache_sku(line, skus[line.sku_id])
+    return lines
+
+
+def group_allocations(rows):
+    """``{line_id: [(pool_name, amount), ...]}`` from ``(line_id, pool_name, amount)`` rows in pk order."""
+    allocations = defaultdict(list)
+    for line_id, pool_name, amount in rows:
+        allocations[line_id].append((pool_name, amount))
+    return allocations
+
+
+def section_301_rates():
+    return {code: rate or Decimal('0') for code, rate in Country.objects.values_list('code', 'section_301_rate')}
+
+
+def landed_cost_rows(lines, allocations, rate_overrides=None):
+    """One results row per line of ``lines`` (loaded by ``load_lines``).
+
+    ``allocations`` maps a line id to its ``(pool_name, amount)`` pairs,
+    see ``group_allocations``; the first "Freight Cost" amount fills the
+    freight column.  ``rate_overrides`` maps HTS codes to a rate (percent)
+    used instead of the code's own rate.
+
+    The arithmetic runs on integer arrays (``cogs.money``): amounts in
+    cents, rates in 1/10000 percent and tariffs, exact, in 10**-8 dollars.
+    The rows hold the same values ``reference_landed_cost_rows`` computes
+    with ``Decimal``.
+    """
+    overrides = {code: to_units(rate) for code, rate in (rate_overrides or {}).items()}
+    country_rates = {code: to_units(rate) for code, rate in section_301_rates().items()}
+
+    def hts_rate(sku):
+        if sku is None:
+            return 0
+        if sku.htsus_rate_pct is not None:
+            return to_units(sku.htsus_rate_pct)
+        hts = sku.htsus_code
+        if hts is None:
+            return 0
+        return overrides[hts.code] if hts.code in overrides else to_units(hts.rate_pct)
+
+    def section_301_rate(invoice):
+        country = invoice.country_origin if invoice else None
+        return country_rates.get(country, 0) if country else 0
+
+    # Rates are looked up once per SKU and invoice; this loop only gathers.
+    lines = list(lines)
+    sku_rates, invoice_rates = {}, {}
+    freight, other, other_total, hts, section_301 = [], [], [], [], []
+    for line in lines:
+        freight_amount, other_amounts, other_sum = None, {}, 0.0
+        for name, amount in allocations.get(line.id, ()):
+            if name == FREIGHT_POOL:
+                if freight_amount is None:
+                    freight_amount = amount
+            elif name != HTSUS_POOL:
+                other_amounts[name] = amount
+                # Whole cents; a float sum of a line's few amounts stays far
+                # within half a cent of the exact total.
+                other_sum += float(amount)
+        freight.append(0 if freight_amount is None else freight_amount)
+        other.append(other_amounts)
+        other_total.append(other_sum)
+        rate = sku_rates.get(line.sku_id)
+        if rate is None:
+            rate = sku_rates[line.sku_id] = hts_rate(line.sku)
+        hts.append(rate)
+        rate = invoice_rates.get(line.invoice_id)
+        if rate is None:
+            rate = invoice_rates[line.invoice_id] = section_301_rate(line.invoice)
+        section_301.append(rate)
+
+    quantity = np.array([line.quantity for line in lines], dtype=np.int64)
+    vendor = multiply(to_fixed([line.price_vendor for line in lines]), quantity)
+    hts_tariff = multiply(vendor, np.array(hts, dtype=np.int64))
+    section_301_duty = multiply(vendor, np.array(section_301, dtype=np.int64))
+    # Everything in 10**-8 dollars: cents times 10**6 plus the tariffs.
+    scale = 10 ** (TARIFF_PLACES - CENT_PLACES)
+    allocated = to_fixed(freight) + to_fixed(other_total)
+    total = multiply(vendor + allocated, np.full(len(lines), scale, dtype=np.int64)) + hts_tariff + section_301_duty
+    positive = quantity > 0
+    unit_total = round_divide(total, np.where(positive, quantity, 1) * scale) * positive
+
+    return [
+        {
+            'line': line,
+            'vendor_cost': vendor_cost,
+            'freight_cost': freight_cost,
+            'htsus_tariff': htsus_tariff,
+            'section_301': section_301_amount,
+            'other_cost_allocations': other_cost_allocations,
+            'total_cost': total_cost,
+            'unit_total_cost': unit_total_cost,
+        }
+        for line, vendor_cost, freight_cost, htsus_tariff, section_301_amount, other_cost_allocations, total_cost,
+        unit_total_cost in zip(
+            lines, to_decimals(vendor), freight, to_decimals(hts_tariff, TARIFF_PLACES),
+            to_decimals(section_301_duty, TARIFF_PLACES), other, to_decimals(total, TARIFF_PLACES),
+            to_decimals(unit_total),
+        )
+    ]
+
+
+def reference_landed_cost_rows(lines, allocations, rate_overrides=None):
+    """The per-line ``Decimal`` computation ``landed_cost_rows`` replaces, kept as its specification.
+
+    Used by the tests.
+    """
+    rate_overrides = rate_overrides or {}
+    country_rates = section_301_rates()
+    rows = []
+    for line in lines:
+        vendor_cost = line.price_vendor * line.quantity
+        line_allocations = allocations.get(line.pk, ())
+        freight_cost_amount = next((amount for name, amount in line_allocations if name == FREIGHT_POOL), 0)
+        # Calculate HTSUS tariff on the fly based on SKU rates
+        htsus_rate = Decimal('0')
+        hts = line.sku.htsus_code if line.sku else None
+        hts_rate = rate_overrides.get(hts.code, hts.rate_pct) if hts else None
+        if line.sku and line.sku.htsus_rate_pct is not None:
+            htsus_rate = line.sku.htsus_rate_pct
+        elif hts_rate:
+            htsus_rate = hts_rate
+        htsus_tariff_amount = vendor_cost * (htsus_rate / Decimal('100'))
+
+        # Calculate Section 301 duty based on country
+        section_301_amount = Decimal('0')
+        if line.invoice and line.invoice.country_origin:
+            section_301_rate = country_rates.get(line.invoice.country_origin, Decimal('0'))
+            section_301_amount = vendor_cost * (section_301_rate / Decimal('100'))
+
+        # Collect all other allocated costs for this line
+        other_cost_allocations = {}
+        current_line_other_costs_total = Decimal(0)
+        for name, amount in line_allocations:
+            if name not in (FREIGHT_POOL, HTSUS_POOL):
+                other_cost_allocations[name] = amount
+                current_line_other_costs_total += amount
+
+        total_cost = vendor_cost + freight_cost_amount + htsus_tariff_amount + section_301_amount + current_line_other_costs_total
+        unit_total_cost = (total_cost / line.quantity).quantize(Decimal('0.01')) if line.quantity > 0 else Decimal(0)
+
+        rows.append({
+            'line': line,
+            'vendor_cost': vendor_cost,
+            'freight_cost': freight_cost_amount,
+            'htsus_tariff': htsus_tariff_amount,
+            'section_301': section_301_amount,
+            'other_cost_allocations': other_cost_allocations,
+            'total_cost': total_cost,
+            'unit_total_cost': unit_total_cost,
+        })
+    return rows
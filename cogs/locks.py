@@ -0,0 +1,106 @@
+"""Scope locks for concurrent allocation.
+
+Allocating a pool reads the lines of its scope and replaces the pool's
+rows, and computing an invoice's tariff creates or updates its "HTSUS
+Tariff" pool.  Two transactions doing either for the same pool used to
+interleave into duplicate rows.  ``lock_scopes`` takes transaction-level
+PostgreSQL advisory locks down the scope hierarchy:
+
+* a pool spanning every line locks the root exclusively;
+* a container pool locks the root shared and its container exclusively;
+* an invoice pool, and an invoice's tariff, lock the root and the
+  invoice's container shared and the invoice exclusively.
+
+Allocations over disjoint scopes therefore run in parallel, while
+overlapping ones (a container and one of its invoices, anything and an
+ALL pool, the same pool twice) wait for each other.  The keys are taken
+in ascending order, with root < containers < invoices < names, in one
+statement.  Code that both computes tariffs and allocates takes every
+key it needs up front and passes ``lock=False`` to the inner calls, so
+no transaction waits on another while holding a key it acquired out of
+order.  ``lock_all`` takes the root exclusively, for a recalculation of
+everything.
+
+``lock_names`` serializes the creation of pools looked up by name, such
+as the single "Freight Cost" pool.
+
+On SQLite every transaction starts with ``BEGIN IMMEDIATE`` (see
+``DATABASES``), so writers are serialized already and nothing is locked.
+"""
+import zlib
+
+from django.db import connection
+from django.db.transaction import TransactionManagementError
+
+from .ingestion import fetch_values_in
+from .models import CostPool, Invoice
+
+ROOT = 0
+CONTAINER = 1
+INVOICE = 2
+NAME = 3
+
+
+def lock_key(level, pk=0):
+    """The advisory lock key of the object ``pk`` at ``level`` of the scope hierarchy."""
+    return (level << 48) | int(pk)
+
+
+def lock_plan(pools=(), invoice_ids=()):
+    """``{key: shared}`` of the locks that allocating ``pools`` and computing the tariffs of ``invoice_ids`` need."""
+    plan = {}
+
+    def take(key, shared):
+        plan[key] = plan.get(key, True) and shared
+
+    pools = list(pools)
+    invoice_ids = {int(pk) for pk in invoice_ids}
+    invoice_ids.update(int(pool.invoice_id) for pool in pools
+                       if pool.scope == CostPool.Scope.INVOICE and pool.invoice_id)
+    containers = dict(fetch_values_in(Invoice.objects.values_list('pk', 'container_id'), 'pk', invoice_ids))
+    for pk in invoice_ids:
+        take(lock_key(ROOT), True)
+        if containers.get(pk) is not None:
+            take(lock_key(CONTAINER, containers[pk]), True)
+        take(lock_key(INVOICE, pk), False)
+    for pool in pools:
+        if pool.scope == CostPool.Scope.INVOICE and pool.invoice_id:
+            continue
+        if pool.scope == CostPool.Scope.CONTAINER and pool.container_id:
+            take(lock_key(ROOT), True)
+            take(lock_key(CONTAINER, pool.container_id), False)
+        else:
+            take(lock_key(ROOT), False)
+    return plan
+
+
+def _acquire(plan):
+    if not connection.in_atomic_block:
+        raise TransactionManagementError('Scope locks only last until the end of a transaction; take them inside one.')
+    if connection.vendor != 'postgresql' or not plan:
+        return
+    keys = sorted(plan)
+    with connection.cursor() as cursor:
+        # Volatile functions in the select list run after the sort, so the
+        # keys are taken in order.
+        cursor.execute(
+            'SELECT CASE WHEN lock.shared THEN pg_advisory_xact_lock_shared(lock.key)'
+            ' ELSE pg_advisory_xact_lock(lock.key) END'
+            ' FROM unnest(%s::bigint[], %s::boolean[]) AS lock(key, shared) ORDER BY lock.key',
+            [keys, [plan[key] for key in keys]],
+        )
+
+
+def lock_scopes(pools=(), invoice_ids=()):
+    """Lock the scopes of ``pools`` and the tariffs of ``invoice_ids`` until the end of the current transaction."""
+    _acquire(lock_plan(pools, invoice_ids))
+
+
+def lock_all():
+    """Lock every scope until the end of the current transaction, for code that rewrites them all."""
+    _acquire({lock_key(ROOT): False})
+
+
+def lock_names(*names):
+    """Lock the pool names ``names`` until the end of the current transaction."""
+    _acquire({lock_key(NAME, zlib.crc32(name.encode('utf-8'))): False for name in names})
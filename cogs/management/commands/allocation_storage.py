@@ -0,0 +1,61 @@
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from cogs.models import AllocatedCost, CostPool, PackedAllocation
+from cogs.money import to_fixed
+from cogs.management.commands.compact_allocations import table_bytes
+from cogs.packed import pack
+from cogs.services import ALLOCATION_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = ('Converts stored allocations between AllocatedCost rows and packed PackedAllocation rows '
+            '(see COGS_ALLOCATION_STORAGE), one cost pool per transaction.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--to', choices=['rows', 'packed'], required=True, help='Storage to convert to.')
+
+    def handle(self, *args, **options):
+        before = self._sizes()
+        if options['to'] == 'packed':
+            pool_ids = AllocatedCost.objects.values_list('cost_pool_id', flat=True).distinct()
+            convert = self._pack
+        else:
+            pool_ids = PackedAllocation.objects.values_list('cost_pool_id', flat=True)
+            convert = self._unpack
+        pool_ids = sorted(pool_ids)
+        for pool_id in pool_ids:
+            with transaction.atomic():
+                convert(CostPool.objects.select_for_update().get(pk=pool_id))
+
+        after = self._sizes()
+        self.stdout.write(self.style.SUCCESS(f'Converted {len(pool_ids):,} cost pools to {options["to"]} storage.'))
+        for model in (AllocatedCost, PackedAllocation):
+            self.stdout.write(f'{model.__name__:<18}{self._size(before[model]):>16} -> {self._size(after[model])}')
+
+    def _pack(self, pool):
+        rows = AllocatedCost.objects.filter(cost_pool=pool)
+        line_ids, amounts = zip(*rows.order_by('invoice_line_id', 'pk').values_list(
+            'invoice_line_id', 'amount_allocated'))
+        line_ids = np.array(line_ids, dtype=np.int64)
+        # Of duplicate rows left by old reallocations, the newest counts.
+        last = np.append(line_ids[1:] != line_ids[:-1], True)
+        PackedAllocation.objects.update_or_create(cost_pool=pool, defaults={
+            'line_count': int(last.sum()),
+            'data': pack(line_ids[last], to_fixed(amounts)[last]),
+        })
+        rows.delete()
+
+    def _unpack(self, pool):
+        packed = pool.packed_allocation
+        AllocatedCost.objects.filter(cost_pool=pool).delete()
+        AllocatedCost.objects.bulk_create(packed.allocated_costs(), batch_size=ALLOCATION_BATCH_SIZE)
+        packed.delete()
+
+    def _sizes(self):
+        return {model: (model.objects.count(), table_bytes(model)) for model in (AllocatedCost, PackedAllocation)}
+
+    def _size(self, size):
+        rows, size = size
+        return f'{rows:,} rows, ' + (f'{size:,} bytes' if size is not None else 'size unknown')
@@ -0,0 +1,56 @@
+import random
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cogs.allocation import allocate, reference_allocation
+from cogs.models import CostPool
+
+
+class Command(BaseCommand):
+    help = ('Times the vectorized allocation kernel against the per-line Decimal allocation '
+            'on synthetic lines and checks that both give identical amounts.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lines', type=int, default=100_000, help='Number of synthetic lines (default: 100000).')
+        parser.add_argument('--method', choices=CostPool.Method.values, action='append',
+                            help='Allocation method to time; repeat for several (default: all).')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs per method; the best is reported (default: 3).')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if options['lines'] < 1 or options['repeat'] < 1:
+            raise CommandError('--lines and --repeat must be positive.')
+        rng = random.Random(options['seed'])
+        count = options['lines']
+        quantity = [rng.randint(1, 500) for _ in range(count)]
+        price = [Decimal(rng.randint(1, 100_000)).scaleb(-2) for _ in range(count)]
+        volume = [rng.uniform(1, 5000) for _ in range(count)]
+        # AllocationService reads prices as floats for the kernel.
+        price_floats = [float(value) for value in price]
+        total = Decimal('123456.78')
+
+        self.stdout.write(f'{count:,} lines, best of {options["repeat"]}')
+        self.stdout.write(f'{"method":<16}{"per-line":>12}{"kernel":>12}{"speedup":>10}')
+        for method in options['method'] or CostPool.Method.values:
+            expected, reference_time = self._time(
+                lambda: reference_allocation(total, method, quantity, price, volume), options['repeat'])
+            actual, kernel_time = self._time(
+                lambda: allocate(total, method, quantity, price_floats, volume).amounts(), options['repeat'])
+            if actual != expected:
+                raise CommandError(f'{method}: kernel amounts differ from the per-line allocation.')
+            self.stdout.write(
+                f'{method:<16}{reference_time * 1000:>10.1f}ms{kernel_time * 1000:>10.1f}ms'
+                f'{reference_time / kernel_time:>9.1f}x'
+            )
+        self.stdout.write(self.style.SUCCESS('All methods produced identical amounts.'))
+
+    def _time(self, func, repeat):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return result, best
@@ -0,0 +1,69 @@
+import datetime
+import random
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from cogs.models import HTSRateDetail, HTSUSCode
+from cogs.rates import RateIndex, rate_detail_from_db
+
+COUNTRIES = ['', 'CN', 'VN', 'MX', 'IN', 'DE']
+
+
+class Command(BaseCommand):
+    help = ('Times "rate in force on date D" lookups in the HTSRateDetail interval index against the '
+            'database query, on synthetic rate details that are rolled back afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--codes', type=int, default=200, help='Complex-rate HTS codes (default: 200).')
+        parser.add_argument('--periods', type=int, default=10,
+                            help='Consecutive rate periods per code and country (default: 10).')
+        parser.add_argument('--lookups', type=int, default=2000, help='Lookups timed per path (default: 2000).')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if min(options['codes'], options['periods'], options['lookups']) < 1:
+            raise CommandError('--codes, --periods and --lookups must be positive.')
+        rng = random.Random(options['seed'])
+        with transaction.atomic():
+            codes = HTSUSCode.objects.bulk_create(
+                HTSUSCode(code=f'BENCH.{n:05d}', description='benchmark', has_complex_rates=True)
+                for n in range(options['codes'])
+            )
+            details = []
+            for code in codes:
+                for country in COUNTRIES:
+                    start = datetime.date(2015, 1, 1)
+                    for _ in range(options['periods']):
+                        end = start + datetime.timedelta(days=rng.randint(30, 365))
+                        details.append(HTSRateDetail(hts_code=code, country_code=country, effective_from=start,
+                                                     effective_to=end, adval_pct=Decimal(rng.randint(0, 40))))
+                        start = end + datetime.timedelta(days=1)
+            HTSRateDetail.objects.bulk_create(details, batch_size=1000)
+            keys = [
+                (rng.choice(codes).pk, rng.choice(COUNTRIES),
+                 datetime.date(2015, 1, 1) + datetime.timedelta(days=rng.randint(0, 365 * options['periods'])))
+                for _ in range(options['lookups'])
+            ]
+
+            start = time.perf_counter()
+            index = RateIndex(HTSRateDetail.objects.filter(hts_code__in=codes).iterator())
+            build_time = time.perf_counter() - start
+            expected, query_time = self._time(lambda: [rate_detail_from_db(*key) for key in keys])
+            actual, index_time = self._time(lambda: [index.lookup(*key) for key in keys])
+            transaction.set_rollback(True)
+
+        if actual != expected:
+            raise CommandError('Index lookups differ from the database query.')
+        self.stdout.write(f'{len(details):,} rate details, {len(keys):,} lookups; index built in {build_time:.2f}s')
+        self.stdout.write(f'{"database":<10}{len(keys) / query_time:>14,.0f} lookups/s')
+        self.stdout.write(f'{"index":<10}{len(keys) / index_time:>14,.0f} lookups/s'
+                          f'  ({query_time / index_time:,.0f}x)')
+        self.stdout.write(self.style.SUCCESS('Both paths found the same rates.'))
+
+    def _time(self, func):
+        start = time.perf_counter()
+        result = func()
+        return result, time.perf_counter() - start
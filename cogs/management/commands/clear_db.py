@@ -16,12 +16,15 @@ class Command(BaseCommand):
 
         models_to_clear = [
             'AllocatedCost',
+            'PackedAllocation',
             'CostPool',
             'InvoiceLine',
             'Invoice',
             'Container',
             'SKU',
             'HTSUSCode',
+            'RecalcMark',
+            'UploadRecord',
         ]
 
         for model_name in models_to_clear:
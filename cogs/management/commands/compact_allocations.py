@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from cogs.models import AllocatedCost
+from cogs.services import superseded_allocations
+
+
+def table_bytes(model):
+    """On-disk size of ``model``'s table and its indexes, or ``None`` if the backend can't tell."""
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT pg_total_relation_size(%s)', [table])
+        elif connection.vendor == 'sqlite':
+            try:
+                cursor.execute(
+                    'SELECT SUM(pgsize) FROM dbstat WHERE name IN '
+                    '(SELECT name FROM sqlite_master WHERE tbl_name = %s)', [table])
+            except Exception:
+                # SQLite built without the dbstat virtual table.
+                return None
+        else:
+            return None
+        return cursor.fetchone()[0]
+
+
+class Command(BaseCommand):
+    help = ('Deletes the duplicate AllocatedCost rows earlier reallocations left behind, '
+            'keeping the newest row per cost pool and invoice line.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report what would be deleted.')
+
+    def handle(self, *args, **options):
+        total = AllocatedCost.objects.count()
+        size = table_bytes(AllocatedCost)
+        with transaction.atomic():
+            duplicates = superseded_allocations()
+            deleted = duplicates.count() if options['dry_run'] else duplicates.delete()[0]
+
+        # Freed pages are reused by later inserts; the file itself only
+        # shrinks after VACUUM, so the reclaimed size is the table's share.
+        reclaimed = f'~{size * deleted // total:,} of {size:,} bytes' if size and total else 'size unknown'
+        prefix = 'Dry run, nothing deleted. Would have removed' if options['dry_run'] else 'Removed'
+        self.stdout.write(self.style.SUCCESS(
+            f'{prefix} {deleted:,} of {total:,} allocated cost rows ({reclaimed}).'
+        ))
@@ -1,75 +1,142 @@
+import contextlib
 import csv
-from decimal import Decimal
+import multiprocessing
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from tqdm import tqdm
+
+from cogs.hsus_import import parse_shard
+from cogs.ingestion import fetch_values_in
 from cogs.models import HTSUSCode, SKU
+from cogs.readers import iter_batches
+from cogs.upsert import UpsertResult, bulk_upsert, upsert_htsus_codes
+
+MAX_LISTED_PROBLEMS = 20
+
+
+def count_lines(path):
+    with open(path, 'rb') as file:
+        return sum(chunk.count(b'\n') for chunk in iter(lambda: file.read(1 << 20), b''))
+
 
 class Command(BaseCommand):
     help = 'Imports HTSUSCode and SKU data from a CSV file.'
 
     def add_arguments(self, parser):
         parser.add_argument('csv_file', type=str, help='The path to the CSV file to import.')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Rows parsed, validated and written per batch (default: 5000).')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Processes used to parse and validate batches (default: 1, no pool).')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report what would change and roll everything back.')
 
     def handle(self, *args, **options):
         csv_file_path = options['csv_file']
+        batch_size = options['batch_size']
+        if batch_size < 1 or options['workers'] < 1:
+            raise CommandError('--batch-size and --workers must be positive.')
 
-        try:
-            with open(csv_file_path, 'r', encoding='utf-8') as file:
-                reader = csv.DictReader(file)
-                for row in reader:
-                    htsus_code_str = row.get('HTSUS_Code')
-                    htsus_description = row.get('HTSUS_Description', '')
-                    htsus_rate_pct_str = row.get('HTSUS_Rate_Pct')
-                    sku_str = row.get('SKU')
-                    sku_name = row.get('SKU_Name', '')
-                    sku_htsus_rate_pct_str = row.get('SKU_HTSUS_Rate_Pct')
-
-                    if not htsus_code_str or not htsus_rate_pct_str or not sku_str:
-                        self.stdout.write(self.style.WARNING(f"Skipping row due to missing required data: {row}"))
-                        continue
-
-                    try:
-                        htsus_rate_pct = Decimal(htsus_rate_pct_str)
-                    except Exception:
-                        self.stdout.write(self.style.ERROR(f"Invalid HTSUS_Rate_Pct for HTSUS_Code {htsus_code_str}: {htsus_rate_pct_str}"))
-                        continue
-
-                    htsus_obj, created = HTSUSCode.objects.update_or_create(
-                        code=htsus_code_str,
-                        defaults={
-                            'description': htsus_description,
-                            'rate_pct': htsus_rate_pct
-                        }
-                    )
-                    if created:
-                        self.stdout.write(self.style.SUCCESS(f"Created HTSUSCode: {htsus_obj.code}"))
-                    else:
-                        self.stdout.write(self.style.SUCCESS(f"Updated HTSUSCode: {htsus_obj.code}"))
-
-                    sku_defaults = {
-                        'name': sku_name,
-                        'htsus_code': htsus_obj
-                    }
-                    if sku_htsus_rate_pct_str:
-                        try:
-                            sku_defaults['htsus_rate_pct'] = Decimal(sku_htsus_rate_pct_str)
-                        except Exception:
-                            self.stdout.write(self.style.ERROR(f"Invalid SKU_HTSUS_Rate_Pct for SKU {sku_str}: {sku_htsus_rate_pct_str}"))
-                            continue
-                    else:
-                        sku_defaults['htsus_rate_pct'] = None # Ensure it's set to None if not provided
-
-                    sku_obj, created = SKU.objects.update_or_create(
-                        sku=sku_str,
-                        defaults=sku_defaults
-                    )
-                    if created:
-                        self.stdout.write(self.style.SUCCESS(f"Created SKU: {sku_obj.sku}"))
-                    else:
-                        self.stdout.write(self.style.SUCCESS(f"Updated SKU: {sku_obj.sku}"))
+        self.hts = UpsertResult()
+        self.skus = UpsertResult()
+        self.problems = []
+        self._hts_written = {}
+        # Keys already counted, so codes and SKUs repeated across shards are reported once.
+        self._hts_seen = set()
+        self._skus_seen = set()
+        self._hts_ids = {}
+        rows = 0
+        start = time.perf_counter()
 
+        try:
+            total = max(count_lines(csv_file_path) - 1, 0)
+            with open(csv_file_path, 'r', encoding='utf-8-sig', newline='') as file, \
+                    tqdm(total=total, unit='rows', file=sys.stderr, disable=options['verbosity'] < 1) as progress, \
+                    (transaction.atomic() if options['dry_run'] else contextlib.nullcontext()):
+                reader = csv.reader(file)
+                header = next(reader, None)
+                if header is None:
+                    raise CommandError(f'File "{csv_file_path}" is empty.')
+                for shard in self._parse(header, iter_batches(reader, batch_size), options['workers']):
+                    self._apply(shard, batch_size)
+                    rows += shard.rows
+                    progress.update(shard.rows)
+                if options['dry_run']:
+                    transaction.set_rollback(True)
         except FileNotFoundError:
             raise CommandError(f'File "{csv_file_path}" does not exist.')
+        except CommandError:
+            raise
         except Exception as e:
             raise CommandError(f'Error importing data: {e}')
 
-        self.stdout.write(self.style.SUCCESS('Successfully imported HTSUSCode and SKU data.'))
\ No newline at end of file
+        elapsed = time.perf_counter() - start
+        self._report(rows, elapsed, options)
+
+    def _parse(self, header, shards, workers):
+        """Yield ``ParsedShard`` results in file order, parsing up to ``workers`` shards at once."""
+        if workers == 1:
+            for records in shards:
+                yield parse_shard(header, records)
+            return
+
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            pending = deque()
+            for records in shards:
+                pending.append(pool.submit(parse_shard, header, records))
+                # Bound the shards held in memory while keeping every worker busy.
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def _apply(self, shard, batch_size):
+        self.problems.extend(shard.problems)
+        with transaction.atomic():
+            # Codes shared by many SKUs are only written when their values change.
+            latest = {row['code']: row for row in shard.hts_rows}
+            hts_rows = [
+                row for code, row in latest.items()
+                if self._hts_written.get(code) != (row['description'], row['rate_pct'])
+            ]
+            self.hts += upsert_htsus_codes(hts_rows, batch_size, self._hts_seen)
+            self._hts_written.update((row['code'], (row['description'], row['rate_pct'])) for row in hts_rows)
+
+            missing = {row['htsus_code'] for row in shard.sku_rows} - self._hts_ids.keys()
+            self._hts_ids.update(fetch_values_in(HTSUSCode.objects.values_list('code', 'id'), 'code', missing))
+            sku_rows = [
+                {
+                    'sku': row['sku'],
+                    'name': row['name'],
+                    'htsus_code_id': self._hts_ids[row['htsus_code']],
+                    'htsus_rate_pct': row['htsus_rate_pct'],
+                }
+                for row in shard.sku_rows
+            ]
+            self.skus += bulk_upsert(
+                SKU, sku_rows, 'sku', ['name', 'htsus_code_id', 'htsus_rate_pct'], batch_size, self._skus_seen,
+            )
+
+    def _report(self, rows, elapsed, options):
+        listed = self.problems if options['verbosity'] > 1 else self.problems[:MAX_LISTED_PROBLEMS]
+        for problem in listed:
+            self.stdout.write(self.style.WARNING(problem))
+        if len(listed) < len(self.problems):
+            self.stdout.write(self.style.WARNING(
+                f'... and {len(self.problems) - len(listed)} more skipped rows (use -v 2 to list all).'
+            ))
+
+        rate = rows / elapsed if elapsed else 0
+        prefix = 'Dry run, nothing saved. Would have imported' if options['dry_run'] else 'Imported'
+        self.stdout.write(self.style.SUCCESS(
+            f'{prefix} {rows} rows in {elapsed:.1f}s ({rate:,.0f} rows/sec).\n'
+            f'HTSUSCode: {self.hts.created} created, {self.hts.updated} updated, {self.hts.unchanged} unchanged.\n'
+            f'SKU: {self.skus.created} created, {self.skus.updated} updated, {self.skus.unchanged} unchanged.\n'
+            f'Skipped rows: {len(self.problems)}.'
+        ))
@@ -0,0 +1,131 @@
+import multiprocessing
+import queue
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections
+
+from cogs import jobs, worker
+
+HEARTBEAT_SECONDS = 15
+STALE_CHECK_SECONDS = 60
+
+
+class Command(BaseCommand):
+    help = 'Runs queued background jobs (uploads, recalculations) in a pool of worker processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of worker processes (default: settings.COGS_JOB_WORKERS).')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait between queue polls when idle.')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the queue is empty instead of polling forever.')
+
+    def handle(self, *args, **options):
+        workers = options['workers'] or settings.COGS_JOB_WORKERS
+        poll_interval = options['poll_interval']
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        # Jobs left RUNNING by a crashed worker become claimable again.
+        jobs.requeue_stale_jobs()
+
+        context = multiprocessing.get_context('spawn')
+        self.progress_queue = context.Queue()
+        name = jobs.worker_name()
+        self.stdout.write(self.style.SUCCESS(f'Starting {workers} job workers as {name}'))
+
+        in_flight = {}
+        pool = self._make_pool(context, workers)
+        last_heartbeat = last_stale_check = time.monotonic()
+        try:
+            while not (self.stopping and not in_flight):
+                while not self.stopping and len(in_flight) < workers:
+                    try:
+                        job = jobs.claim_next_job(worker=name)
+                    except OperationalError as e:
+                        self.stderr.write(f'Could not claim a job: {e}')
+                        job = None
+                    if job is None:
+                        break
+                    self.stdout.write(f'Running job #{job.pk} ({job.kind})')
+                    in_flight[pool.submit(worker.run_job, job.pk)] = job.pk
+
+                if not in_flight:
+                    if options['once']:
+                        break
+                    time.sleep(poll_interval)
+                else:
+                    done, _ = wait(in_flight, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        job_id = in_flight.pop(future)
+                        try:
+                            status = future.result()
+                            self.stdout.write(f'Job #{job_id} {status.lower()}')
+                        except BrokenProcessPool:
+                            # A worker died (e.g. killed for memory); every job it
+                            # shared the pool with is released and the pool rebuilt.
+                            lost = [job_id] + list(in_flight.values())
+                            in_flight.clear()
+                            jobs.release_jobs(lost, 'Worker process died')
+                            self.stderr.write(self.style.ERROR(f'Worker pool broke; released jobs {lost}'))
+                            pool.shutdown(wait=False, cancel_futures=True)
+                            pool = self._make_pool(context, workers)
+                            break
+                        except Exception as e:
+                            jobs.release_jobs([job_id], str(e))
+                            self.stderr.write(self.style.ERROR(f'Job #{job_id} errored: {e}'))
+
+                self._drain_progress()
+                now = time.monotonic()
+                if in_flight and now - last_heartbeat >= HEARTBEAT_SECONDS:
+                    self._db_write(jobs.heartbeat, list(in_flight.values()))
+                    last_heartbeat = now
+                if now - last_stale_check >= STALE_CHECK_SECONDS:
+                    self._db_write(jobs.requeue_stale_jobs)
+                    last_stale_check = now
+        finally:
+            pool.shutdown(wait=True)
+            self._drain_progress()
+
+        self.stdout.write(self.style.SUCCESS('Job workers stopped.'))
+
+    def _make_pool(self, context, workers):
+        # Children open their own database connections.
+        connections.close_all()
+        return ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=context,
+            initializer=worker.init_worker,
+            initargs=(self.progress_queue,),
+        )
+
+    def _drain_progress(self):
+        latest = {}
+        while True:
+            try:
+                job_id, done, total, message = self.progress_queue.get_nowait()
+            except queue.Empty:
+                break
+            latest[job_id] = (done, total, message)
+        for job_id, (done, total, message) in latest.items():
+            self._db_write(jobs.save_progress, job_id, done, total, message)
+
+    def _db_write(self, func, *args):
+        # On SQLite a worker holding the write lock can make bookkeeping
+        # writes time out; they are retried on the next tick.
+        try:
+            func(*args)
+        except OperationalError as e:
+            self.stderr.write(f'Skipped bookkeeping write: {e}')
+
+    def _stop(self, signum, frame):
+        if not self.stopping:
+            self.stdout.write('Stopping after running jobs finish...')
+        self.stopping = True
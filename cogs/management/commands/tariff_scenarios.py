@@ -0,0 +1,42 @@
+import csv
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cogs.scenarios import DIMENSIONS, ScenarioLines, read_scenarios
+
+
+class Command(BaseCommand):
+    help = ('Landed cost impact of tariff rate scenarios by container, invoice and SKU, as CSV. '
+            'The scenario file has the columns scenario, kind (section_301 or hts), code and rate (percent).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', help='CSV file of scenario rate changes.')
+        parser.add_argument('--output', help='Write the impact cube here instead of to stdout.')
+        parser.add_argument('--dimension', action='append', choices=DIMENSIONS,
+                            help='Sum by this dimension; repeat for several (default: all).')
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['scenarios'], newline='', encoding='utf-8-sig') as file:
+                scenarios = read_scenarios(csv.DictReader(file))
+        except (OSError, ValueError) as exc:
+            raise CommandError(f'{options["scenarios"]}: {exc}')
+        if not scenarios:
+            raise CommandError(f'{options["scenarios"]}: no scenarios.')
+
+        start = time.perf_counter()
+        lines = ScenarioLines()
+        loaded = time.perf_counter()
+        cube = lines.sweep(scenarios, options['dimension'] or DIMENSIONS)
+        swept = time.perf_counter()
+        if options['output']:
+            with open(options['output'], 'w', newline='', encoding='utf-8') as file:
+                cube.write_csv(file)
+        else:
+            cube.write_csv(self.stdout)
+        # The cube may be going to stdout, so the timings go to stderr.
+        self.stderr.write(self.style.SUCCESS(
+            f'{len(scenarios)} scenarios x {len(lines.ids):,} lines: loaded in {loaded - start:.2f}s, '
+            f'swept in {swept - loaded:.2f}s.'
+        ))
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.5 on 2026-10-17 22:01
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cogs', '0011_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=50)),
+                ('sha256', models.CharField(max_length=64)),
+                ('file_name', models.CharField(max_length=255)),
+                ('result', models.JSONField(blank=True, default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='invoiceline',
+            name='row_hash',
+            field=models.CharField(blank=True, default='', help_text='Fingerprint of the source CSV row, see cogs.uploads.line_hash', max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name='invoiceline',
+            index=models.Index(fields=['invoice', 'row_hash'], name='cogs_invoic_invoice_f55c68_idx'),
+        ),
+        migrations.AddField(
+            model_name='uploadrecord',
+            name='job',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='cogs.job'),
+        ),
+        migrations.AddConstraint(
+            model_name='uploadrecord',
+            constraint=models.UniqueConstraint(fields=('kind', 'sha256'), name='unique_upload_fingerprint'),
+        ),
+    ]
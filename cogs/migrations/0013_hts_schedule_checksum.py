@@ -0,0 +1,42 @@
+# Generated by Django 5.2.5 on 2026-10-17 22:12
+
+import hashlib
+from decimal import Decimal
+
+from django.db import migrations, models
+
+
+def schedule_checksum(description, rate_pct):
+    # Frozen copy of cogs.models.schedule_checksum as of this migration.
+    rate = '' if rate_pct is None else Decimal(rate_pct).quantize(Decimal('0.0001'))
+    content = f"{description or ''}\x1f{rate}"
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def fill_checksums(apps, schema_editor):
+    HTSUSCode = apps.get_model('cogs', 'HTSUSCode')
+    codes = list(HTSUSCode.objects.only('id', 'description', 'rate_pct'))
+    for code in codes:
+        code.checksum = schedule_checksum(code.description, code.rate_pct)
+    HTSUSCode.objects.bulk_update(codes, ['checksum'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cogs', '0012_upload_registry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='htsuscode',
+            name='checksum',
+            field=models.CharField(blank=True, default='', help_text='Fingerprint of description and rate from the last schedule import', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='htsuscode',
+            name='retired_at',
+            field=models.DateTimeField(blank=True, help_text='Set when a full schedule import no longer lists this code', null=True),
+        ),
+        migrations.RunPython(fill_checksums, migrations.RunPython.noop),
+    ]
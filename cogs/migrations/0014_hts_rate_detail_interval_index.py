@@ -0,0 +1,22 @@
+# Generated by Django 5.2.5 on 2026-10-17 22:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cogs', '0013_hts_schedule_checksum'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='htsratedetail',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AddIndex(
+            model_name='htsratedetail',
+            index=models.Index(fields=['hts_code', 'country_code', 'effective_from'], name='cogs_rate_in_force_idx'),
+        ),
+    ]
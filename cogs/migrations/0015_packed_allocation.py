@@ -0,0 +1,23 @@
+# Generated by Django 5.2.5 on 2026-10-17 22:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cogs', '0014_hts_rate_detail_interval_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PackedAllocation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('line_count', models.IntegerField()),
+                ('data', models.BinaryField(help_text='Compressed line ids and amounts in cents, see cogs.packed.pack')),
+                ('cost_pool', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='packed_allocation', to='cogs.costpool')),
+            ],
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.5 on 2026-10-17 23:09
+
+from django.db import migrations, models
+
+
+def mark_everything(apps, schema_editor):
+    # Nothing tracked changes before; the first incremental run does it all.
+    CostPool = apps.get_model('cogs', 'CostPool')
+    Invoice = apps.get_model('cogs', 'Invoice')
+    RecalcMark = apps.get_model('cogs', 'RecalcMark')
+    marks = [RecalcMark(kind='POOL', key=pk) for pk in CostPool.objects.filter(auto_compute=False).values_list('pk', flat=True)]
+    marks += [RecalcMark(kind='TARIFF', key=pk) for pk in Invoice.objects.values_list('pk', flat=True)]
+    RecalcMark.objects.bulk_create(marks, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cogs', '0015_packed_allocation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecalcMark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('POOL', 'Cost pool'), ('TARIFF', 'Invoice tariff'), ('LINES', 'Invoice lines'), ('CONTAINER', 'Container')], max_length=10)),
+                ('key', models.BigIntegerField(help_text='Id of the cost pool, invoice or container')),
+                ('marked_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('kind', 'key'), name='unique_recalc_mark')],
+            },
+        ),
+        migrations.RunPython(mark_everything, migrations.RunPython.noop),
+    ]
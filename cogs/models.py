@@ -1,6 +1,7 @@
 from django.db import models
 from django.contrib.auth.models import User
 from decimal import Decimal
+import hashlib
 import json
 
 # --- LEGACY HTSUS MODEL - COMMENTED FOR MIGRATION ---
@@ -11,6 +12,16 @@ import json
 #     def __str__(self):
 #         return self.code
 
+HTS_RATE_QUANTUM = Decimal('0.0001')  # HTSUSCode.rate_pct has 4 decimal places
+
+
+def schedule_checksum(description, rate_pct):
+    """Fingerprint of the schedule content of one HTS code (see cogs.hts_delta)."""
+    rate = '' if rate_pct is None else Decimal(rate_pct).quantize(HTS_RATE_QUANTUM)
+    content = f"{description or ''}\x1f{rate}"
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
 # --- NEW UNIFIED HTS MODEL ---
 class HTSUSCode(models.Model):
     # Core fields
@@ -33,6 +44,10 @@ class HTSUSCode(models.Model):
         help_text="If True, check HTSRateDetail for country/program specific rates"
     )
 
+    # Schedule revisions (see cogs.hts_delta)
+    checksum = models.CharField(max_length=64, blank=True, default='', help_text="Fingerprint of description and rate from the last schedule import")
+    retired_at = models.DateTimeField(null=True, blank=True, help_text="Set when a full schedule import no longer lists this code")
+
     def get_rate_for_country(self, country_code=None, program_code=None, date=None):
         """Get applicable rate considering country and trade program"""
         if not self.has_complex_rates:
@@ -42,6 +57,12 @@ class HTSUSCode(models.Model):
         # For now, return simple rate as fallback
         return self.rate_pct or Decimal(0)
 
+    def save(self, *args, **kwargs):
+        self.checksum = schedule_checksum(self.description, self.rate_pct)
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'checksum'}
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return f"{self.code} - {self.description[:50]}"
 
@@ -74,9 +95,14 @@ class HTSRateDetail(models.Model):
     # Validity period
     effective_from = models.DateField()
     effective_to = models.DateField(null=True, blank=True)
+    # Lets other processes notice changes to their cogs.rates.RateIndex
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     class Meta:
         ordering = ['country_code', 'trade_program', '-effective_from']
+        indexes = [
+            models.Index(fields=['hts_code', 'country_code', 'effective_from'], name='cogs_rate_in_force_idx'),
+        ]
 
     def __str__(self):
         return f"{self.hts_code.code} - {self.country_code or 'ALL'} - {self.rate_type}"
@@ -166,6 +192,12 @@ class InvoiceLine(models.Model):
     price_vendor = models.DecimalField(max_digits=10, decimal_places=2, help_text="Price per unit")
     total_vendor = models.DecimalField(max_digits=10, decimal_places=2, help_text="Denormalized from CSV for validation")
     unit_volume_cc = models.FloatField(help_text="Volume per unit in cubic centimeters")
+    row_hash = models.CharField(max_length=64, blank=True, default='', help_text="Fingerprint of the source CSV row, see cogs.uploads.line_hash")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['invoice', 'row_hash']),
+        ]
 
     def __str__(self):
         return f"{self.invoice.invoice_number} - {self.sku.sku}"
@@ -205,6 +237,48 @@ class AllocatedCost(models.Model):
         return f"{self.cost_pool.name} - {self.invoice_line}"
 
 
+class PackedAllocation(models.Model):
+    """A cost pool's whole allocation in one row (``COGS_ALLOCATION_STORAGE = 'packed'``), see ``cogs.packed``."""
+    cost_pool = models.OneToOneField(CostPool, on_delete=models.CASCADE, related_name='packed_allocation')
+    line_count = models.IntegerField()
+    data = models.BinaryField(help_text="Compressed line ids and amounts in cents, see cogs.packed.pack")
+
+    def __str__(self):
+        return f"{self.cost_pool.name} - {self.line_count} lines"
+
+    def allocated_costs(self):
+        """The allocation as unsaved ``AllocatedCost`` rows, for code that expects them."""
+        from .money import to_decimals
+        from .packed import unpack
+        line_ids, cents = unpack(self.data)
+        return [
+            AllocatedCost(cost_pool_id=self.cost_pool_id, invoice_line_id=line_id, amount_allocated=amount)
+            for line_id, amount in zip(line_ids.tolist(), to_decimals(cents))
+        ]
+
+
+class RecalcMark(models.Model):
+    """A change the stored allocations do not reflect yet (see cogs.dirty)."""
+
+    class Kind(models.TextChoices):
+        POOL = 'POOL', 'Cost pool'
+        TARIFF = 'TARIFF', 'Invoice tariff'
+        LINES = 'LINES', 'Invoice lines'
+        CONTAINER = 'CONTAINER', 'Container'
+
+    kind = models.CharField(max_length=10, choices=Kind.choices)
+    key = models.BigIntegerField(help_text="Id of the cost pool, invoice or container")
+    marked_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'key'], name='unique_recalc_mark'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.key}"
+
+
 # ============= DATA PERSISTENCE MODELS =============
 class CalculationHistory(models.Model):
     """Store history of all COGS calculations"""
@@ -314,3 +388,76 @@ class SavedResults(models.Model):
     
     def __str__(self):
         return f"{self.batch_name} - {self.sku}"
+
+
+# ============= BACKGROUND JOBS =============
+class Job(models.Model):
+    """A unit of background work run by ``manage.py run_workers`` (see cogs.jobs)."""
+
+    class Status(models.TextChoices):
+        QUEUED = 'QUEUED', 'Queued'
+        RUNNING = 'RUNNING', 'Running'
+        SUCCEEDED = 'SUCCEEDED', 'Succeeded'
+        FAILED = 'FAILED', 'Failed'
+
+    kind = models.CharField(max_length=50)
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.QUEUED)
+    payload = models.JSONField(default=dict, blank=True)
+    result = models.JSONField(default=dict, blank=True)
+    error = models.TextField(blank=True)
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+
+    # Progress, reported by the handler while it runs
+    progress_done = models.PositiveBigIntegerField(default=0)
+    progress_total = models.PositiveBigIntegerField(null=True, blank=True)
+    progress_message = models.CharField(max_length=255, blank=True)
+
+    # Crash recovery: a RUNNING job whose heartbeat goes stale is requeued
+    attempts = models.PositiveIntegerField(default=0)
+    worker = models.CharField(max_length=100, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Debounced jobs (see cogs.scheduler) are not claimed before this time
+    run_after = models.DateTimeField(null=True, blank=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+        ]
+
+    @property
+    def is_finished(self):
+        return self.status in (self.Status.SUCCEEDED, self.Status.FAILED)
+
+    @property
+    def percent(self):
+        if self.status == self.Status.SUCCEEDED:
+            return 100
+        if not self.progress_total:
+            return None
+        return min(100, int(100 * self.progress_done / self.progress_total))
+
+    def __str__(self):
+        return f"Job #{self.pk} {self.kind} ({self.status})"
+
+
+class UploadRecord(models.Model):
+    """Registry of processed upload files, keyed by a fingerprint of their content (see cogs.uploads)."""
+    kind = models.CharField(max_length=50)
+    sha256 = models.CharField(max_length=64)
+    file_name = models.CharField(max_length=255)
+    job = models.ForeignKey(Job, on_delete=models.SET_NULL, null=True, blank=True)
+    result = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'sha256'], name='unique_upload_fingerprint'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind}: {self.file_name} ({self.sha256[:12]})"
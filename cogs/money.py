@@ -0,0 +1,66 @@
+"""Fixed-point money and rate arithmetic on integer arrays.
+
+Amounts are held as integer multiples of ``10 ** -places`` dollars (cents
+for ``places=2``) and percent rates as multiples of ``10 ** -RATE_PLACES``
+percent, in int64 numpy arrays.  Every operation the landed cost needs
+(sums, products of an amount and a rate, rounding a quotient to the cent)
+is then exact integer arithmetic, so the results equal the ``Decimal``
+computation they replace rather than approximate it; ``Decimal`` values
+are only built from the final integers, at the ORM and template boundary.
+
+Arrays that could overflow int64 fall back to Python integers (``object``
+arrays), as in ``cogs.allocation``.
+"""
+from decimal import Decimal
+
+import numpy as np
+
+from .allocation import INT64_SAFE
+
+CENT_PLACES = 2
+# HTSUSCode.rate_pct and SKU.htsus_rate_pct have four decimal places.
+RATE_PLACES = 4
+
+
+def to_fixed(values, places=CENT_PLACES):
+    """``values`` (``Decimal``, float or ``None`` for zero) as integers in units of ``10 ** -places``.
+
+    Meant for ``DecimalField`` columns, which have at most ``places``
+    decimals: float64 represents them to well under half a unit, so
+    rounding gives the exact integer.  Use ``to_units`` for values that
+    may carry more decimals.
+    """
+    scaled = np.array([0.0 if value is None else float(value) for value in values], dtype=np.float64)
+    return np.rint(scaled * 10 ** places).astype(np.int64)
+
+
+def to_units(value, places=RATE_PLACES):
+    """One ``Decimal`` (or ``None`` for zero) as an integer in units of ``10 ** -places``.
+
+    Raises ``ValueError`` if ``value`` has more than ``places`` decimals.
+    """
+    scaled = Decimal(value or 0).scaleb(places)
+    if scaled != scaled.to_integral_value():
+        raise ValueError(f'{value} has more than {places} decimal places.')
+    return int(scaled)
+
+
+def multiply(a, b):
+    """Elementwise ``a * b``, in Python integers where int64 could overflow."""
+    if len(a) and float(np.abs(a).max()) * float(np.abs(b).max()) >= INT64_SAFE:
+        return a.astype(object) * b.astype(object)
+    return a * b
+
+
+def round_divide(numerator, denominator):
+    """``numerator / denominator`` rounded half-even to an integer; denominators must be positive."""
+    quotient, remainder = numerator // denominator, numerator % denominator
+    twice = 2 * remainder
+    round_up = (twice > denominator) | ((twice == denominator) & (quotient % 2 == 1))
+    return quotient + round_up.astype(np.int64)
+
+
+def to_decimals(units, places=CENT_PLACES):
+    """Integers in units of ``10 ** -places`` as ``Decimal`` values."""
+    # Multiplying by the unit is exact here and cheaper than scaleb().
+    return list(map(Decimal(1).scaleb(-places).__rmul__, units.tolist()))
@@ -0,0 +1,103 @@
+"""Packed allocation storage: one row per cost pool instead of one per line.
+
+With ``COGS_ALLOCATION_STORAGE = 'packed'`` ``AllocationService`` stores
+each pool's allocation as a ``PackedAllocation``: the line ids (ascending,
+delta-encoded) and the amounts in cents, as little-endian int64 arrays
+compressed with zlib.  Consecutive ids delta-encode to runs of ones, so a
+pool costs a few bytes per line instead of an ``AllocatedCost`` row and
+its index entries.
+
+``read_allocations`` and ``allocation_rows`` read both storages, so the
+results page, ``what_if`` and the scenario sweeps work with either (and
+with a mix, while switching).  ``PackedAllocation.allocated_costs`` gives
+a packed pool as unsaved ``AllocatedCost`` rows, and ``manage.py
+allocation_storage`` converts stored allocations between the two.
+
+Packed arrays are not updated when lines are deleted; readers only ever
+look up the lines they are asked for, and ids are not reused.
+"""
+import zlib
+from decimal import Decimal
+
+import numpy as np
+from django.db.backends.utils import format_number
+
+from .allocation import CENT
+from .ingestion import LOOKUP_CHUNK_SIZE
+from .models import AllocatedCost, PackedAllocation
+from .money import to_decimals, to_fixed
+
+FORMAT_VERSION = 1
+_amount_field = AllocatedCost._meta.get_field('amount_allocated')
+
+
+def pack(line_ids, cents):
+    """``bytes`` holding ``line_ids`` (ascending) and their ``cents``."""
+    line_ids = np.asarray(line_ids, dtype=np.int64)
+    deltas = np.diff(line_ids, prepend=np.int64(0))
+    payload = np.concatenate([deltas, np.asarray(cents, dtype=np.int64)]).astype('<i8').tobytes()
+    return bytes([FORMAT_VERSION]) + zlib.compress(payload)
+
+
+def unpack(data):
+    """``(line_ids, cents)`` int64 arrays from ``pack`` output."""
+    data = bytes(data)
+    if data[0] != FORMAT_VERSION:
+        raise ValueError(f'Unknown packed allocation format {data[0]}.')
+    values = np.frombuffer(zlib.decompress(data[1:]), dtype='<i8').astype(np.int64)
+    deltas, cents = np.split(values, 2)
+    return np.cumsum(deltas), cents
+
+
+def stored_cents(amount):
+    """Cents of ``amount`` as ``AllocatedCost.amount_allocated`` would store it."""
+    value = format_number(amount, _amount_field.max_digits, _amount_field.decimal_places)
+    return int(Decimal(value).scaleb(2))
+
+
+def allocation_cents(allocation):
+    """The amounts of a ``cogs.allocation.Allocation`` in cents, rounded as the rows would be stored."""
+    if allocation.cents is None:
+        return np.full(allocation.count, stored_cents(allocation.equal_share), dtype=np.int64)
+    cents = allocation.cents.astype(np.int64)
+    if allocation.fix_index is not None:
+        cents[allocation.fix_index] = stored_cents(int(cents[allocation.fix_index]) * CENT + allocation.fix_amount)
+    return cents
+
+
+def _line_ids(lines):
+    return np.array(lines.order_by('pk').values_list('pk', flat=True), dtype=np.int64)
+
+
+def read_allocations(lines, exclude_pools=()):
+    """Stored allocations of the lines of the queryset ``lines`` as ``(line_ids, pool_ids, cents)`` arrays.
+
+    ``AllocatedCost`` rows come first, in pk order, then packed pools in
+    pool pk order, each in line id order.  Pools in ``exclude_pools`` (ids)
+    are left out.
+    """
+    rows = AllocatedCost.objects.filter(invoice_line__in=lines.values('pk'))
+    packed = PackedAllocation.objects.all()
+    if exclude_pools:
+        rows = rows.exclude(cost_pool_id__in=exclude_pools)
+        packed = packed.exclude(cost_pool_id__in=exclude_pools)
+    line_ids, pool_ids, amounts = list(zip(*rows.order_by('pk').values_list(
+        'invoice_line_id', 'cost_pool_id', 'amount_allocated'))) or [(), (), ()]
+    parts = [(np.array(line_ids, dtype=np.int64), np.array(pool_ids, dtype=np.int64), to_fixed(amounts))]
+
+    wanted = None
+    for pool_id, data in packed.order_by('cost_pool_id').values_list('cost_pool_id', 'data').iterator(
+            chunk_size=LOOKUP_CHUNK_SIZE):
+        if wanted is None:
+            wanted = _line_ids(lines)
+        pool_lines, cents = unpack(data)
+        position = np.searchsorted(wanted, pool_lines).clip(max=max(len(wanted) - 1, 0))
+        keep = wanted[position] == pool_lines if len(wanted) else np.zeros(len(pool_lines), dtype=bool)
+        parts.append((pool_lines[keep], np.full(int(keep.sum()), pool_id, dtype=np.int64), cents[keep]))
+    return tuple(np.concatenate(column) for column in zip(*parts))
+
+
+def allocation_rows(lines, exclude_pools=()):
+    """Iterator of ``(line_id, pool_id, amount)`` for ``read_allocations``, amounts as ``Decimal``."""
+    line_ids, pool_ids, cents = read_allocations(lines, exclude_pools)
+    return zip(line_ids.tolist(), pool_ids.tolist(), to_decimals(cents))
@@ -0,0 +1,183 @@
+"""HTSUS rate resolution for a batch of invoices from memory.
+
+``AllocationService`` used to follow ``line.sku.htsus_code`` lazily for
+every line and, for codes with complex rates, ask the database for the
+matching ``HTSRateDetail`` twice per line.  ``RateContext.load`` reads the
+SKUs and their HTS codes for the batch up front, two queries (per
+``LOOKUP_CHUNK_SIZE`` keys), and ``rate`` then answers from memory.
+
+Rate details come from ``RateIndex``, an interval index of every
+``HTSRateDetail`` held by the process: per (HTS code, country) the rows
+are sorted by ``effective_from``, so the row in force on a date is found
+by binary search.  Saves and deletes in this process update the index
+in place (``post_save``/``post_delete``); changes made by other processes
+are noticed by comparing the row count and latest ``updated_at`` with the
+table, one aggregate query per ``rate_index()`` call, and trigger a
+rebuild.  ``QuerySet.update()`` does not touch ``updated_at``, so write
+rate details through ``save()``.
+"""
+import threading
+from bisect import bisect_right
+from decimal import Decimal
+
+from django.db.models import Count, Max, Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .ingestion import fetch_values_in
+from .models import HTSRateDetail, HTSUSCode, SKU
+
+_to_date = HTSRateDetail._meta.get_field('effective_from').to_python
+
+DETAIL_FIELDS = ('pk', 'hts_code_id', 'country_code', 'adval_pct', 'effective_from', 'effective_to', 'updated_at')
+
+
+class RateIndex:
+    """``HTSRateDetail`` rows keyed by (hts_code_id, country_code), sorted by ``effective_from``."""
+
+    def __init__(self, details=()):
+        # key -> ([effective_from, ...], [(effective_from, pk, effective_to, adval_pct), ...])
+        self._series = {}
+        # pk -> (key, updated_at), to move or drop a row when it changes
+        self._rows = {}
+        for detail in details:
+            self.add(detail)
+
+    @property
+    def fingerprint(self):
+        """``(row count, latest updated_at)``, as ``table_fingerprint`` reports it for the same rows."""
+        return len(self._rows), max((updated_at for _, updated_at in self._rows.values()), default=None)
+
+    def add(self, detail):
+        self.discard(detail.pk)
+        key = (detail.hts_code_id, detail.country_code)
+        starts, rows = self._series.setdefault(key, ([], []))
+        # Saved instances may still hold the strings they were created with.
+        effective_from = _to_date(detail.effective_from)
+        row = (effective_from, detail.pk, _to_date(detail.effective_to), detail.adval_pct)
+        index = bisect_right(rows, row)
+        starts.insert(index, effective_from)
+        rows.insert(index, row)
+        self._rows[detail.pk] = (key, detail.updated_at)
+
+    def discard(self, pk):
+        if pk not in self._rows:
+            return
+        key, _ = self._rows.pop(pk)
+        starts, rows = self._series[key]
+        index = next(i for i, row in enumerate(rows) if row[1] == pk)
+        del starts[index], rows[index]
+        if not rows:
+            del self._series[key]
+
+    def lookup(self, hts_code_id, country_code, on_date):
+        """``(found, adval_pct)`` of the row in force on ``on_date``, the latest starting one if several are."""
+        series = self._series.get((hts_code_id, country_code))
+        if series is None:
+            return False, None
+        starts, rows = series
+        # Rows starting on or before the date, latest first; the first
+        # still in force wins.  Periods rarely overlap, so this is one step.
+        for index in range(bisect_right(starts, on_date) - 1, -1, -1):
+            effective_to = rows[index][2]
+            if effective_to is None or effective_to >= on_date:
+                return True, rows[index][3]
+        return False, None
+
+
+def table_fingerprint():
+    totals = HTSRateDetail.objects.aggregate(count=Count('pk'), latest=Max('updated_at'))
+    return totals['count'], totals['latest']
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def rate_index():
+    """The process-wide ``RateIndex``, rebuilt if the table changed behind its back."""
+    global _index
+    fingerprint = table_fingerprint()
+    with _index_lock:
+        if _index is None or _index.fingerprint != fingerprint:
+            _index = RateIndex(HTSRateDetail.objects.only(*DETAIL_FIELDS).iterator())
+        return _index
+
+
+@receiver(post_save, sender=HTSRateDetail)
+def _index_saved_detail(sender, instance, raw=False, **kwargs):
+    with _index_lock:
+        if _index is not None and not raw:
+            _index.add(instance)
+
+
+@receiver(post_delete, sender=HTSRateDetail)
+def _index_deleted_detail(sender, instance, **kwargs):
+    with _index_lock:
+        if _index is not None:
+            _index.discard(instance.pk)
+
+
+def rate_detail_from_db(hts_code_id, country_code, on_date):
+    """``(found, adval_pct)`` like ``RateIndex.lookup``, straight from the database.
+
+    The per-line query the index replaces; kept for comparison in the tests
+    and ``manage.py benchmark_rates``.
+    """
+    row = HTSRateDetail.objects.filter(
+        hts_code_id=hts_code_id, country_code=country_code, effective_from__lte=on_date,
+    ).filter(
+        Q(effective_to__gte=on_date) | Q(effective_to__isnull=True)
+    ).order_by('-effective_from', '-pk').values_list('adval_pct').first()
+    return (False, None) if row is None else (True, row[0])
+
+
+class RateContext:
+    """Rates of a fixed set of SKUs, resolved from memory."""
+
+    def __init__(self, skus, codes, index):
+        self.skus = skus
+        self.codes = codes
+        self.index = index
+        self._rates = {}
+
+    @classmethod
+    def load(cls, sku_ids):
+        """Load the SKUs ``sku_ids`` and their HTS codes; rate details come from ``rate_index()``."""
+        skus = {
+            sku.pk: sku
+            for sku in fetch_values_in(SKU.objects.only('pk', 'htsus_rate_pct', 'htsus_code_id'), 'pk', set(sku_ids))
+        }
+        code_ids = {sku.htsus_code_id for sku in skus.values()} - {None}
+        codes = {
+            code.pk: code
+            for code in fetch_values_in(HTSUSCode.objects.only('pk', 'rate_pct', 'has_complex_rates'), 'pk', code_ids)
+        }
+        index = rate_index() if any(code.has_complex_rates for code in codes.values()) else RateIndex()
+        return cls(skus, codes, index)
+
+    def rate(self, sku_id, country_code, invoice_date):
+        """HTSUS rate (percent) of SKU ``sku_id`` for goods from ``country_code`` on ``invoice_date``."""
+        key = (sku_id, country_code, invoice_date)
+        if key not in self._rates:
+            self._rates[key] = self._resolve(sku_id, country_code, invoice_date)
+        return self._rates[key]
+
+    def _resolve(self, sku_id, country_code, invoice_date):
+        sku = self.skus[sku_id]
+        # Check SKU level first
+        if sku.htsus_rate_pct is not None:
+            return sku.htsus_rate_pct
+        hts = self.codes.get(sku.htsus_code_id)
+        if hts is None:
+            # No HTS code assigned
+            return Decimal(0)
+        if hts.has_complex_rates and country_code:
+            # Country-specific or global
+            for country in (country_code, ''):
+                found, adval_pct = self.index.lookup(hts.pk, country, invoice_date)
+                if found:
+                    # For now, return only ad valorem rate
+                    # TODO: Add support for specific duties and compound rates
+                    return adval_pct if adval_pct else Decimal(0)
+        return hts.rate_pct if hts.rate_pct else Decimal(0)
@@ -0,0 +1,136 @@
+"""Incremental readers for uploaded files.
+
+Uploads are decoded chunk by chunk from ``UploadedFile.chunks()`` instead of
+``read().decode()``, so the raw bytes, the decoded text and the parsed rows
+are never held in memory all at once.  Excel workbooks are streamed the same
+way with openpyxl's read-only mode, so CSV and Excel uploads can feed the
+same batch writers through ``open_table``.
+"""
+import codecs
+import csv
+from itertools import islice
+
+from openpyxl import load_workbook
+
+DEFAULT_BATCH_SIZE = 5000
+FALLBACK_ENCODING = 'cp1252'
+EXCEL_EXTENSIONS = ('.xlsx', '.xlsm')
+
+
+def iter_text(chunks, encoding='utf-8', fallback_encoding=FALLBACK_ENCODING):
+    """Decode an iterable of byte chunks into text chunks.
+
+    A leading UTF-8 byte order mark is dropped.  If the bytes stop being
+    valid UTF-8 the rest of the stream is decoded as Windows-1252, which is
+    what Excel on Windows writes when it exports "CSV" rather than
+    "CSV UTF-8".
+    """
+    decoder = codecs.getincrementaldecoder(f'{encoding}-sig' if encoding == 'utf-8' else encoding)()
+    for chunk in chunks:
+        try:
+            text = decoder.decode(chunk)
+        except UnicodeDecodeError as exc:
+            if fallback_encoding is None:
+                raise
+            text = exc.object[:exc.start].decode(encoding)
+            decoder = codecs.getincrementaldecoder(fallback_encoding)(errors='replace')
+            text += decoder.decode(exc.object[exc.start:])
+            fallback_encoding = None
+        if text:
+            yield text
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+def iter_lines(text_chunks):
+    """Split text chunks into ``\\n``-terminated lines for the csv module."""
+    pending = ''
+    for text in text_chunks:
+        pending += text
+        lines = pending.split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+
+def csv_dict_reader(uploaded_file, **kwargs):
+    """Return a ``csv.DictReader`` that streams ``uploaded_file`` chunk by chunk."""
+    return csv.DictReader(iter_lines(iter_text(uploaded_file.chunks())), **kwargs)
+
+
+def iter_batches(iterable, size=DEFAULT_BATCH_SIZE):
+    """Yield lists of at most ``size`` items from ``iterable``."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def iter_csv_batches(uploaded_file, batch_size=DEFAULT_BATCH_SIZE):
+    """Yield batches of CSV rows (as dicts) from ``uploaded_file``."""
+    return iter_batches(csv_dict_reader(uploaded_file), batch_size)
+
+
+def iter_workbook_rows(file, sheet=0):
+    """Yield the rows of one worksheet of an .xlsx file as tuples of cell values.
+
+    The workbook is opened read-only, so openpyxl parses the sheet XML as it
+    goes instead of building every cell of every sheet up front; memory
+    stays flat however many rows the sheet has.  ``sheet`` is an index or a
+    sheet name.  Rows without any value are skipped.
+    """
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        worksheet = workbook.worksheets[sheet] if isinstance(sheet, int) else workbook[sheet]
+        for row in worksheet.iter_rows(values_only=True):
+            if any(value is not None for value in row):
+                yield row
+    finally:
+        workbook.close()
+
+
+def _iter_legacy_excel_rows(file):
+    # The binary .xls format has no streaming reader; pandas (xlrd) loads it whole.
+    import pandas as pd
+    df = pd.read_excel(file, header=None, dtype=object)
+    for row in df.itertuples(index=False):
+        yield tuple(None if pd.isna(value) else value for value in row)
+
+
+def open_table(file, file_name, sheet=0):
+    """Return ``(header, rows)`` for an uploaded CSV or Excel file.
+
+    ``header`` is the list of first-row values with trailing empty cells
+    dropped; ``rows`` lazily yields the remaining rows as sequences of cell
+    values: strings for CSV files, typed values (numbers, datetimes,
+    ``None``) for workbooks.  Only the first worksheet is read by default,
+    as ``pandas.read_excel`` did.
+    """
+    name = file_name.lower()
+    if name.endswith(EXCEL_EXTENSIONS):
+        rows = iter_workbook_rows(file, sheet)
+    elif name.endswith('.xls'):
+        rows = _iter_legacy_excel_rows(file)
+    else:
+        rows = (row for row in csv.reader(iter_lines(iter_text(file.chunks()))) if row)
+    header = list(next(rows, None) or [])
+    while header and header[-1] in (None, ''):
+        header.pop()
+    return header, rows
+
+
+def iter_table_dicts(file, file_name, sheet=0):
+    """Yield the rows of a CSV or Excel file as dicts keyed by the header row."""
+    header, rows = open_table(file, file_name, sheet)
+    for row in rows:
+        yield dict(zip(header, row))
+
+
+def is_blank(value):
+    """True for an empty cell: ``None`` from a workbook or a blank CSV string."""
+    return value is None or (isinstance(value, str) and not value.strip())
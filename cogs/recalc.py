@@ -0,0 +1,207 @@
+"""Recalculation of every cost pool, partitioned by container.
+
+A container-scoped pool only touches the lines of its container, and an
+invoice-scoped pool (including every "HTSUS Tariff" pool) only those of
+its invoice, so grouping both under the invoice's container splits the
+work into partitions that share no lines.  ``plan_partitions`` packs the
+containers into bins of similar line counts; the bins run on a ``spawn``
+process pool (``cogs.worker.recalculate_partition``), each worker with
+its own database connection and each bin in its own transaction.
+Pools spanning every line (ALL scope, or a scope without its container or
+invoice) run last in the parent, the reduce step.
+
+Each bin commits on its own: a failed recalculation leaves the bins that
+finished reallocated, and running it again replaces their rows.
+
+``recalculate_dirty`` is the incremental alternative: it reallocates only
+the pools and tariffs that ``cogs.dirty`` marked as changed, in one
+transaction, and reports how many it left alone.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Q
+
+from . import dirty, locks, worker
+from .ingestion import fetch_values_in
+from .models import CostPool, Invoice, InvoiceLine
+from .services import AllocationService
+
+# Bins per worker: enough to even out uneven containers, few enough to
+# keep the per-bin queries cheap.
+BINS_PER_WORKER = 4
+
+
+@dataclass
+class PartitionResult:
+    containers: int = 0
+    pools: int = 0
+    invoices: int = 0
+
+
+def recalc_workers():
+    """``COGS_RECALC_WORKERS``; 1 on SQLite, which serializes writers anyway."""
+    return 1 if connection.vendor == 'sqlite' else max(1, settings.COGS_RECALC_WORKERS)
+
+
+def _container_q(field, container_ids):
+    """``field`` is one of ``container_ids``, where ``None`` stands for no container."""
+    q = Q(**{f'{field}__in': [pk for pk in container_ids if pk is not None]})
+    if None in container_ids:
+        q |= Q(**{f'{field}__isnull': True})
+    return q
+
+
+def partition_pools(container_ids):
+    """Manual pools confined to the containers ``container_ids``."""
+    return CostPool.objects.filter(auto_compute=False).filter(
+        Q(scope=CostPool.Scope.CONTAINER) & _container_q('container_id', [pk for pk in container_ids if pk is not None])
+        | Q(scope=CostPool.Scope.INVOICE, invoice__isnull=False) & _container_q('invoice__container_id', container_ids)
+    )
+
+
+def reduce_pools():
+    """Manual pools spanning every line; allocated after all partitions."""
+    return CostPool.objects.filter(auto_compute=False).filter(
+        Q(scope=CostPool.Scope.ALL)
+        | Q(scope=CostPool.Scope.CONTAINER, container__isnull=True)
+        | Q(scope=CostPool.Scope.INVOICE, invoice__isnull=True)
+    )
+
+
+def plan_partitions(bins):
+    """Split the containers (``None`` for invoices without one) into at most ``bins`` lists.
+
+    Containers are placed largest first, each into the bin with the fewest
+    lines so far.
+    """
+    sizes = dict(
+        InvoiceLine.objects.values_list('invoice__container_id').annotate(lines=Count('id')).values_list(
+            'invoice__container_id', 'lines')
+    )
+    # Invoices without lines still get their HTSUS pool, and pools of a
+    # container without invoices still have their old rows replaced.
+    for container_id in Invoice.objects.values_list('container_id', flat=True).distinct():
+        sizes.setdefault(container_id, 0)
+    for container_id in CostPool.objects.filter(scope=CostPool.Scope.CONTAINER, container__isnull=False).values_list(
+            'container_id', flat=True).distinct():
+        sizes.setdefault(container_id, 0)
+    partitions = [[] for _ in range(min(bins, len(sizes)))]
+    loads = [0] * len(partitions)
+    for container_id, lines in sorted(sizes.items(), key=lambda item: (-item[1], item[0] is None, item[0] or 0)):
+        smallest = loads.index(min(loads))
+        partitions[smallest].append(container_id)
+        loads[smallest] += lines
+    return partitions
+
+
+def recalculate_partition(container_ids):
+    """Recompute HTSUS and reallocate the manual pools of ``container_ids`` in one transaction."""
+    service = AllocationService()
+    with transaction.atomic():
+        pools = list(partition_pools(container_ids))
+        invoices = Invoice.objects.filter(_container_q('container_id', container_ids))
+        # Every scope up front; see cogs.locks.
+        locks.lock_scopes(pools, invoices.values_list('pk', flat=True))
+        htsus_pools = service.compute_htsus_pools(invoices, lock=False)
+        service.allocate_pools(pools + htsus_pools, lock=False)
+    return PartitionResult(len(container_ids), len(pools), len(htsus_pools))
+
+
+def recalculate_partitioned(workers=None, progress=None):
+    """Reallocate every manual pool and recompute HTSUS for every invoice, ``workers`` partitions at a time.
+
+    Allocates the same rows as ``AllocationService.recalculate_all``.
+    ``progress(done, total)`` is called as partitions finish.  Returns the
+    counts ``recalculate_all`` does plus the number of partitions.
+    """
+    workers = recalc_workers() if workers is None else max(1, workers)
+    # Everything is recomputed, so the pending marks are settled; they
+    # come back if the run fails, as its bins commit separately.
+    with transaction.atomic():
+        changes = dirty.claim()
+    try:
+        counts = _recalculate_partitions(workers, progress)
+    except BaseException:
+        dirty.restore(changes)
+        raise
+    return counts
+
+
+def _recalculate_partitions(workers, progress):
+    partitions = plan_partitions(workers * BINS_PER_WORKER)
+    total = PartitionResult()
+
+    def add(result, done):
+        total.pools += result.pools
+        total.invoices += result.invoices
+        if progress:
+            progress(done, len(partitions) + 1)
+
+    if workers == 1 or len(partitions) <= 1:
+        for done, container_ids in enumerate(partitions, start=1):
+            add(recalculate_partition(container_ids), done)
+    else:
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=min(workers, len(partitions)), mp_context=context,
+                                 initializer=worker.init_worker) as pool:
+            futures = [pool.submit(worker.recalculate_partition, container_ids) for container_ids in partitions]
+            for done, future in enumerate(as_completed(futures), start=1):
+                add(future.result(), done)
+
+    # Reduce: pools over every line, once the partitions are in place.
+    with transaction.atomic():
+        pools = list(reduce_pools())
+        AllocationService().allocate_pools(pools)
+    total.pools += len(pools)
+    if progress:
+        progress(len(partitions) + 1, len(partitions) + 1)
+    return {'pools': total.pools, 'invoices': total.invoices, 'partitions': len(partitions)}
+
+
+def _spans_all(scope, invoice_id, container_id):
+    """Whether a pool of this scope is spread over every line, as in ``AllocationService.lines_for_pool``."""
+    return not (scope == CostPool.Scope.INVOICE and invoice_id or scope == CostPool.Scope.CONTAINER and container_id)
+
+
+def recalculate_dirty():
+    """Reallocate what changed since it was last allocated (see ``cogs.dirty``), in one transaction.
+
+    That is the manual pools with a ``POOL`` mark, or spread over lines
+    that changed, and the tariffs of invoices with a ``TARIFF`` or
+    ``LINES`` mark.  Returns the counts ``recalculate_partitioned`` does,
+    without partitions, plus the manual pools and invoices skipped.
+    """
+    service = AllocationService()
+    with transaction.atomic():
+        changes = dirty.claim()
+        containers = set(changes.containers)
+        containers.update(pk for _, pk in fetch_values_in(
+            Invoice.objects.values_list('pk', 'container_id'), 'pk', changes.lines))
+        lines_changed = bool(changes.lines or changes.containers)
+
+        manual = CostPool.objects.filter(auto_compute=False).values_list('pk', 'scope', 'invoice_id', 'container_id')
+        total_pools = 0
+        stale = []
+        for pk, scope, invoice_id, container_id in manual:
+            total_pools += 1
+            if (pk in changes.pools
+                    or scope == CostPool.Scope.INVOICE and invoice_id in changes.lines
+                    or scope == CostPool.Scope.CONTAINER and container_id in containers
+                    or lines_changed and _spans_all(scope, invoice_id, container_id)):
+                stale.append(pk)
+        pools = list(fetch_values_in(CostPool.objects.order_by('pk'), 'pk', stale))
+        invoices = list(fetch_values_in(
+            Invoice.objects.select_related('entry').order_by('pk'), 'pk', changes.tariffs | changes.lines))
+        locks.lock_scopes(pools, [invoice.pk for invoice in invoices])
+        htsus_pools = service.compute_htsus_pools(invoices, lock=False)
+        service.allocate_pools(pools + htsus_pools, lock=False)
+    return {
+        'pools': len(pools),
+        'invoices': len(htsus_pools),
+        'skipped_pools': total_pools - len(pools),
+        'skipped_invoices': Invoice.objects.count() - len(htsus_pools),
+    }
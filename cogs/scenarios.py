@@ -0,0 +1,206 @@
+"""Tariff scenario sweeps over the landed cost of every line.
+
+Finance asks "what if Section 301 on China goes to 25% and 9403.60 to
+10%?" for dozens of such scenarios at once.  ``ScenarioLines`` reads the
+lines once into numpy columns: vendor cost, the allocated costs of
+``cogs.landed`` (which no tariff rate changes), and for the tariff the
+line's HTS code and country of origin as indexes into per-code and
+per-country rate vectors.  A scenario is a pair of such vectors, so N
+scenarios are two matrices and the tariff change of every line under
+every scenario is one gather and multiply; summing it per container,
+invoice or SKU gives the impact cube.
+
+Rates follow ``landed_cost_rows``: a SKU's own ``htsus_rate_pct`` wins
+over its HTS code, so HTS scenarios leave those lines alone, and Section
+301 applies by the invoice's country of origin.  Amounts are floats and
+rounded to the cent only on export.
+"""
+import csv
+from dataclasses import dataclass, field
+
+import numpy as np
+from django.db import models
+from django.db.models.functions import Cast
+
+from tariff.models import Country
+
+from .ingestion import fetch_values_in
+from .landed import FREIGHT_POOL, HTSUS_POOL
+from .packed import read_allocations
+from .models import Container, CostPool, HTSUSCode, Invoice, InvoiceLine, SKU
+
+SCENARIO_KINDS = ('section_301', 'hts')
+DIMENSIONS = ('container', 'invoice', 'sku')
+CUBE_HEADER = ['Scenario', 'Dimension', 'Key', 'Baseline Landed Cost', 'Scenario Landed Cost', 'Impact']
+# Scenarios evaluated together are capped so that (scenarios × lines)
+# floats stay around 32 MB.
+SWEEP_CHUNK_ELEMENTS = 4_000_000
+
+
+@dataclass
+class Scenario:
+    """Rate changes (percent) by country code for Section 301 and by HTS code."""
+    name: str
+    section_301: dict = field(default_factory=dict)
+    hts: dict = field(default_factory=dict)
+
+
+def read_scenarios(rows):
+    """``Scenario`` objects from CSV rows (dicts) with columns scenario, kind, code and rate.
+
+    ``kind`` is ``section_301`` (``code`` a country code) or ``hts`` (an
+    HTS code).  Scenarios keep the order they first appear in.  Raises
+    ``ValueError`` naming the first bad row.
+    """
+    scenarios = {}
+    for number, row in enumerate(rows, start=2):
+        name, kind, code = (str(row.get(column) or '').strip() for column in ('scenario', 'kind', 'code'))
+        if not name or not code:
+            raise ValueError(f'Row {number}: scenario and code are required.')
+        if kind not in SCENARIO_KINDS:
+            raise ValueError(f'Row {number}: kind must be one of {", ".join(SCENARIO_KINDS)}, not {kind!r}.')
+        try:
+            rate = float(row.get('rate'))
+        except (TypeError, ValueError):
+            raise ValueError(f'Row {number}: rate {row.get("rate")!r} is not a number.') from None
+        scenario = scenarios.setdefault(name, Scenario(name))
+        getattr(scenario, kind)[code.upper() if kind == 'section_301' else code] = rate
+    return list(scenarios.values())
+
+
+def _index(keys):
+    """Position of each of ``keys`` among their sorted distinct values, and those values."""
+    values, positions = np.unique(keys, return_inverse=True)
+    return positions, values
+
+
+class ScenarioLines:
+    """The lines of the queryset ``lines`` (default: all) as numpy columns, with their current rates."""
+
+    def __init__(self, lines=None):
+        lines = InvoiceLine.objects.all() if lines is None else lines
+        rows = list(lines.order_by('pk').values_list(
+            'pk', 'invoice_id', 'invoice__container_id', 'sku_id', 'quantity',
+            Cast('price_vendor', models.FloatField()), Cast('sku__htsus_rate_pct', models.FloatField()),
+            'sku__htsus_code_id', 'invoice__country_origin',
+        ))
+        ids, invoices, containers, skus, quantities, prices, sku_rates, code_ids, countries = \
+            list(zip(*rows)) or [()] * 9
+        self.ids = np.array(ids, dtype=np.int64)
+        self.vendor = np.array(prices, dtype=np.float64) * np.array(quantities, dtype=np.float64)
+        self.other = self._allocated_costs(lines)
+
+        # Code and country rates get an extra last column, always 0% and
+        # never changed by a scenario, for lines whose SKU has its own rate
+        # (``sku_rate``), without an HTS code or without a country.
+        self.sku_rate = np.array([0.0 if rate is None else rate for rate in sku_rates])
+        codes = {
+            pk: (code, float(rate or 0)) for pk, code, rate in fetch_values_in(
+                HTSUSCode.objects.values_list('pk', 'code', 'rate_pct'), 'pk',
+                {pk for pk in code_ids if pk is not None})
+        }
+        code_column = {pk: column for column, pk in enumerate(codes)}
+        self.code_column = {code: code_column[pk] for pk, (code, _) in codes.items()}
+        self.code_rates = np.array([rate for _, rate in codes.values()] + [0.0])
+        self.code_index = np.array([
+            code_column[pk] if pk is not None and rate is None else len(codes)
+            for pk, rate in zip(code_ids, sku_rates)
+        ], dtype=np.int64)
+
+        section_301 = dict(Country.objects.values_list('code', 'section_301_rate'))
+        self.country_column = {code: column for column, code in enumerate(sorted({code for code in countries if code}))}
+        self.country_rates = np.array([float(section_301.get(code) or 0) for code in self.country_column] + [0.0])
+        self.country_index = np.array([self.country_column.get(code, len(self.country_column)) for code in countries],
+                                      dtype=np.int64)
+
+        self.groups = {
+            'container': _index(np.array([-1 if pk is None else pk for pk in containers], dtype=np.int64)),
+            'invoice': _index(np.array(invoices, dtype=np.int64)),
+            'sku': _index(np.array(skus, dtype=np.int64)),
+        }
+
+    def _allocated_costs(self, lines):
+        """Allocated cost per line as ``landed_cost_rows`` counts it: the first freight row and every other pool but HTSUS."""
+        other = np.zeros(len(self.ids))
+        line_ids, pool_ids, cents = read_allocations(lines)
+        if not len(line_ids):
+            return other
+        amounts = cents / 100
+        names = dict(CostPool.objects.values_list('pk', 'name'))
+        position = np.searchsorted(self.ids, line_ids)
+        freight = np.isin(pool_ids, [pk for pk, name in names.items() if name == FREIGHT_POOL])
+        rest = ~freight & ~np.isin(pool_ids, [pk for pk, name in names.items() if name == HTSUS_POOL])
+        other += np.bincount(position[rest], weights=amounts[rest], minlength=len(self.ids))
+        _, first = np.unique(position[freight], return_index=True)
+        other[position[freight][first]] += amounts[freight][first]
+        return other
+
+    def baseline(self):
+        """Landed cost of each line at the current rates."""
+        rate = self.code_rates[self.code_index] + self.sku_rate + self.country_rates[self.country_index]
+        return self.vendor + self.other + self.vendor * rate / 100
+
+    def rate_changes(self, scenarios):
+        """How each scenario changes the code and country rates, as (scenarios × codes, scenarios × countries)."""
+        hts = np.zeros((len(scenarios), len(self.code_rates)))
+        section_301 = np.zeros((len(scenarios), len(self.country_rates)))
+        for row, scenario in enumerate(scenarios):
+            for changes, columns, rates, current in ((hts, self.code_column, scenario.hts, self.code_rates),
+                                                    (section_301, self.country_column, scenario.section_301,
+                                                     self.country_rates)):
+                for code, rate in rates.items():
+                    if code in columns:
+                        changes[row, columns[code]] = rate - current[columns[code]]
+        return hts, section_301
+
+    def sweep(self, scenarios, dimensions=DIMENSIONS):
+        """``ImpactCube`` of ``scenarios`` summed by each of ``dimensions``."""
+        scenarios = list(scenarios)
+        groups = {dimension: self.groups[dimension] for dimension in dimensions}
+        impact = {dimension: np.zeros((len(scenarios), len(keys))) for dimension, (_, keys) in groups.items()}
+        hts, section_301 = self.rate_changes(scenarios)
+        step = max(1, SWEEP_CHUNK_ELEMENTS // max(1, len(self.ids)))
+        for start in range(0, len(scenarios), step):
+            # Tariff change of every line under each scenario of the chunk.
+            chunk = slice(start, start + step)
+            changes = self.vendor * (hts[chunk][:, self.code_index] + section_301[chunk][:, self.country_index]) / 100
+            for row, change in enumerate(changes, start=start):
+                for dimension, (positions, keys) in groups.items():
+                    impact[dimension][row] = np.bincount(positions, weights=change, minlength=len(keys))
+        baseline = self.baseline()
+        return ImpactCube([scenario.name for scenario in scenarios], {
+            dimension: (_labels(dimension, keys), np.bincount(positions, weights=baseline, minlength=len(keys)),
+                        impact[dimension])
+            for dimension, (positions, keys) in groups.items()
+        })
+
+
+def _labels(dimension, keys):
+    """Display names of the container, invoice or SKU ids ``keys`` (``-1``: no container)."""
+    model, name = {'container': (Container, 'container_id'), 'invoice': (Invoice, 'invoice_number'),
+                   'sku': (SKU, 'sku')}[dimension]
+    names = dict(fetch_values_in(model.objects.values_list('pk', name), 'pk', keys.tolist()))
+    return [names.get(key, '') for key in keys.tolist()]
+
+
+@dataclass
+class ImpactCube:
+    """Landed cost by scenario × dimension × key.
+
+    ``dimensions`` maps each dimension to ``(labels, baseline, impact)``:
+    the keys' display names, their landed cost at current rates and the
+    (scenarios × keys) change of it under each scenario.
+    """
+    scenarios: list
+    dimensions: dict
+
+    def rows(self):
+        for dimension, (labels, baseline, impact) in self.dimensions.items():
+            for row, scenario in enumerate(self.scenarios):
+                for label, base, change in zip(labels, baseline, impact[row]):
+                    yield [scenario, dimension, label, f'{base:.2f}', f'{base + change:.2f}', f'{change:.2f}']
+
+    def write_csv(self, file):
+        writer = csv.writer(file)
+        writer.writerow(CUBE_HEADER)
+        writer.writerows(self.rows())
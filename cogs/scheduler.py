@@ -0,0 +1,74 @@
+"""Debounced recalculation after cost edits.
+
+Adding, editing or deleting a cost pool used to allocate inside the
+request, and deleting one reallocated every manual pool.  Edits now only
+record what changed (``cogs.dirty``) and call ``schedule_recalculation``,
+which queues one incremental ``recalculate_costs`` job, not claimed until
+``COGS_RECALC_DEBOUNCE_SECONDS`` have passed without a further edit.
+While that job is still queued every further edit joins it and pushes it
+back, up to ``COGS_RECALC_MAX_DELAY_SECONDS`` after it was first queued,
+so a burst of edits costs one recalculation of the scopes they touched.
+An edit made once the job is running queues the next one, and a worker
+cannot claim the job while an edit is pushing it back (``claim_job``
+checks ``run_after`` in its update).
+
+``results_watermark`` tells the results page how current it is: every
+change before the oldest pending ``RecalcMark`` is in the stored
+allocations.  In eager mode (``COGS_JOBS_EAGER``) the job runs straight
+away, as every job does.
+"""
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Min
+from django.utils import timezone
+
+from . import locks
+from .jobs import enqueue
+from .models import Job, RecalcMark
+
+RECALC_KIND = 'recalculate_costs'
+
+
+def schedule_recalculation(user=None):
+    """Have the changes marked so far recalculated once edits pause; returns the ``Job`` that will do it."""
+    now = timezone.now()
+    run_after = now + timedelta(seconds=settings.COGS_RECALC_DEBOUNCE_SECONDS)
+    if settings.COGS_JOBS_EAGER:
+        # Runs inside enqueue, so there is never a queued one to join.
+        return enqueue(RECALC_KIND, {'debounced': True}, user=user, run_after=run_after)
+    with transaction.atomic():
+        # select_for_update locks nothing while no job is queued; the name
+        # lock keeps two first edits from each queueing one.
+        locks.lock_names(RECALC_KIND)
+        queued = Job.objects.filter(kind=RECALC_KIND, payload__debounced=True, status=Job.Status.QUEUED)
+        job = queued.select_for_update().order_by('created_at').first()
+        if job is None:
+            return enqueue(RECALC_KIND, {'debounced': True}, user=user, run_after=run_after)
+        job.run_after = min(run_after, job.created_at + timedelta(seconds=settings.COGS_RECALC_MAX_DELAY_SECONDS))
+        Job.objects.filter(pk=job.pk).update(run_after=job.run_after)
+        return job
+
+
+@dataclass
+class Watermark:
+    # Every change before this time is in the results; None when all are.
+    current_as_of: datetime = None
+    # The queued or running recalculation that will bring in the rest.
+    job: Job = None
+
+    @property
+    def is_current(self):
+        return self.current_as_of is None
+
+
+def results_watermark():
+    """How current the stored allocations are, as a ``Watermark``."""
+    oldest = RecalcMark.objects.aggregate(oldest=Min('marked_at'))['oldest']
+    if oldest is None:
+        return Watermark()
+    job = Job.objects.filter(kind=RECALC_KIND, status__in=[Job.Status.QUEUED, Job.Status.RUNNING]).order_by(
+        'created_at').first()
+    return Watermark(oldest, job)
@@ -1,154 +1,476 @@
-from .models import InvoiceLine, CostPool, AllocatedCost, HTSUSCode, SKU
+from itertools import islice
+
+import numpy as np
+
+from . import dirty, locks
+from .allocation import (
+    CENT, PRICE_METHODS, VOLUME, WEIGHTED_METHODS, allocate, allocate_cents, line_weights, weight_to_decimal,
+)
+from .ingestion import LOOKUP_CHUNK_SIZE, fetch_values_in
+from .landed import group_allocations, landed_cost_rows, load_lines
+from .rates import RateContext
+from .models import Invoice, InvoiceLine, CostPool, AllocatedCost, HTSUSCode, PackedAllocation, SKU
+from .money import to_decimals
+from .packed import allocation_cents, allocation_rows, pack
 from decimal import Decimal
-from django.db import models
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Cast, Floor, Mod, Round
 from tariff.models import Entry
 from datetime import date
 
+ALLOCATION_BATCH_SIZE = 1000
+# AllocatedCost rows buffered by allocate_pools between inserts.
+ALLOCATION_FLUSH_ROWS = 50_000
+# Lines read, and AllocatedCost rows inserted, at a time by streaming mode.
+ALLOCATION_STREAM_CHUNK_SIZE = 10_000
+# PackedAllocation rows per insert; each holds a whole pool.
+PACKED_BATCH_SIZE = 50
+# Above this many invoices/containers a batch loads every line instead of
+# filtering with long IN lists.
+LINE_FILTER_MAX_KEYS = 500
+
+
+def _group_positions(keys):
+    """Map each distinct value of ``keys`` to the positions holding it, in order."""
+    order = np.argsort(keys, kind='stable')
+    values, starts = np.unique(keys[order], return_index=True)
+    return dict(zip(values.tolist(), np.split(order, starts[1:])))
+
+
+class LineColumns:
+    """The invoice lines of a batch of cost pools as numpy columns, in id order.
+
+    Loaded with one query; ``positions(pool)`` picks a pool's lines by its
+    scope, like ``AllocationService.lines_for_pool``.
+    """
+
+    def __init__(self, queryset, price=False, volume=False):
+        columns = ['id', 'invoice_id', 'invoice__container_id', 'quantity']
+        if price:
+            # Read as float: building a Decimal per row costs more than the
+            # allocation itself, and the kernel only needs whole cents.
+            columns.append(Cast('price_vendor', models.FloatField()))
+        if volume:
+            columns.append('unit_volume_cc')
+        rows = list(queryset.order_by('id').values_list(*columns))
+        values = list(zip(*rows)) or [()] * len(columns)
+        self.ids = np.array(values[0], dtype=np.int64)
+        self.invoice = np.array(values[1], dtype=np.int64)
+        self.container = np.array([-1 if pk is None else pk for pk in values[2]], dtype=np.int64)
+        self.quantity = np.array(values[3], dtype=np.int64)
+        rest = iter(values[4:])
+        self.price = np.array(next(rest), dtype=np.float64) if price else None
+        self.volume = np.array(next(rest), dtype=np.float64) if volume else None
+        self._by_invoice = None
+        self._by_container = None
+
+    def positions(self, pool):
+        if pool.scope == CostPool.Scope.INVOICE and pool.invoice_id:
+            if self._by_invoice is None:
+                self._by_invoice = _group_positions(self.invoice)
+            # Pools built from form data may still hold the id as a string.
+            return self._by_invoice.get(int(pool.invoice_id), np.empty(0, dtype=np.int64))
+        if pool.scope == CostPool.Scope.CONTAINER and pool.container_id:
+            if self._by_container is None:
+                self._by_container = _group_positions(self.container)
+            return self._by_container.get(int(pool.container_id), np.empty(0, dtype=np.int64))
+        return np.arange(len(self.ids))
+
+
+def spans_every_line(pool):
+    """Whether ``pool`` is spread over every invoice line, not one invoice or container."""
+    return not ((pool.scope == CostPool.Scope.INVOICE and pool.invoice_id)
+                or (pool.scope == CostPool.Scope.CONTAINER and pool.container_id))
+
+
+def superseded_allocations():
+    """``AllocatedCost`` rows left over from earlier allocations of the same pool and line.
+
+    Reallocation used to add a new set of rows without removing the old
+    one; for each (pool, line) pair only the newest row is current.
+    """
+    current = (
+        AllocatedCost.objects.values('cost_pool_id', 'invoice_line_id')
+        .annotate(current_id=models.Max('id')).values('current_id')
+    )
+    return AllocatedCost.objects.exclude(pk__in=current)
+
+
+ALLOCATION_MODES = ('kernel', 'database', 'streaming')
+ALLOCATION_STORAGES = ('rows', 'packed')
+
+
+def line_weight(method):
+    """Database expression for a line's allocation weight under ``method``, or ``None`` for EQUALLY."""
+    if method in PRICE_METHODS:
+        return models.ExpressionWrapper(F('price_vendor') * F('quantity'), output_field=models.DecimalField())
+    if method == CostPool.Method.VOLUME:
+        return models.ExpressionWrapper(F('unit_volume_cc') * F('quantity'), output_field=models.FloatField())
+    if method == CostPool.Method.QUANTITY:
+        return F('quantity')
+    return None
+
+
 class AllocationService:
 
-    def compute_normalizers(self, scope, method, queryset):
-        if method == CostPool.Method.PRICE:
-            return sum(line.price_vendor * line.quantity for line in queryset)
-        elif method == CostPool.Method.VOLUME:
-            return Decimal(sum(line.unit_volume_cc * line.quantity for line in queryset))
-        elif method == CostPool.Method.QUANTITY:
-            return Decimal(sum(line.quantity for line in queryset))
-        elif method == CostPool.Method.PRICE_QUANTITY:
-            return sum(line.price_vendor * line.quantity for line in queryset)
-        return Decimal(0)
+    def __init__(self, mode=None, storage=None):
+        self.mode = mode or settings.COGS_ALLOCATION_MODE
+        self.storage = storage or settings.COGS_ALLOCATION_STORAGE
+        if self.mode not in ALLOCATION_MODES:
+            raise ValueError(f'Unknown allocation mode {self.mode!r}; expected one of {ALLOCATION_MODES}.')
+        if self.storage not in ALLOCATION_STORAGES:
+            raise ValueError(f'Unknown allocation storage {self.storage!r}; expected one of {ALLOCATION_STORAGES}.')
+        if self.mode in ('database', 'streaming') and self.storage == 'packed':
+            raise ValueError(f"The {self.mode!r} allocation mode writes rows; it cannot use 'packed' storage.")
 
-    def allocate_cost(self, cost_pool):
-        if cost_pool.scope == CostPool.Scope.INVOICE:
-            if cost_pool.invoice:
-                lines = InvoiceLine.objects.filter(invoice=cost_pool.invoice)
-            else:
-                lines = InvoiceLine.objects.all()
-        elif cost_pool.scope == CostPool.Scope.CONTAINER:
-            if cost_pool.container:
-                lines = InvoiceLine.objects.filter(invoice__container=cost_pool.container)
+    def lines_for_pool(self, cost_pool):
+        """The invoice lines ``cost_pool`` is spread over, according to its scope."""
+        if cost_pool.scope == CostPool.Scope.INVOICE and cost_pool.invoice_id:
+            return InvoiceLine.objects.filter(invoice_id=cost_pool.invoice_id)
+        if cost_pool.scope == CostPool.Scope.CONTAINER and cost_pool.container_id:
+            return InvoiceLine.objects.filter(invoice__container_id=cost_pool.container_id)
+        return InvoiceLine.objects.all()
+
+    def lines_for_pools(self, pools):
+        """One queryset covering the lines of every pool in ``pools``."""
+        invoices, containers = set(), set()
+        for pool in pools:
+            if pool.scope == CostPool.Scope.INVOICE and pool.invoice_id:
+                invoices.add(pool.invoice_id)
+            elif pool.scope == CostPool.Scope.CONTAINER and pool.container_id:
+                containers.add(pool.container_id)
             else:
-                lines = InvoiceLine.objects.all()
-        else: # ALL
-            lines = InvoiceLine.objects.all()
+                # The pool spans every line.
+                return InvoiceLine.objects.all()
+        if len(invoices) + len(containers) > LINE_FILTER_MAX_KEYS:
+            # Scanning the table beats a huge IN list.
+            return InvoiceLine.objects.all()
+        return InvoiceLine.objects.filter(
+            models.Q(invoice_id__in=invoices) | models.Q(invoice__container_id__in=containers)
+        )
 
-        normalizer = self.compute_normalizers(cost_pool.scope, cost_pool.method, lines)
+    def allocate_cost(self, cost_pool):
+        """Spread ``cost_pool.amount_total`` over its lines and store the ``AllocatedCost`` rows.
 
+        The shares are computed by the vectorized kernel in
+        ``cogs.allocation``: amounts rounded half-even to the cent, with the
+        rounding difference on the largest allocation.  When the weights sum
+        to zero (and for EQUALLY) the amount is split equally.
+        """
+        self.allocate_pools([cost_pool])
+
+    @transaction.atomic
+    def allocate_pools(self, pools, lock=True):
+        """Allocate every pool in ``pools`` in one pass; same rows as ``allocate_cost`` per pool.
+
+        The lines of all pools are loaded once as columns, each pool picks
+        its lines by scope and the ``AllocatedCost`` rows of all pools are
+        inserted together in large chunks, or with ``packed`` storage one
+        ``PackedAllocation`` per pool.  A pool's previous allocation, in
+        either storage, is deleted in the same transaction, so reallocating
+        replaces it instead of adding another copy, and the pools' ``POOL``
+        marks (see ``cogs.dirty``) are cleared.  The pools' scopes are
+        locked first (see ``cogs.locks``), unless the caller already holds
+        the locks and passes ``lock=False``.  In ``streaming`` mode the pools
+        spanning every line are allocated by ``allocate_streaming`` instead.
+        """
+        pools = list(pools)
+        if not pools:
+            return
+        if lock:
+            locks.lock_scopes(pools)
+        pool_ids = [pool.pk for pool in pools]
+        dirty.clear(dirty.Kind.POOL, [pool.pk for pool in pools if not pool.auto_compute])
+        for start in range(0, len(pool_ids), LOOKUP_CHUNK_SIZE):
+            chunk = pool_ids[start:start + LOOKUP_CHUNK_SIZE]
+            AllocatedCost.objects.filter(cost_pool_id__in=chunk).delete()
+            PackedAllocation.objects.filter(cost_pool_id__in=chunk).delete()
+        if self.mode == 'database':
+            for pool in pools:
+                self.allocate_in_database(pool)
+            return
+        if self.mode == 'streaming':
+            for pool in pools:
+                if spans_every_line(pool):
+                    self.allocate_streaming(pool)
+            pools = [pool for pool in pools if not spans_every_line(pool)]
+        if self.storage == 'packed':
+            PackedAllocation.objects.bulk_create(
+                (PackedAllocation(cost_pool_id=pool.pk, line_count=len(line_ids),
+                                  data=pack(line_ids, allocation_cents(allocation)))
+                 for pool, line_ids, allocation in self.iter_allocations(pools)),
+                batch_size=PACKED_BATCH_SIZE,
+            )
+            return
+        pending = []
+        for pool, line_ids, allocation in self.iter_allocations(pools):
+            pending.extend(
+                AllocatedCost(cost_pool_id=pool.pk, invoice_line_id=line_id, amount_allocated=amount)
+                for line_id, amount in zip(line_ids.tolist(), allocation.amounts())
+            )
+            if len(pending) >= ALLOCATION_FLUSH_ROWS:
+                AllocatedCost.objects.bulk_create(pending, batch_size=ALLOCATION_BATCH_SIZE)
+                pending = []
+        AllocatedCost.objects.bulk_create(pending, batch_size=ALLOCATION_BATCH_SIZE)
+
+    def iter_allocations(self, pools):
+        """Yield ``(pool, line_ids, allocation)`` for each pool with lines, computed in memory.
+
+        ``line_ids`` is an ascending int64 array and ``allocation`` a
+        ``cogs.allocation.Allocation`` in the same order.  ``pools`` need
+        not be saved; nothing is written.
+        """
+        methods = {pool.method for pool in pools}
+        lines = LineColumns(
+            self.lines_for_pools(pools),
+            price=bool(methods & set(PRICE_METHODS)),
+            volume=CostPool.Method.VOLUME in methods,
+        )
+        for pool in pools:
+            positions = lines.positions(pool)
+            if not len(positions):
+                continue
+            allocation = allocate(
+                pool.amount_total, pool.method, lines.quantity[positions],
+                price=lines.price[positions] if pool.method in PRICE_METHODS else None,
+                volume=lines.volume[positions] if pool.method == CostPool.Method.VOLUME else None,
+            )
+            yield pool, lines.ids[positions], allocation
+
+    def what_if(self, pools=(), rate_overrides=None, lines=None):
+        """Results rows (see ``cogs.landed``) as they would be with ``pools`` added; nothing is written.
+
+        ``pools`` are unsaved ``CostPool`` instances; one whose ``pk`` is
+        set stands in for that stored pool, e.g. a new quote for the
+        existing "Freight Cost" pool.  ``rate_overrides`` maps HTS codes to
+        the rate (percent) to assume.  ``lines`` narrows the rows returned,
+        like the results page filters; the hypothetical pools are still
+        spread over all the lines of their scope.
+        """
+        pools = list(pools)
+        queryset = (InvoiceLine.objects.all() if lines is None else lines).order_by('pk')
+        lines = load_lines(queryset)
+        line_ids = {line.pk for line in lines}
+        replaced = {pool.pk for pool in pools if pool.pk}
+        names = dict(CostPool.objects.exclude(pk__in=replaced).values_list('pk', 'name'))
+        rows = [
+            (line_id, names[pool_id], amount)
+            for line_id, pool_id, amount in allocation_rows(queryset, exclude_pools=replaced)
+            if pool_id in names
+        ]
+        for pool, pool_line_ids, allocation in self.iter_allocations(pools):
+            # Rounded as saving them would.
+            rows.extend((line_id, pool.name, amount)
+                        for line_id, amount in zip(pool_line_ids.tolist(), to_decimals(allocation_cents(allocation)))
+                        if line_id in line_ids)
+        return landed_cost_rows(lines, group_allocations(rows), rate_overrides)
+
+    def allocate_in_database(self, pool):
+        """Allocate ``pool`` without reading its lines into Python (``COGS_ALLOCATION_MODE = 'database'``).
+
+        One aggregate query gives the normalizer, one ``INSERT ... SELECT``
+        writes every line's share rounded half-even to the cent, and the
+        rounding difference is added to the largest row (lowest line id on
+        ties), as in ``cogs.allocation``.  The arithmetic is the database's:
+        exact numeric on PostgreSQL, float on SQLite, where a line lying
+        within float error of a half cent may round the other way.
+        """
+        lines = self.lines_for_pool(pool)
+        weight = line_weight(pool.method)
+        totals = lines.aggregate(count=models.Count('id'), **({'normalizer': models.Sum(weight)} if weight else {}))
+        if not totals['count']:
+            return
+        normalizer = totals.get('normalizer') or 0
+        if normalizer == 0:
+            # EQUALLY, or no weight to go by: equal unrounded shares, no penny fix.
+            amount = Value((pool.amount_total / totals['count']).quantize(CENT), output_field=models.DecimalField())
+        else:
+            if connection.vendor == 'sqlite':
+                # SQLite stores the Decimal parameters as integers when they are
+                # whole, which would make the division an integer division.
+                normalizer = float(normalizer)
+            share = models.ExpressionWrapper(
+                weight * Value(pool.amount_total * 100) / Value(normalizer), output_field=models.FloatField())
+            lines = lines.annotate(share=share).annotate(whole=Floor('share')).annotate(
+                fraction=F('share') - F('whole'), odd=Mod('whole', 2))
+            half_up = models.Case(
+                models.When(fraction__gt=0.5, then=1),
+                models.When(models.Q(fraction=0.5) & ~models.Q(odd=0), then=1),
+                default=0,
+            )
+            amount = models.ExpressionWrapper((F('whole') + half_up) / Value(100), output_field=models.DecimalField())
+        select, params = lines.annotate(amount=amount).values_list('id', 'amount').query.sql_with_params()
+        quote = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {quote(AllocatedCost._meta.db_table)} '
+                f'({quote("cost_pool_id")}, {quote("invoice_line_id")}, {quote("amount_allocated")}) '
+                f'SELECT %s, allocation.id, allocation.amount FROM ({select}) allocation',
+                (pool.pk, *params),
+            )
         if normalizer == 0:
-            # Allocate equally if normalizer is zero
-            if lines.count() > 0:
-                amount_per_line = cost_pool.amount_total / lines.count()
-                for line in lines:
-                    AllocatedCost.objects.create(
-                        cost_pool=cost_pool,
-                        invoice_line=line,
-                        amount_allocated=amount_per_line
-                    )
             return
 
-        allocations = []
-        for line in lines:
-            if cost_pool.method == CostPool.Method.PRICE:
-                share = (line.price_vendor * line.quantity) / normalizer
-            elif cost_pool.method == CostPool.Method.VOLUME:
-                share = Decimal(line.unit_volume_cc * line.quantity) / normalizer
-            elif cost_pool.method == CostPool.Method.QUANTITY:
-                share = Decimal(line.quantity) / normalizer
-            elif cost_pool.method == CostPool.Method.PRICE_QUANTITY:
-                share = (line.price_vendor * line.quantity) / normalizer
+        rows = AllocatedCost.objects.filter(cost_pool_id=pool.pk)
+        residual = pool.amount_total - (rows.aggregate(total=models.Sum('amount_allocated'))['total'] or 0)
+        if residual:
+            largest = rows.order_by('-amount_allocated', 'invoice_line_id').values_list('pk', 'amount_allocated')[0]
+            rows.filter(pk=largest[0]).update(amount_allocated=(largest[1] + residual).quantize(CENT))
+
+    def allocate_streaming(self, pool):
+        """Allocate ``pool`` a chunk of lines at a time (``COGS_ALLOCATION_MODE = 'streaming'``).
+
+        Stores the same rows as the kernel, but never holds more than
+        ``ALLOCATION_STREAM_CHUNK_SIZE`` lines, so memory stays flat however
+        many lines the pool spans.  The first pass gets the line count and
+        normalizer from the database; the second reads the lines in id
+        order with a chunked iterator, rounds each chunk with
+        ``cogs.allocation.allocate_cents`` and inserts its rows before
+        reading the next, keeping only the running total and the largest
+        row.  The rounding difference is then added to that row with one
+        update.
+        """
+        lines = self.lines_for_pool(pool).order_by('id')
+        count, normalizer = self._stream_normalizer(lines, pool.method)
+        if not count:
+            return
+        to_decimal = weight_to_decimal(pool.method)
+        weighted = pool.method in WEIGHTED_METHODS and to_decimal(normalizer) != 0
+        columns = ['id', 'quantity']
+        if pool.method in PRICE_METHODS:
+            # Float, as LineColumns reads it.
+            columns.append(Cast('price_vendor', models.FloatField()))
+        elif pool.method == VOLUME:
+            columns.append('unit_volume_cc')
+        rows = lines.values_list(*columns).iterator(chunk_size=ALLOCATION_STREAM_CHUNK_SIZE)
+        total_cents, largest = 0, None
+        while chunk := list(islice(rows, ALLOCATION_STREAM_CHUNK_SIZE)):
+            line_ids, quantity, *rest = zip(*chunk)
+            if weighted:
+                weights, _, _ = line_weights(
+                    pool.method, quantity,
+                    price=rest[0] if pool.method in PRICE_METHODS else None,
+                    volume=rest[0] if pool.method == VOLUME else None,
+                )
+                cents = allocate_cents(pool.amount_total, weights, normalizer, to_decimal).tolist()
+                total_cents += sum(cents)
+                top = max(range(len(cents)), key=cents.__getitem__)
+                # The first largest row overall, as the kernel picks it.
+                if largest is None or cents[top] > largest[0]:
+                    largest = (cents[top], line_ids[top])
+                amounts = [Decimal(amount) * CENT for amount in cents]
             else:
-                share = Decimal(0)
-            
-            amount = cost_pool.amount_total * share
-            allocations.append(AllocatedCost(cost_pool=cost_pool, invoice_line=line, amount_allocated=amount))
+                # EQUALLY, or no weight to go by: equal unrounded shares, no penny fix.
+                amounts = [pool.amount_total / count] * len(line_ids)
+            AllocatedCost.objects.bulk_create(
+                (AllocatedCost(cost_pool_id=pool.pk, invoice_line_id=line_id, amount_allocated=amount)
+                 for line_id, amount in zip(line_ids, amounts)),
+                batch_size=ALLOCATION_BATCH_SIZE,
+            )
+        residual = pool.amount_total - Decimal(total_cents) * CENT
+        if weighted and residual:
+            AllocatedCost.objects.filter(cost_pool_id=pool.pk, invoice_line_id=largest[1]).update(
+                amount_allocated=Decimal(largest[0]) * CENT + residual)
 
-        self.round_and_fix_pennies(cost_pool.amount_total, allocations)
+    @staticmethod
+    def _stream_normalizer(lines, method):
+        """``(count, normalizer)`` of ``lines`` under ``method``, equal to the kernel's.
 
-        AllocatedCost.objects.bulk_create(allocations)
+        One aggregate query, except for VOLUME: the kernel sums its float
+        weights in line order and a database sum may round differently, so
+        the volumes are summed here a chunk at a time.
+        """
+        if method in PRICE_METHODS:
+            # Whole cents times quantity, an exact integer as in the kernel.
+            weight = models.ExpressionWrapper(
+                Cast(Round(F('price_vendor') * 100), models.BigIntegerField()) * F('quantity'),
+                output_field=models.BigIntegerField(),
+            )
+        elif method in WEIGHTED_METHODS and method != VOLUME:
+            weight = F('quantity')
+        else:
+            weight = None
+        totals = lines.aggregate(count=models.Count('id'), **({'normalizer': models.Sum(weight)} if weight else {}))
+        if method != VOLUME:
+            return totals['count'], totals.get('normalizer') or 0
+        rows = lines.values_list('quantity', 'unit_volume_cc').iterator(chunk_size=ALLOCATION_STREAM_CHUNK_SIZE)
+        normalizer = 0
+        while chunk := list(islice(rows, ALLOCATION_STREAM_CHUNK_SIZE)):
+            quantity, volume = zip(*chunk)
+            weights, _, _ = line_weights(method, quantity, volume=volume)
+            normalizer = sum(weights.tolist(), normalizer)
+        return totals['count'], normalizer
 
-    def compute_htsus_for_invoice(self, invoice):
-        """Calculate HTSUS tariffs with support for country-specific rates"""
+    @transaction.atomic
+    def recalculate_all(self):
+        """Reallocate every manual cost pool and recompute HTSUS for every invoice.
 
-        htsus_cost_pool, created = CostPool.objects.get_or_create(
-            invoice=invoice,
-            name="HTSUS Tariff",
-            defaults={
-                'scope': CostPool.Scope.INVOICE,
-                'method': CostPool.Method.PRICE,
-                'auto_compute': True,
-                'amount_total': Decimal(0)
-            }
-        )
+        HTSUS totals are computed for all invoices from one pass over the
+        lines, then the manual and HTSUS pools are allocated together by
+        ``allocate_pools``.
+        """
+        # Everything is rewritten, so lock the root rather than every scope.
+        locks.lock_all()
+        pools = list(CostPool.objects.filter(auto_compute=False))
+        htsus_pools = self.compute_htsus_pools(Invoice.objects.all(), lock=False)
+        self.allocate_pools(pools + htsus_pools, lock=False)
+        return {'pools': len(pools), 'invoices': len(htsus_pools)}
 
-        # Get country code if Entry is linked
-        country_code = None
-        if getattr(invoice, 'entry', None):
-            country_code = invoice.entry.country_origin
+    @transaction.atomic
+    def compute_htsus_for_invoice(self, invoice):
+        """Calculate HTSUS tariffs with support for country-specific rates"""
+        self.allocate_pools(self.compute_htsus_pools([invoice]), lock=False)
 
-        total_tariff = Decimal(0)
+    def compute_htsus_pools(self, invoices, lock=True):
+        """Set the "HTSUS Tariff" pool total of each invoice; return the pools, not yet allocated.
 
-        for line in invoice.lines.all():
-            # Rate determination logic
-            if not invoice.apply_db_htsus_rate and invoice.manual_htsus_rate_pct is not None:
-                # Manual override at invoice level
-                rate = invoice.manual_htsus_rate_pct
-            else:
-                # Check SKU level first
-                if line.sku.htsus_rate_pct is not None:
-                    rate = line.sku.htsus_rate_pct
-                elif line.sku.htsus_code:
-                    # Use HTS code rate
-                    hts = line.sku.htsus_code
-
-                    # Check if complex rates exist and country is known
-                    if getattr(hts, 'has_complex_rates', False) and country_code:
-                        # Get country-specific rate
-                        rate = self._get_complex_rate(hts, country_code, invoice.invoice_date)
-                    else:
-                        # Use simple rate
-                        rate = hts.rate_pct if hts.rate_pct else Decimal(0)
+        Pools are created where missing.  Lines are read in chunks of
+        invoices and rated from a ``RateContext`` loaded per chunk, so the
+        query count does not grow with the number of lines.  The invoices'
+        ``TARIFF`` marks (see ``cogs.dirty``) are cleared.  Call it inside a
+        transaction: the invoices are locked (see ``cogs.locks``) until the
+        pools are allocated, unless ``lock=False`` says the caller holds the
+        locks already.
+        """
+        invoices = list(invoices.select_related('entry') if hasattr(invoices, 'select_related') else invoices)
+        if not invoices:
+            return []
+        totals = {invoice.pk: Decimal(0) for invoice in invoices}
+        by_id = {invoice.pk: invoice for invoice in invoices}
+        ids = list(by_id)
+        if lock:
+            locks.lock_scopes(invoice_ids=ids)
+        to_date = Invoice._meta.get_field('invoice_date').to_python
+        for start in range(0, len(ids), LOOKUP_CHUNK_SIZE):
+            chunk = ids[start:start + LOOKUP_CHUNK_SIZE]
+            lines = list(InvoiceLine.objects.filter(invoice_id__in=chunk).values_list(
+                'invoice_id', 'sku_id', 'quantity', 'price_vendor'))
+            # Country-specific rates need the country of the linked Entry
+            countries = {pk: by_id[pk].entry.country_origin if by_id[pk].entry_id else None for pk in chunk}
+            rates = RateContext.load({line[1] for line in lines})
+            for invoice_id, sku_id, quantity, price_vendor in lines:
+                invoice = by_id[invoice_id]
+                if not invoice.apply_db_htsus_rate and invoice.manual_htsus_rate_pct is not None:
+                    # Manual override at invoice level
+                    rate = invoice.manual_htsus_rate_pct
                 else:
-                    # No HTS code assigned
-                    rate = Decimal(0)
-
-            # Calculate tariff amount
-            tariff_amount = (line.price_vendor * line.quantity) * (rate / Decimal(100))
-            total_tariff += tariff_amount
-
-        htsus_cost_pool.amount_total = total_tariff
-        htsus_cost_pool.save()
-        self.allocate_cost(htsus_cost_pool)
-
-    def _get_complex_rate(self, hts_code, country_code, invoice_date):
-        """Get complex rate from HTSRateDetail for specific country and date"""
-
-        from cogs.models import HTSRateDetail
-
-        # Find applicable rate detail
-        rate_details = HTSRateDetail.objects.filter(
-            hts_code=hts_code,
-            country_code__in=[country_code, ''],  # Country-specific or global
-            effective_from__lte=invoice_date
-        ).filter(
-            models.Q(effective_to__gte=invoice_date) | models.Q(effective_to__isnull=True)
-        ).order_by('-country_code', '-effective_from')  # Prefer country-specific
-
-        if rate_details.exists():
-            detail = rate_details.first()
-
-            # For now, return only ad valorem rate
-            # TODO: Add support for specific duties and compound rates
-            return detail.adval_pct if detail.adval_pct else Decimal(0)
-
-        # Fallback to simple rate
-        return hts_code.rate_pct if hts_code.rate_pct else Decimal(0)
-
-    def round_and_fix_pennies(self, total_amount, allocations):
-        total_allocated = Decimal(0)
-        for alloc in allocations:
-            alloc.amount_allocated = round(alloc.amount_allocated, 2)
-            total_allocated += alloc.amount_allocated
-
-        rounding_diff = total_amount - total_allocated
-        if rounding_diff != Decimal(0) and allocations:
-            allocations.sort(key=lambda x: x.amount_allocated, reverse=True)
-            allocations[0].amount_allocated += rounding_diff
+                    rate = rates.rate(sku_id, countries[invoice_id], to_date(invoice.invoice_date))
+                totals[invoice_id] += (price_vendor * quantity) * (rate / Decimal(100))
+
+        pools = {}
+        for pool in fetch_values_in(CostPool.objects.filter(name="HTSUS Tariff").order_by('pk'), 'invoice_id', ids):
+            pools.setdefault(pool.invoice_id, pool)
+        missing = [
+            CostPool(invoice_id=pk, name="HTSUS Tariff", scope=CostPool.Scope.INVOICE,
+                     method=CostPool.Method.PRICE, auto_compute=True, amount_total=Decimal(0))
+            for pk in ids if pk not in pools
+        ]
+        for pool in CostPool.objects.bulk_create(missing, batch_size=ALLOCATION_BATCH_SIZE):
+            pools[pool.invoice_id] = pool
+        for pk, pool in pools.items():
+            pool.amount_total = totals[pk]
+        CostPool.objects.bulk_update(pools.values(), ['amount_total'], batch_size=ALLOCATION_BATCH_SIZE)
+        dirty.clear(dirty.Kind.TARIFF, ids)
+        return [pools[pk] for pk in ids]
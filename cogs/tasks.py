@@ -0,0 +1,182 @@
+"""Background job handlers for the cogs app (registered in cogs.jobs)."""
+import zipfile
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+
+from .archive import ArchiveRejected, ingest_archive, list_members
+from .hts_delta import import_schedule
+from .ingestion import InvoiceIngestor
+from .jobs import JobError, report_progress
+from .recalc import recalculate_dirty, recalculate_partitioned
+from .readers import is_blank, iter_csv_batches, iter_table_dicts
+from .uploads import duplicate_result, fingerprint_archive, fingerprint_file, previous_upload, record_upload
+from .validation import MAX_REPORTED_ERRORS, validate_invoice_file
+
+
+def _invoice_upload_salt(payload):
+    # Upload options that change the outcome are part of the fingerprint.
+    salt = payload.get('country_origin') or ''
+    return f'{salt}\x00replace' if payload.get('replace_lines') else salt
+
+
+def process_invoice_upload(job):
+    payload = job.payload
+    ingestor = InvoiceIngestor(country_origin=payload.get('country_origin'),
+                               replace_lines=payload.get('replace_lines', False))
+
+    with default_storage.open(payload['files'][0], 'rb') as upload:
+        sha256 = fingerprint_file(upload, payload['file_name'], salt=_invoice_upload_salt(payload))
+        previous = previous_upload(job.kind, sha256)
+        if previous:
+            return duplicate_result(previous)
+
+        # Reject the whole file before writing anything if any row is bad.
+        report_progress(job, 0, None, 'Validating file')
+        report = validate_invoice_file(upload)
+        if not report.is_valid:
+            raise JobError(
+                f'{len(report.errors)} problem(s) found in {report.rows} rows; nothing was imported',
+                result=report.as_result(),
+            )
+        upload.seek(0)
+
+        def batches():
+            rows = 0
+            for batch in iter_csv_batches(upload):
+                yield batch
+                rows += len(batch)
+                report_progress(job, upload.tell(), upload.size, f'{rows} rows imported')
+
+        with transaction.atomic():
+            result = ingestor.ingest_batches(batches())
+            message = f'Invoice uploaded successfully: {result.lines_created} lines'
+            if result.lines_unchanged or result.lines_deleted:
+                message += (f' added, {result.lines_unchanged} unchanged, '
+                            f'{result.lines_deleted} removed')
+            summary = {
+                'message': f'{message} ({result.rows_per_sec:,.0f} rows/sec)',
+                'rows': result.rows,
+                'lines_created': result.lines_created,
+                'lines_unchanged': result.lines_unchanged,
+                'lines_deleted': result.lines_deleted,
+                'rows_per_sec': round(result.rows_per_sec, 1),
+            }
+            record_upload(job.kind, sha256, payload['file_name'], summary, job=job)
+
+    return summary
+
+
+def process_invoice_archive(job):
+    payload = job.payload
+    file_name = payload['file_name']
+
+    with default_storage.open(payload['files'][0], 'rb') as upload:
+        try:
+            archive = zipfile.ZipFile(upload)
+            names, skipped = list_members(archive)
+            sha256 = fingerprint_archive(archive, names, salt=_invoice_upload_salt(payload))
+        except zipfile.BadZipFile as e:
+            raise JobError(f'{file_name} is not a valid zip archive ({e})')
+
+        with archive:
+            if not names:
+                raise JobError(f'{file_name} contains no CSV files')
+            previous = previous_upload(job.kind, sha256)
+            if previous:
+                return duplicate_result(previous)
+            skipped_files = [{'file': name, 'rows': 0, 'status': 'skipped'} for name in skipped]
+
+            def progress(done, total):
+                report_progress(job, done, total, f'{done} of {total} files processed')
+
+            with transaction.atomic():
+                try:
+                    files, result = ingest_archive(
+                        archive, names, payload.get('country_origin'), settings.COGS_ARCHIVE_WORKERS, progress,
+                        replace_lines=payload.get('replace_lines', False),
+                    )
+                except ArchiveRejected as e:
+                    raise JobError(
+                        f'{e}; nothing was imported',
+                        result={
+                            'files': e.files + skipped_files,
+                            'error_count': len(e.errors),
+                            'errors': e.errors[:MAX_REPORTED_ERRORS],
+                        },
+                    )
+                summary = {
+                    'message': f'{len(files)} invoice files uploaded: {result.lines_created} lines added,'
+                               f' {result.lines_unchanged} unchanged, {result.lines_deleted} removed'
+                               f' ({result.rows_per_sec:,.0f} rows/sec)',
+                    'files': files + skipped_files,
+                    'rows': result.rows,
+                    'lines_created': result.lines_created,
+                    'lines_unchanged': result.lines_unchanged,
+                    'lines_deleted': result.lines_deleted,
+                    'rows_per_sec': round(result.rows_per_sec, 1),
+                }
+                record_upload(job.kind, sha256, file_name, summary, job=job)
+
+    return summary
+
+
+def process_htsus_upload(job):
+    payload = job.payload
+    file_name = payload['file_name']
+    retire_missing = payload.get('retire_missing', False)
+
+    with default_storage.open(payload['files'][0], 'rb') as upload:
+        sha256 = fingerprint_file(upload, file_name, salt='full' if retire_missing else '')
+        previous = previous_upload(job.kind, sha256)
+        if previous:
+            return duplicate_result(previous)
+        def rows():
+            for index, row in enumerate(iter_table_dicts(upload, file_name), start=1):
+                if index % 1000 == 0:
+                    report_progress(job, upload.tell(), upload.size, f'{index} rows read')
+                code = str(row.get('code', '') or '').strip()
+                if not code:
+                    continue
+                description = row.get('description', '')
+                rate_pct = row.get('rate_pct', 0)
+                try:
+                    rate_pct = None if is_blank(rate_pct) else Decimal(str(rate_pct).strip())
+                except InvalidOperation:
+                    raise JobError(f"Invalid rate_pct '{rate_pct}' for code {code}")
+                yield {
+                    'code': code,
+                    'description': '' if is_blank(description) else str(description),
+                    'rate_pct': rate_pct,
+                }
+
+        with transaction.atomic():
+            delta = import_schedule(rows(), retire_missing=retire_missing)
+            summary = {
+                'message': f'Successfully imported {delta.created} new codes and updated {delta.updated} existing codes'
+                           f' ({delta.unchanged} unchanged, {delta.retired} retired, {delta.restored} restored);'
+                           f' {len(delta.changes)} rate changes',
+                **delta.as_result(),
+            }
+            record_upload(job.kind, sha256, file_name, summary, job=job)
+
+    return summary
+
+
+def recalculate_costs(job):
+    if job.payload.get('full'):
+        # Each partition commits on its own; see cogs.recalc.
+        counts = recalculate_partitioned(
+            progress=lambda done, total: report_progress(job, done, total, 'Recalculating containers'),
+        )
+        return {'message': 'Costs recalculated successfully', **counts}
+
+    # Only what changed since the last recalculation; see cogs.dirty.
+    counts = recalculate_dirty()
+    return {
+        'message': f"Costs recalculated: {counts['pools']} cost pools and {counts['invoices']} invoice tariffs"
+                   f" updated, {counts['skipped_pools']} pools and {counts['skipped_invoices']} invoices unchanged",
+        **counts,
+    }
@@ -0,0 +1,79 @@
+"""Fixtures shared by the test modules of the cogs app."""
+import random
+import pytest
+from decimal import Decimal
+from cogs.models import Container, CostPool, HTSUSCode, Invoice, InvoiceLine, SKU
+
+
+@pytest.fixture
+def job_storage(settings, tmp_path):
+    """Files saved for jobs go to a temporary ``MEDIA_ROOT``, which is returned."""
+    settings.MEDIA_ROOT = tmp_path
+    return tmp_path
+
+
+@pytest.fixture
+def eager_jobs(settings, job_storage):
+    """Jobs run as soon as they are enqueued, with their files in ``job_storage``."""
+    settings.COGS_JOBS_EAGER = True
+    return job_storage
+
+
+@pytest.fixture
+def vessel():
+    sku = SKU.objects.create(sku='SKU1', htsus_rate_pct=Decimal('5'))
+    containers = [Container.objects.create(container_id=f'C{n}') for n in range(5)]
+    invoices = []
+    for n in range(12):
+        invoice = Invoice.objects.create(invoice_number=f'I{n}', invoice_date='2023-01-01',
+                                         container=containers[n % 5] if n < 10 else None)
+        for q in range(1, n % 4 + 2):
+            InvoiceLine.objects.create(invoice=invoice, sku=sku, quantity=q, price_vendor=Decimal('9.99') * q,
+                                       total_vendor=Decimal('9.99') * q * q, unit_volume_cc=q)
+        invoices.append(invoice)
+    empty = Container.objects.create(container_id='EMPTY')
+    pools = [
+        CostPool.objects.create(name='Freight', scope=CostPool.Scope.CONTAINER, method='VOLUME',
+                                container=container, amount_total=Decimal('100.00'))
+        for container in containers + [empty]
+    ]
+    pools += [
+        CostPool.objects.create(name='Broker', scope=CostPool.Scope.INVOICE, method='EQUALLY',
+                                invoice=invoice, amount_total=Decimal('25.00'))
+        for invoice in (invoices[0], invoices[11])
+    ]
+    pools.append(CostPool.objects.create(name='Insurance', scope=CostPool.Scope.ALL, method='PRICE',
+                                         amount_total=Decimal('77.77')))
+    pools.append(CostPool.objects.create(name='Orphan', scope=CostPool.Scope.CONTAINER, method='QUANTITY',
+                                         amount_total=Decimal('1.00')))
+    return invoices, pools
+
+
+@pytest.fixture
+def shipment():
+    rng = random.Random(3)
+    codes = [HTSUSCode.objects.create(code=f'0101.{n}', rate_pct=Decimal(rate))
+             for n, rate in enumerate(['2.5', '7', '0'])]
+    skus = [SKU.objects.create(sku=f'SKU{n}', htsus_code=codes[n % 3]) for n in range(6)]
+    skus.append(SKU.objects.create(sku='OVERRIDE', htsus_rate_pct=Decimal('12.5')))
+    containers = [Container.objects.create(container_id=f'C{n}') for n in range(3)]
+    invoices = []
+    for n in range(8):
+        invoice = Invoice.objects.create(invoice_number=f'I{n}', invoice_date='2023-01-01',
+                                         container=containers[n % 3])
+        for _ in range(rng.randint(1, 12)):
+            quantity, price = rng.randint(1, 300), Decimal(rng.randint(1, 50_000)).scaleb(-2)
+            InvoiceLine.objects.create(invoice=invoice, sku=rng.choice(skus), quantity=quantity, price_vendor=price,
+                                       total_vendor=price * quantity, unit_volume_cc=rng.uniform(1, 900))
+        invoices.append(invoice)
+    invoices[1].apply_db_htsus_rate = False
+    invoices[1].manual_htsus_rate_pct = Decimal('3.3')
+    invoices[1].save()
+    pools = [CostPool.objects.create(name='Freight', scope=CostPool.Scope.CONTAINER, method=method,
+                                     container=container, amount_total=Decimal('987.65'))
+             for container, method in zip(containers, ['VOLUME', 'QUANTITY', 'PRICE_QUANTITY'])]
+    pools.append(CostPool.objects.create(name='Broker', scope=CostPool.Scope.INVOICE, method='EQUALLY',
+                                         invoice=invoices[2], amount_total=Decimal('100.00')))
+    pools.append(CostPool.objects.create(name='Insurance', scope=CostPool.Scope.ALL, method='PRICE',
+                                         amount_total=Decimal('55.55')))
+    return invoices, pools
@@ -0,0 +1,64 @@
+import random
+import pytest
+from decimal import Decimal
+from cogs.allocation import allocate, reference_allocation
+from cogs.models import AllocatedCost, Container, CostPool, Invoice, InvoiceLine, SKU
+from cogs.services import AllocationService
+
+METHODS = ['PRICE', 'PRICE_QUANTITY', 'VOLUME', 'QUANTITY', 'EQUALLY']
+
+
+def random_lines(rng, count):
+    quantity = [rng.randint(0, 500) for _ in range(count)]
+    price = [Decimal(rng.randint(0, 100_000)).scaleb(-2) for _ in range(count)]
+    volume = [rng.choice([0.0, 0.1, 1.5, rng.uniform(0, 5000)]) for _ in range(count)]
+    return quantity, price, volume
+
+
+@pytest.mark.parametrize('method', METHODS)
+@pytest.mark.parametrize('seed', range(25))
+def test_kernel_matches_per_line_allocation(method, seed):
+    rng = random.Random(seed)
+    quantity, price, volume = random_lines(rng, rng.choice([1, 2, 3, 7, 50, 400]))
+    totals = [Decimal(rng.randint(-10_000, 10_000_000)).scaleb(-2), Decimal('0.01'), Decimal('1.01'),
+              # Auto-computed HTSUS pools are allocated before their total is rounded.
+              Decimal(rng.randint(1, 10 ** 9)).scaleb(-6)]
+    for total in totals:
+        expected = reference_allocation(total, method, quantity, price, volume)
+        assert allocate(total, method, quantity, price, volume).amounts() == expected
+
+
+@pytest.mark.parametrize('method', ['PRICE', 'QUANTITY', 'VOLUME'])
+def test_exact_half_cents_round_half_even(method):
+    # Every line lands exactly on a half cent.
+    quantity, price, volume = [1] * 4, [Decimal('1.00')] * 4, [2.0] * 4
+    for total in [Decimal('0.02'), Decimal('0.06'), Decimal('1.01'), Decimal('-0.06')]:
+        allocation = allocate(total, method, quantity, price, volume)
+        assert allocation.amounts() == reference_allocation(total, method, quantity, price, volume)
+        assert sum(allocation.amounts()) == total
+
+
+def test_residual_goes_to_first_largest_line():
+    allocation = allocate(Decimal('100.00'), 'QUANTITY', [1, 1, 1])
+    assert allocation.amounts() == [Decimal('33.34'), Decimal('33.33'), Decimal('33.33')]
+
+
+@pytest.mark.django_db
+def test_allocate_cost_stores_kernel_amounts():
+    rng = random.Random(7)
+    container = Container.objects.create(container_id='C1')
+    invoice = Invoice.objects.create(invoice_number='I1', invoice_date='2023-01-01', container=container)
+    sku = SKU.objects.create(sku='SKU1')
+    quantity, price, volume = random_lines(rng, 60)
+    lines = InvoiceLine.objects.bulk_create(
+        InvoiceLine(invoice=invoice, sku=sku, quantity=q, price_vendor=p, total_vendor=p * q, unit_volume_cc=v)
+        for q, p, v in zip(quantity, price, volume)
+    )
+    service = AllocationService()
+    for method in METHODS:
+        pool = CostPool.objects.create(name=method, scope=CostPool.Scope.CONTAINER, method=method,
+                                       amount_total=Decimal('1234.57'), container=container)
+        service.allocate_cost(pool)
+        stored = dict(AllocatedCost.objects.filter(cost_pool=pool).values_list('invoice_line_id', 'amount_allocated'))
+        expected = reference_allocation(Decimal('1234.57'), method, quantity, price, volume)
+        assert [stored[line.pk] for line in lines] == [amount.quantize(Decimal('0.01')) for amount in expected]
@@ -0,0 +1,111 @@
+import io
+import zipfile
+import pytest
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.urls import reverse
+from cogs import jobs
+from cogs.archive import iter_parsed_members, list_members
+from cogs.models import Container, Invoice, InvoiceLine, Job, SKU
+
+HEADER = 'Invoice#,Invoice date,Container ID,PO#,SKU,Quantity,Price,Total,Volume\n'
+
+
+def make_zip(members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, content in members.items():
+            archive.writestr(name, content)
+    return buffer.getvalue()
+
+
+def invoice_csv(*rows):
+    return HEADER + ''.join(row + '\n' for row in rows)
+
+
+VESSEL = {
+    'vessel/I1.csv': invoice_csv('I1,2023-01-01,C1,PO1,SKU1,2,5.00,10.00,100',
+                                 'I1,2023-01-01,C1,PO1,SKU2,1,3.00,3.00,50'),
+    'vessel/I2.csv': invoice_csv('I2,2023-01-01,C1,PO2,SKU1,4,5.00,20.00,100'),
+    'vessel/I3.csv': invoice_csv('I3,2023-01-02,C2,PO3,SKU3,1,1.00,1.00,10'),
+    'vessel/readme.txt': 'not an invoice',
+    '__MACOSX/vessel/._I1.csv': 'resource fork',
+}
+
+
+@pytest.fixture(autouse=True)
+def one_archive_worker(settings):
+    settings.COGS_ARCHIVE_WORKERS = 1
+
+
+def upload(content, name='vessel.zip'):
+    saved = jobs.save_upload(SimpleUploadedFile(name, content))
+    return jobs.enqueue('invoice_archive_upload', {'file_name': name, 'country_origin': None, 'files': [saved]})
+
+
+def test_list_members_skips_metadata_and_other_files():
+    archive = zipfile.ZipFile(io.BytesIO(make_zip({**VESSEL, 'vessel/.hidden.csv': HEADER})))
+    assert list_members(archive) == (['vessel/I1.csv', 'vessel/I2.csv', 'vessel/I3.csv'], ['vessel/readme.txt'])
+
+
+@pytest.mark.django_db
+def test_parallel_parsing_keeps_archive_order():
+    names = [f'I{n}.csv' for n in range(6)]
+    archive = zipfile.ZipFile(io.BytesIO(make_zip({
+        name: invoice_csv(f'I{n},2023-01-01,C1,PO,SKU{n},{n + 1},1.00,{n + 1}.00,1') for n, name in enumerate(names)
+    })))
+    members = list(iter_parsed_members(archive, names, workers=2))
+    assert [member.name for member in members] == names
+    assert [member.parsed[0]['quantity'] for member in members] == [1, 2, 3, 4, 5, 6]
+
+
+@pytest.mark.django_db
+def test_archive_is_merged_into_one_import(eager_jobs):
+    job = upload(make_zip(VESSEL))
+
+    assert job.status == Job.Status.SUCCEEDED, job.error
+    assert [(f['file'], f['status'], f['rows']) for f in job.result['files']] == [
+        ('vessel/I1.csv', 'imported', 2),
+        ('vessel/I2.csv', 'imported', 1),
+        ('vessel/I3.csv', 'imported', 1),
+        ('vessel/readme.txt', 'skipped', 0),
+    ]
+    assert job.result['lines_created'] == 4
+    # Containers and SKUs shared between files are created once.
+    assert Container.objects.count() == 2
+    assert SKU.objects.count() == 3
+    assert Invoice.objects.count() == 3
+    assert InvoiceLine.objects.count() == 4
+
+    again = upload(make_zip(VESSEL), name='again.zip')
+    assert again.result['duplicate_of'] == job.pk
+
+
+@pytest.mark.django_db
+def test_one_bad_file_rejects_the_archive(eager_jobs):
+    members = {**VESSEL, 'vessel/I2.csv': invoice_csv('I2,2023-13-45,C1,PO2,SKU1,4,5.00,20.00,100')}
+    job = upload(make_zip(members))
+
+    assert job.status == Job.Status.FAILED
+    assert 'nothing was imported' in job.error
+    assert [f['status'] for f in job.result['files']] == ['valid', 'invalid', 'valid', 'skipped']
+    assert job.result['errors'][0]['file'] == 'vessel/I2.csv'
+    assert not Invoice.objects.exists()
+    assert not Container.objects.exists()
+
+
+@pytest.mark.django_db
+def test_upload_view_accepts_zip(client, eager_jobs):
+    response = client.post(reverse('invoice_upload'), {'file': SimpleUploadedFile('vessel.zip', make_zip(VESSEL))})
+    job = Job.objects.get()
+    assert job.kind == 'invoice_archive_upload'
+    assert response.status_code == 302 and response.url == reverse('job_detail', args=[job.pk])
+
+    page = client.get(response.url)
+    assert b'vessel/I3.csv' in page.content and b'skipped' in page.content
+
+
+@pytest.mark.django_db
+def test_not_a_zip_fails_cleanly(eager_jobs):
+    job = upload(b'definitely not a zip')
+    assert job.status == Job.Status.FAILED
+    assert 'not a valid zip archive' in job.error
@@ -0,0 +1,173 @@
+import io
+import pytest
+from decimal import Decimal
+from django.core.management import call_command
+from django.db import connection, models
+from django.test.utils import CaptureQueriesContext
+from cogs.allocation import reference_allocation
+from cogs.models import AllocatedCost, Container, CostPool, Invoice, InvoiceLine, SKU
+from cogs import services
+from cogs.services import AllocationService
+
+
+def expected_amounts(pool):
+    lines = list(AllocationService().lines_for_pool(pool).order_by('id'))
+    amounts = reference_allocation(
+        pool.amount_total, pool.method, [line.quantity for line in lines],
+        [line.price_vendor for line in lines], [line.unit_volume_cc for line in lines],
+    )
+    return {line.pk: amount.quantize(Decimal('0.01')) for line, amount in zip(lines, amounts)}
+
+
+def stored_amounts(pool):
+    return dict(AllocatedCost.objects.filter(cost_pool=pool).values_list('invoice_line_id', 'amount_allocated'))
+
+
+@pytest.mark.django_db
+def test_allocate_pools_matches_per_pool_allocation(shipment):
+    _, pools = shipment
+    AllocationService().allocate_pools(pools)
+    for pool in pools:
+        assert stored_amounts(pool) == expected_amounts(pool), pool.name
+
+
+@pytest.mark.django_db
+def test_recalculate_all_matches_per_invoice_htsus(shipment):
+    invoices, pools = shipment
+    service = AllocationService()
+    for invoice in invoices:
+        service.compute_htsus_for_invoice(invoice)
+    single = {pool.invoice_id: (pool.amount_total, stored_amounts(pool))
+              for pool in CostPool.objects.filter(name='HTSUS Tariff')}
+    AllocatedCost.objects.all().delete()
+
+    assert service.recalculate_all() == {'pools': len(pools), 'invoices': len(invoices)}
+    # Existing HTSUS pools are reused, not duplicated.
+    htsus = CostPool.objects.filter(name='HTSUS Tariff')
+    assert htsus.count() == len(invoices)
+    assert {pool.invoice_id: (pool.amount_total, stored_amounts(pool)) for pool in htsus} == single
+    for pool in pools:
+        assert stored_amounts(pool) == expected_amounts(pool), pool.name
+
+    manual = Invoice.objects.get(invoice_number='I1')
+    assert htsus.get(invoice=manual).amount_total == sum(
+        (line.price_vendor * line.quantity * Decimal('0.033') for line in manual.lines.all()), Decimal(0)
+    ).quantize(Decimal('0.01'))
+
+
+@pytest.mark.django_db
+def test_recalculate_all_query_count_does_not_grow_with_pools(shipment):
+    service = AllocationService()
+    service.recalculate_all()
+    with CaptureQueriesContext(connection) as small:
+        service.recalculate_all()
+
+    for n in range(20):
+        container = Container.objects.create(container_id=f'X{n}')
+        invoice = Invoice.objects.create(invoice_number=f'X{n}', invoice_date='2023-01-01', container=container)
+        InvoiceLine.objects.create(invoice=invoice, sku=SKU.objects.first(), quantity=1, price_vendor=Decimal('1.00'),
+                                   total_vendor=Decimal('1.00'), unit_volume_cc=1)
+        CostPool.objects.create(name='Freight', scope=CostPool.Scope.CONTAINER, method='QUANTITY',
+                                container=container, amount_total=Decimal('10.00'))
+    service.recalculate_all()
+    with CaptureQueriesContext(connection) as large:
+        service.recalculate_all()
+    assert len(large.captured_queries) == len(small.captured_queries)
+
+
+@pytest.mark.django_db
+def test_reallocation_replaces_previous_rows(shipment):
+    invoices, pools = shipment
+    service = AllocationService()
+    service.recalculate_all()
+    rows = AllocatedCost.objects.count()
+    service.recalculate_all()
+    service.allocate_cost(pools[0])
+    assert AllocatedCost.objects.count() == rows
+
+    # Moving a pool to another container drops its rows on the old one.
+    pools[0].container = invoices[1].container
+    pools[0].save()
+    service.allocate_cost(pools[0])
+    assert stored_amounts(pools[0]) == expected_amounts(pools[0])
+
+
+@pytest.mark.django_db
+def test_compact_allocations_keeps_newest_row_per_line(shipment):
+    _, pools = shipment
+    service = AllocationService()
+    service.allocate_pools(pools)
+    current = {pool.pk: stored_amounts(pool) for pool in pools}
+    rows = AllocatedCost.objects.count()
+    # Rows an older reallocation appended without removing.
+    AllocatedCost.objects.bulk_create(
+        AllocatedCost(cost_pool_id=row.cost_pool_id, invoice_line_id=row.invoice_line_id, amount_allocated=1)
+        for row in AllocatedCost.objects.all()
+    )
+    AllocatedCost.objects.filter(amount_allocated=1).update(id=models.F('id') - 10 ** 6)
+
+    out = io.StringIO()
+    call_command('compact_allocations', '--dry-run', stdout=out)
+    assert f'Would have removed {rows:,} of {2 * rows:,}' in out.getvalue()
+    assert AllocatedCost.objects.count() == 2 * rows
+
+    call_command('compact_allocations', stdout=out)
+    assert AllocatedCost.objects.count() == rows
+    assert {pool.pk: stored_amounts(pool) for pool in pools} == current
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('total', [Decimal('987.65'), Decimal('-12.34'), Decimal('0.01'), Decimal('123.456789')])
+def test_database_mode_matches_kernel(shipment, total):
+    _, pools = shipment
+    CostPool.objects.filter(pk__in=[pool.pk for pool in pools]).update(amount_total=total)
+    for pool in pools:
+        pool.amount_total = total
+    AllocationService(mode='kernel').allocate_pools(pools)
+    kernel = {pool.pk: stored_amounts(pool) for pool in pools}
+    AllocationService(mode='database').allocate_pools(pools)
+
+    for pool in pools:
+        stored = stored_amounts(pool)
+        assert stored.keys() == kernel[pool.pk].keys()
+        if pool.method != 'EQUALLY':
+            assert sum(stored.values()) == total.quantize(Decimal('0.01'))
+        # Float arithmetic may round a line lying on a half cent the other way.
+        assert all(abs(stored[pk] - kernel[pool.pk][pk]) <= Decimal('0.01') for pk in stored)
+        assert sum(stored[pk] != kernel[pool.pk][pk] for pk in stored) <= 2
+
+
+def test_unknown_allocation_mode_is_rejected():
+    with pytest.raises(ValueError):
+        AllocationService(mode='spreadsheet')
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('total', [Decimal('987.65'), Decimal('-12.34'), Decimal('0.01'), Decimal('123.456789')])
+def test_streaming_mode_matches_kernel(shipment, monkeypatch, total):
+    _, pools = shipment
+    pools += [CostPool.objects.create(name=method.title(), scope=CostPool.Scope.ALL, method=method, amount_total=total)
+              for method in ['VOLUME', 'QUANTITY', 'PRICE_QUANTITY', 'EQUALLY']]
+    AllocationService(mode='kernel').allocate_pools(pools)
+    kernel = {pool.pk: stored_amounts(pool) for pool in pools}
+
+    monkeypatch.setattr(services, 'ALLOCATION_STREAM_CHUNK_SIZE', 7)
+    inserts = []
+    bulk_create = AllocatedCost.objects.bulk_create
+
+    def counted(rows, **kwargs):
+        rows = list(rows)
+        inserts.append(len(rows))
+        return bulk_create(rows, **kwargs)
+
+    monkeypatch.setattr(AllocatedCost.objects, 'bulk_create', counted)
+    AllocationService(mode='streaming').allocate_pools([pool for pool in pools if pool.scope == CostPool.Scope.ALL])
+    assert {pool.pk: stored_amounts(pool) for pool in pools} == kernel
+    # Every line is written, a bounded chunk at a time.
+    assert max(inserts) == 7
+    assert sum(inserts) == 5 * InvoiceLine.objects.count()
+
+
+def test_streaming_mode_cannot_pack():
+    with pytest.raises(ValueError):
+        AllocationService(mode='streaming', storage='packed')
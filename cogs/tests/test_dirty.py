@@ -0,0 +1,133 @@
+import pytest
+from decimal import Decimal
+from cogs import dirty, recalc
+from cogs.hts_delta import import_schedule
+from cogs.ingestion import InvoiceIngestor
+from cogs.models import Container, HTSUSCode, InvoiceLine, RecalcMark, SKU
+from cogs.recalc import recalculate_dirty, recalculate_partitioned
+from cogs.services import AllocationService
+from cogs.upsert import import_sku_rows
+from test_ingestion import make_rows
+from test_recalc import allocation_rows
+
+
+@pytest.fixture
+def settled(vessel):
+    recalculate_partitioned(workers=1)
+    assert not RecalcMark.objects.exists()
+    return vessel
+
+
+def assert_matches_full_recalculation():
+    incremental = allocation_rows()
+    AllocationService().recalculate_all()
+    assert allocation_rows() == incremental
+
+
+@pytest.mark.django_db
+def test_nothing_changed_skips_everything(settled):
+    before = allocation_rows()
+    counts = recalculate_dirty()
+    assert counts == {'pools': 0, 'invoices': 0, 'skipped_pools': 10, 'skipped_invoices': 12}
+    assert allocation_rows() == before
+
+
+@pytest.mark.django_db
+def test_new_lines_reallocate_only_their_scopes(settled):
+    invoices, pools = settled
+    InvoiceIngestor().ingest(make_rows([
+        ['NEW', '2023-02-01', 'C1', 'PO', 'SKU1', '4', '3.00', '12.00', '7'],
+        [invoices[0].invoice_number, '2023-01-01', 'C0', 'PO', 'SKU1', '2', '1.00', '2.00', '3'],
+    ]))
+    counts = recalculate_dirty()
+    # Freight of C0 and C1, the broker fee of I0, insurance and the orphan pool.
+    assert counts['pools'] == 5
+    assert counts['invoices'] == 2
+    assert counts['skipped_invoices'] == 11
+    assert not RecalcMark.objects.exists()
+    assert_matches_full_recalculation()
+
+
+@pytest.mark.django_db
+def test_edits_mark_what_they_affect(settled):
+    invoices, pools = settled
+    freight = pools[2]
+    freight.name = 'Renamed'
+    freight.save()
+    assert not RecalcMark.objects.exists()
+
+    freight.amount_total = Decimal('150.00')
+    freight.save()
+    invoice = invoices[7]
+    invoice.manual_htsus_rate_pct = Decimal('2.5')
+    invoice.apply_db_htsus_rate = False
+    invoice.save()
+    assert set(RecalcMark.objects.values_list('kind', 'key')) == {('POOL', freight.pk), ('TARIFF', invoice.pk)}
+    assert recalculate_dirty()['pools'] == 1
+    assert_matches_full_recalculation()
+
+    moved = invoices[3]
+    old_container = moved.container_id
+    moved.container = Container.objects.get(container_id='C4')
+    moved.save()
+    assert set(RecalcMark.objects.values_list('kind', 'key')) == {('LINES', moved.pk), ('CONTAINER', old_container)}
+    counts = recalculate_dirty()
+    # Freight of both containers, insurance and the orphan pool.
+    assert (counts['pools'], counts['invoices']) == (4, 1)
+    assert_matches_full_recalculation()
+
+    InvoiceLine.objects.filter(invoice=invoices[11]).first().delete()
+    assert recalculate_dirty()['invoices'] == 1
+    assert_matches_full_recalculation()
+
+
+@pytest.mark.django_db
+def test_rate_changes_mark_the_invoices_using_them(settled):
+    invoices, _ = settled
+    code = HTSUSCode.objects.create(code='1234.56', description='Widgets', rate_pct=Decimal('4'))
+    other = SKU.objects.create(sku='SKU2', htsus_code=code)
+    InvoiceLine.objects.filter(invoice__in=invoices[:2]).update(sku=other)
+    RecalcMark.objects.all().delete()
+
+    import_sku_rows([{'sku': 'SKU2', 'name': 'Renamed', 'htsus_code': '1234.56', 'htsus_rate_pct': '4'}])
+    assert not RecalcMark.objects.exists()
+    import_schedule([{'code': '1234.56', 'description': 'Widgets', 'rate_pct': Decimal('6')}])
+    assert set(RecalcMark.objects.values_list('key', flat=True)) == {invoices[0].pk, invoices[1].pk}
+    assert recalculate_dirty()['invoices'] == 2
+
+    sku = SKU.objects.get(sku='SKU1')
+    sku.htsus_rate_pct = Decimal('7')
+    sku.save()
+    assert RecalcMark.objects.filter(kind='TARIFF').count() == 10
+    counts = recalculate_dirty()
+    assert (counts['pools'], counts['invoices']) == (0, 10)
+    assert_matches_full_recalculation()
+
+
+@pytest.mark.django_db
+def test_failed_full_recalculation_keeps_the_marks(vessel, monkeypatch):
+    before = set(RecalcMark.objects.values_list('kind', 'key'))
+    assert before
+
+    def fail(*args):
+        raise RuntimeError('worker died')
+
+    monkeypatch.setattr(recalc, '_recalculate_partitions', fail)
+    with pytest.raises(RuntimeError):
+        recalculate_partitioned(workers=1)
+    assert set(RecalcMark.objects.values_list('kind', 'key')) == before
+
+
+@pytest.mark.django_db
+def test_collecting_writes_once_and_not_on_error(settled):
+    invoices, _ = settled
+    with dirty.collecting():
+        InvoiceLine.objects.filter(invoice=invoices[5]).delete()
+        assert not RecalcMark.objects.exists()
+    assert list(RecalcMark.objects.values_list('kind', 'key')) == [('LINES', invoices[5].pk)]
+
+    with pytest.raises(ValueError):
+        with dirty.collecting():
+            dirty.mark(dirty.Kind.POOL, [1])
+            raise ValueError
+    assert RecalcMark.objects.count() == 1
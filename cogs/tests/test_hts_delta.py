@@ -0,0 +1,110 @@
+import pytest
+from decimal import Decimal
+from django.core.files.uploadedfile import SimpleUploadedFile
+from cogs import hts_delta, jobs
+from cogs.hts_delta import affected_invoices, import_schedule
+from cogs.models import Container, HTSUSCode, Invoice, InvoiceLine, SKU, schedule_checksum
+
+
+def row(code, description, rate):
+    return {'code': code, 'description': description, 'rate_pct': None if rate is None else Decimal(rate)}
+
+
+@pytest.fixture
+def schedule():
+    for code, description, rate in [('1111', 'a', '1'), ('2222', 'b', '2'), ('3333', 'c', '3')]:
+        HTSUSCode.objects.create(code=code, description=description, rate_pct=Decimal(rate))
+
+
+@pytest.mark.django_db
+def test_checksum_is_kept_on_save():
+    code = HTSUSCode.objects.create(code='1111', description='a', rate_pct=Decimal('1.5'))
+    assert code.checksum == schedule_checksum('a', Decimal('1.5000'))
+    code.rate_pct = Decimal('2')
+    code.save(update_fields=['rate_pct'])
+    code.refresh_from_db()
+    assert code.checksum == schedule_checksum('a', 2)
+
+
+@pytest.mark.django_db
+def test_only_changed_codes_are_written(schedule, django_assert_max_num_queries):
+    rows = [row('1111', 'a', '1.0000'), row('2222', 'b', '2.5'), row('3333', 'renamed', '3'), row('4444', 'd', None)]
+    with django_assert_max_num_queries(8):
+        delta = import_schedule(rows)
+
+    assert (delta.created, delta.updated, delta.unchanged, delta.retired) == (1, 2, 1, 0)
+    assert HTSUSCode.objects.get(code='2222').rate_pct == Decimal('2.5')
+    assert HTSUSCode.objects.get(code='3333').description == 'renamed'
+    # Description-only edits are not rate changes.
+    assert sorted(delta.changes, key=lambda change: change['code']) == [
+        {'code': '2222', 'old_rate': '2.0000', 'new_rate': '2.5000', 'change': 'updated'},
+        {'code': '4444', 'old_rate': None, 'new_rate': None, 'change': 'created'},
+    ]
+    for code in HTSUSCode.objects.all():
+        assert code.checksum == schedule_checksum(code.description, code.rate_pct)
+
+    again = import_schedule(rows)
+    assert (again.created, again.updated, again.unchanged, again.changes) == (0, 0, 4, [])
+
+
+@pytest.mark.django_db
+def test_repeated_code_keeps_last_row_and_original_rate(schedule):
+    delta = import_schedule([row('1111', 'a', '5'), row('1111', 'a', '6')], batch_size=1)
+    assert (delta.updated, delta.unchanged) == (1, 0)
+    assert delta.changes == [{'code': '1111', 'old_rate': '1.0000', 'new_rate': '6.0000', 'change': 'updated'}]
+    assert HTSUSCode.objects.get(code='1111').rate_pct == Decimal('6')
+
+
+@pytest.mark.django_db
+def test_full_schedule_retires_and_restores(schedule):
+    delta = import_schedule([row('1111', 'a', '1'), row('2222', 'b', '2')], retire_missing=True)
+    assert (delta.unchanged, delta.retired) == (2, 1)
+    # The code keeps its rate, so no tariff changes.
+    assert delta.changes == []
+    retired = HTSUSCode.objects.get(code='3333')
+    assert retired.retired_at is not None and retired.rate_pct == Decimal('3')
+
+    # A partial revision never retires anything; listing the code restores it.
+    delta = import_schedule([row('3333', 'c', '3')])
+    assert (delta.restored, delta.retired) == (1, 0)
+    assert delta.changes == [{'code': '3333', 'old_rate': None, 'new_rate': '3.0000', 'change': 'restored'}]
+    assert HTSUSCode.objects.filter(retired_at__isnull=True).count() == 3
+
+
+@pytest.mark.django_db
+def test_affected_invoices_follow_the_rate_fallback(schedule, monkeypatch):
+    monkeypatch.setattr(hts_delta, 'LOOKUP_CHUNK_SIZE', 1)
+    container = Container.objects.create(container_id='C1')
+    hts = HTSUSCode.objects.get(code='1111')
+    plain = SKU.objects.create(sku='PLAIN', htsus_code=hts)
+    override = SKU.objects.create(sku='OVERRIDE', htsus_code=hts, htsus_rate_pct=Decimal('9'))
+    other = SKU.objects.create(sku='OTHER', htsus_code=HTSUSCode.objects.get(code='2222'))
+    invoices = []
+    for number, sku, apply_db, manual in [
+        ('I1', plain, True, None),
+        ('I2', override, True, None),
+        # No manual rate, so database rates still apply.
+        ('I3', plain, False, None),
+        ('I4', plain, False, Decimal('2')),
+        ('I5', other, True, None),
+    ]:
+        invoice = Invoice.objects.create(invoice_number=number, invoice_date='2023-01-01', container=container,
+                                         apply_db_htsus_rate=apply_db, manual_htsus_rate_pct=manual)
+        for _ in range(2):
+            InvoiceLine.objects.create(invoice=invoice, sku=sku, quantity=1, price_vendor=1, total_vendor=1,
+                                       unit_volume_cc=1)
+        invoices.append(invoice)
+
+    delta = import_schedule([row('1111', 'a', '4'), row('2222', 'b', '5')])
+    assert affected_invoices(delta.changes) == [invoices[0].pk, invoices[2].pk, invoices[4].pk]
+
+
+@pytest.mark.django_db
+def test_htsus_upload_job_returns_change_set(schedule, eager_jobs):
+    content = b'code,description,rate_pct\n1111,a,1\n2222,b,7\n'
+    name = jobs.save_upload(SimpleUploadedFile('hts.csv', content))
+    job = jobs.enqueue('htsus_bulk_upload', {'file_name': 'hts.csv', 'files': [name], 'retire_missing': True})
+
+    assert (job.result['updated'], job.result['unchanged'], job.result['retired']) == (1, 1, 1)
+    assert [change['code'] for change in job.result['changes']] == ['2222']
+    assert '1 rate changes' in job.result['message']
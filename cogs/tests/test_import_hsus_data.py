@@ -0,0 +1,82 @@
+import io
+import pytest
+from decimal import Decimal
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from cogs.models import HTSUSCode, SKU
+
+CSV = (
+    'HTSUS_Code,HTSUS_Description,HTSUS_Rate_Pct,SKU,SKU_Name,SKU_HTSUS_Rate_Pct\n'
+    '1111,Chairs,3.5,S1,Chair,\n'
+    '1111,Chairs,3.5,S2,Stool,1.25\n'
+    '2222,Tables,abc,S3,Table,\n'
+    '3333,Lamps,2,S4,Lamp,oops\n'
+    ',Missing,1,S5,Nothing,\n'
+    '4444,Rugs,0,S6,Rug,\n'
+)
+
+
+def run(path, *args):
+    out = io.StringIO()
+    call_command('import_hsus_data', str(path), *args, verbosity=0, stdout=out)
+    return out.getvalue()
+
+
+@pytest.fixture
+def schedule(tmp_path):
+    path = tmp_path / 'hsus.csv'
+    path.write_text(CSV)
+    return path
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('workers', ['1', '2'])
+def test_import_applies_rows_like_the_row_by_row_version(schedule, workers):
+    output = run(schedule, '--batch-size', '2', '--workers', workers)
+
+    assert set(HTSUSCode.objects.values_list('code', flat=True)) == {'1111', '3333', '4444'}
+    assert set(SKU.objects.values_list('sku', flat=True)) == {'S1', 'S2', 'S6'}
+    s2 = SKU.objects.get(sku='S2')
+    assert s2.htsus_code.code == '1111'
+    assert s2.htsus_rate_pct == Decimal('1.25')
+    assert SKU.objects.get(sku='S1').htsus_rate_pct is None
+    assert 'HTSUSCode: 3 created' in output
+    assert 'Skipped rows: 3.' in output
+
+
+@pytest.mark.django_db
+def test_reimport_reports_unchanged(schedule):
+    run(schedule)
+    output = run(schedule)
+    assert 'HTSUSCode: 0 created, 0 updated, 3 unchanged.' in output
+    assert 'SKU: 0 created, 0 updated, 3 unchanged.' in output
+
+
+@pytest.mark.django_db
+def test_keys_repeated_across_shards_are_counted_once(tmp_path):
+    path = tmp_path / 'repeated.csv'
+    path.write_text(
+        'HTSUS_Code,HTSUS_Description,HTSUS_Rate_Pct,SKU,SKU_Name,SKU_HTSUS_Rate_Pct\n'
+        '1111,Chairs,3.5,S1,Chair,\n'
+        '1111,Chairs,3.5,S1,Chair,\n'
+        '1111,Chairs,4,S1,Armchair,\n'
+    )
+    output = run(path, '--batch-size', '1')
+    assert 'HTSUSCode: 1 created, 0 updated, 0 unchanged.' in output
+    assert 'SKU: 1 created, 0 updated, 0 unchanged.' in output
+    assert SKU.objects.get(sku='S1').name == 'Armchair'
+    assert HTSUSCode.objects.get(code='1111').rate_pct == Decimal('4')
+
+
+@pytest.mark.django_db
+def test_dry_run_writes_nothing(schedule):
+    output = run(schedule, '--dry-run')
+    assert 'Dry run' in output
+    assert 'SKU: 3 created' in output
+    assert not HTSUSCode.objects.exists()
+    assert not SKU.objects.exists()
+
+
+def test_missing_file_is_a_command_error(tmp_path):
+    with pytest.raises(CommandError, match='does not exist'):
+        run(tmp_path / 'nope.csv')
@@ -0,0 +1,75 @@
+import csv
+import io
+import pytest
+from datetime import date
+from decimal import Decimal
+from cogs.models import Invoice, InvoiceLine, SKU, Container
+from cogs.ingestion import InvoiceIngestor
+
+HEADER = ['Invoice#', 'Invoice date', 'Container ID', 'PO#', 'SKU', 'Quantity', 'Price', 'Total', 'Volume']
+
+
+def make_rows(rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(HEADER)
+    writer.writerows(rows)
+    return list(csv.DictReader(io.StringIO(buf.getvalue())))
+
+
+@pytest.mark.django_db
+def test_ingest_creates_same_rows_as_get_or_create():
+    existing_container = Container.objects.create(container_id='C0')
+    existing = Invoice.objects.create(invoice_number='I1', invoice_date='2020-05-05', container=existing_container, po_number='OLD')
+    SKU.objects.create(sku='SKU1')
+
+    rows = make_rows([
+        ['I1', '2023-01-01', 'C1', 'PO1', 'SKU1', '10.0', '2.50', '25.00', '100'],
+        ['I2', '01/02/23', 'C1', 'PO2', 'SKU2', '3', '1.00', '3.00', '50.5'],
+        ['I2', '03.01.2023', 'C2', 'PO9', 'SKU1', '1', '4.00', '4.00', '10'],
+    ])
+    result = InvoiceIngestor(country_origin='CN').ingest(rows)
+
+    assert result.rows == 3
+    assert result.lines_created == 3
+    assert set(Container.objects.values_list('container_id', flat=True)) == {'C0', 'C1', 'C2'}
+    assert set(SKU.objects.values_list('sku', flat=True)) == {'SKU1', 'SKU2'}
+
+    existing.refresh_from_db()
+    assert existing.po_number == 'OLD'
+    assert existing.invoice_date == date(2020, 5, 5)
+
+    new_invoice = Invoice.objects.get(invoice_number='I2')
+    assert new_invoice.invoice_date == date(2023, 1, 2)
+    assert new_invoice.container.container_id == 'C1'
+    assert new_invoice.po_number == 'PO2'
+    assert new_invoice.country_origin == 'CN'
+
+    lines = list(InvoiceLine.objects.order_by('id'))
+    assert [line.invoice.invoice_number for line in lines] == ['I1', 'I2', 'I2']
+    assert lines[0].quantity == 10
+    assert lines[0].price_vendor == Decimal('2.50')
+    assert lines[1].unit_volume_cc == 50.5
+
+
+@pytest.mark.django_db
+def test_ingest_query_count_is_independent_of_row_count(django_assert_max_num_queries):
+    rows = make_rows([
+        [f'I{n % 7}', '2023-01-01', f'C{n % 3}', 'PO', f'SKU{n}', '1', '1.00', '1.00', '1']
+        for n in range(300)
+    ])
+    with django_assert_max_num_queries(20):
+        InvoiceIngestor().ingest(rows)
+    assert InvoiceLine.objects.count() == 300
+
+
+@pytest.mark.django_db
+def test_ingest_bad_row_writes_nothing():
+    rows = make_rows([
+        ['I1', '2023-01-01', 'C1', 'PO1', 'SKU1', '1', '1.00', '1.00', '1'],
+        ['I1', 'not a date', 'C1', 'PO1', 'SKU1', '1', '1.00', '1.00', '1'],
+    ])
+    with pytest.raises(ValueError, match='not supported'):
+        InvoiceIngestor().ingest(rows)
+    assert not InvoiceLine.objects.exists()
+    assert not Container.objects.exists()
@@ -0,0 +1,83 @@
+import pytest
+from datetime import timedelta
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.urls import reverse
+from django.utils import timezone
+from cogs import jobs
+from cogs.models import Job, InvoiceLine
+
+INVOICE_CSV = (
+    'Invoice#,Invoice date,Container ID,PO#,SKU,Quantity,Price,Total,Volume\n'
+    'I1,2023-01-01,C1,PO1,SKU1,2,5.00,10.00,100\n'
+)
+
+
+@pytest.mark.django_db
+def test_enqueue_claim_and_execute(settings, job_storage):
+    settings.COGS_JOBS_EAGER = False
+    name = jobs.save_upload(SimpleUploadedFile('inv.csv', INVOICE_CSV.encode()))
+    job = jobs.enqueue('invoice_upload', {'file_name': 'inv.csv', 'files': [name]})
+    assert job.status == Job.Status.QUEUED
+
+    claimed = jobs.claim_next_job(worker='test')
+    assert claimed.pk == job.pk
+    assert jobs.claim_next_job(worker='test') is None
+
+    assert jobs.execute_job(job.pk) == Job.Status.SUCCEEDED
+    job.refresh_from_db()
+    assert job.attempts == 1
+    assert job.result['rows'] == 1
+    assert job.progress_done > 0
+    assert InvoiceLine.objects.count() == 1
+    assert not (job_storage / name).exists()
+
+
+@pytest.mark.django_db
+def test_failed_handler_marks_job_failed(settings, job_storage):
+    settings.COGS_JOBS_EAGER = True
+    bad = INVOICE_CSV.replace('2023-01-01', 'yesterday')
+    name = jobs.save_upload(SimpleUploadedFile('inv.csv', bad.encode()))
+    job = jobs.enqueue('invoice_upload', {'file_name': 'inv.csv', 'files': [name]})
+    assert job.status == Job.Status.FAILED
+    assert 'nothing was imported' in job.error
+    assert 'not supported' in job.result['errors'][0]['message']
+    assert not InvoiceLine.objects.exists()
+
+
+@pytest.mark.django_db
+def test_stale_running_jobs_are_requeued_or_failed(settings):
+    settings.COGS_JOB_MAX_ATTEMPTS = 2
+    old = timezone.now() - timedelta(hours=1)
+    retry = Job.objects.create(kind='recalculate_costs', status=Job.Status.RUNNING, attempts=1, heartbeat_at=old)
+    give_up = Job.objects.create(kind='recalculate_costs', status=Job.Status.RUNNING, attempts=2, heartbeat_at=old)
+    alive = Job.objects.create(kind='recalculate_costs', status=Job.Status.RUNNING, attempts=1, heartbeat_at=timezone.now())
+
+    assert jobs.requeue_stale_jobs(stale_after=60) == 2
+    assert Job.objects.get(pk=retry.pk).status == Job.Status.QUEUED
+    assert Job.objects.get(pk=give_up.pk).status == Job.Status.FAILED
+    assert Job.objects.get(pk=alive.pk).status == Job.Status.RUNNING
+
+
+@pytest.mark.django_db
+def test_invoice_upload_view_enqueues_and_status_endpoint(client, settings, job_storage):
+    settings.COGS_JOBS_EAGER = False
+    upload = SimpleUploadedFile('inv.csv', INVOICE_CSV.encode())
+    response = client.post(reverse('invoice_upload'), {'file': upload})
+    job = Job.objects.get()
+    assert response.status_code == 302
+    assert response.url == reverse('job_detail', args=[job.pk])
+    assert not InvoiceLine.objects.exists()
+
+    status = client.get(reverse('job_status', args=[job.pk])).json()
+    assert status['status'] == 'QUEUED'
+    assert status['finished'] is False
+
+    jobs.claim_job(job)
+    jobs.execute_job(job.pk)
+    status = client.get(reverse('job_status', args=[job.pk])).json()
+    assert status['status'] == 'SUCCEEDED'
+    assert status['percent'] == 100
+
+    fragment = client.get(reverse('job_status', args=[job.pk]), HTTP_HX_REQUEST='true')
+    assert b'Invoice uploaded successfully' in fragment.content
+    assert b'hx-trigger' not in fragment.content
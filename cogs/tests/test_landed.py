@@ -0,0 +1,75 @@
+import csv
+import io
+import random
+import pytest
+import numpy as np
+from decimal import Decimal
+from django.urls import reverse
+from cogs.landed import landed_cost_rows, reference_landed_cost_rows
+from cogs.models import HTSUSCode, Invoice, InvoiceLine, SavedResults, SKU
+from cogs.money import round_divide, to_units
+from tariff.models import Country
+
+COUNTRIES = ['CN', 'VN', 'MX', 'IN']
+POOLS = ['Freight Cost', 'HTSUS Tariff', 'Drayage', 'Exam', 'Storage']
+
+
+def random_rate(rng, places):
+    return rng.choice([None, Decimal(0), Decimal(rng.randint(0, 10 ** (places + 3))).scaleb(-places)])
+
+
+def random_lines(rng, count):
+    """Unsaved lines with random prices, rates and allocations, and the allocations by line id."""
+    codes = [HTSUSCode(pk=n, code=f'{n:04d}.00', rate_pct=random_rate(rng, 4)) for n in range(1, 6)]
+    skus = [SKU(pk=n, sku=f'S{n}', htsus_code=rng.choice(codes + [None]), htsus_rate_pct=random_rate(rng, 4))
+            for n in range(1, 9)]
+    invoices = [Invoice(pk=n, country_origin=rng.choice(COUNTRIES + ['', None, 'DE'])) for n in range(1, 5)]
+    lines, allocations = [], {}
+    for pk in range(1, count + 1):
+        lines.append(InvoiceLine(pk=pk, invoice=rng.choice(invoices), sku=rng.choice(skus),
+                                 quantity=rng.choice([0, 1, 3, 7, rng.randint(-5, 100_000)]),
+                                 price_vendor=Decimal(rng.randint(0, 10 ** rng.randint(1, 9))).scaleb(-2)))
+        allocations[pk] = [(rng.choice(POOLS), Decimal(rng.randint(-10 ** 6, 10 ** 8)).scaleb(-2))
+                           for _ in range(rng.randint(0, 5))]
+    overrides = {code.code: Decimal(rng.randint(0, 10 ** 6)).scaleb(-4) for code in codes if rng.random() < 0.3}
+    return lines, allocations, overrides
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('seed', range(40))
+def test_fixed_point_rows_equal_decimal_rows(seed):
+    rng = random.Random(seed)
+    for code in COUNTRIES:
+        Country.objects.create(name=code, code=code, section_301_rate=random_rate(rng, 2) or 0)
+    lines, allocations, overrides = random_lines(rng, rng.choice([1, 5, 60, 400]))
+    assert landed_cost_rows(lines, allocations, overrides) == reference_landed_cost_rows(lines, allocations, overrides)
+
+
+def test_round_divide_is_half_even_and_overflow_safe():
+    numerator = np.array([5, 15, 25, -5, -15, 7, -7], dtype=np.int64)
+    assert round_divide(numerator, np.full(7, 10, dtype=np.int64)).tolist() == [0, 2, 2, 0, -2, 1, -1]
+    big = np.array([10 ** 30 + 5], dtype=object)
+    assert round_divide(big, np.array([10], dtype=object)).tolist() == [10 ** 29]
+    with pytest.raises(ValueError):
+        to_units(Decimal('1.23456'))
+
+
+@pytest.mark.django_db
+def test_csv_export_and_snapshot_use_results_rows(client, django_user_model):
+    client.force_login(django_user_model.objects.create_user('finance'))
+    Country.objects.create(name='China', code='CN', section_301_rate=Decimal('7.5'))
+    sku = SKU.objects.create(sku='CHAIR', htsus_code=HTSUSCode.objects.create(code='9403.60', rate_pct=Decimal('3.9')))
+    invoice = Invoice.objects.create(invoice_number='I1', invoice_date='2023-01-01', country_origin='CN')
+    for quantity, price in ((3, '12.35'), (7, '0.99')):
+        InvoiceLine.objects.create(invoice=invoice, sku=sku, quantity=quantity, price_vendor=Decimal(price),
+                                   total_vendor=Decimal(price) * quantity, unit_volume_cc=1)
+    results = client.get(reverse('results')).context['results_data']
+
+    rows = list(csv.DictReader(io.StringIO(client.get(reverse('download_results_csv')).content.decode())))
+    assert [row['TOTAL COST'] for row in rows] == [f'${result["total_cost"]:.2f}' for result in results]
+    assert [row['HTSUS Tariff'] for row in rows] == ['$1.44', '$0.27']
+
+    assert client.post(reverse('save_results_snapshot')).json()['saved_count'] == 2
+    saved = SavedResults.objects.order_by('pk')
+    assert [record.unit_total_cost for record in saved] == [result['unit_total_cost'] for result in results]
+    assert [record.section_301 for record in saved] == [Decimal('2.78'), Decimal('0.52')]
@@ -0,0 +1,64 @@
+import pytest
+from django.db import connection, transaction
+from django.db.transaction import TransactionManagementError
+from django.test.utils import CaptureQueriesContext
+from cogs import locks
+from cogs.locks import CONTAINER, INVOICE, ROOT, lock_key, lock_plan
+from cogs.services import AllocationService
+
+
+def conflict(first, second):
+    # Two plans wait for each other when they share a key and either takes it exclusively.
+    return any(not (first[key] and second[key]) for key in first.keys() & second.keys())
+
+
+@pytest.mark.django_db
+def test_overlapping_scopes_conflict_and_disjoint_ones_do_not(vessel):
+    invoices, pools = vessel
+    freight = {pool.container_id: pool for pool in pools if pool.name == 'Freight'}
+    broker, insurance = pools[6], pools[8]
+    container = invoices[0].container_id
+
+    assert not conflict(lock_plan([freight[container]]), lock_plan([freight[invoices[1].container_id]]))
+    assert conflict(lock_plan([freight[container]]), lock_plan([broker]))
+    assert conflict(lock_plan([freight[container]]), lock_plan(invoice_ids=[invoices[5].pk]))
+    assert not conflict(lock_plan([broker]), lock_plan(invoice_ids=[invoices[5].pk]))
+    assert conflict(lock_plan([broker]), lock_plan(invoice_ids=[invoices[0].pk]))
+    assert conflict(lock_plan([broker]), lock_plan([broker]))
+    assert conflict(lock_plan([insurance]), lock_plan(invoice_ids=[invoices[11].pk]))
+
+
+@pytest.mark.django_db
+def test_plan_takes_the_strongest_lock_on_each_key(vessel):
+    invoices, pools = vessel
+    container = invoices[0].container_id
+    freight = next(pool for pool in pools if pool.name == 'Freight' and pool.container_id == container)
+    assert lock_plan([freight], [invoices[0].pk, invoices[11].pk]) == {
+        lock_key(ROOT): True,
+        lock_key(CONTAINER, container): False,
+        lock_key(INVOICE, invoices[0].pk): False,
+        lock_key(INVOICE, invoices[11].pk): False,
+    }
+    assert lock_plan([pools[8]], [invoices[0].pk])[lock_key(ROOT)] is False
+    assert lock_key(CONTAINER, 2 ** 40) < lock_key(INVOICE, 1) < lock_key(locks.NAME)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_locks_need_a_transaction(vessel):
+    invoices, pools = vessel
+    with pytest.raises(TransactionManagementError):
+        locks.lock_scopes(pools)
+    with pytest.raises(TransactionManagementError):
+        AllocationService().compute_htsus_pools(invoices[:1])
+    with transaction.atomic(), CaptureQueriesContext(connection) as queries:
+        locks.lock_names('Freight Cost')
+    # SQLite is serialized by BEGIN IMMEDIATE already.
+    assert not queries.captured_queries
+
+
+@pytest.mark.django_db
+def test_recalculating_everything_locks_the_root_once(vessel, monkeypatch):
+    plans = []
+    monkeypatch.setattr(locks, '_acquire', plans.append)
+    AllocationService().recalculate_all()
+    assert plans == [{lock_key(ROOT): False}]
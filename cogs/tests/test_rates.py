@@ -0,0 +1,124 @@
+import datetime
+import random
+import pytest
+from decimal import Decimal
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from cogs.models import CostPool, HTSRateDetail, HTSUSCode, Invoice, InvoiceLine, SKU
+from cogs.rates import RateContext, rate_detail_from_db, rate_index
+from cogs.services import AllocationService
+from tariff.models import Entry
+
+
+@pytest.fixture
+def complex_code():
+    code = HTSUSCode.objects.create(code='8471.30', description='Laptops', rate_pct=Decimal('2'), has_complex_rates=True)
+    details = [
+        ('', '2020-01-01', None, '4'),
+        ('CN', '2020-01-01', '2022-12-31', '25'),
+        ('CN', '2023-01-01', None, '30'),
+        ('VN', '2024-01-01', None, '6'),
+    ]
+    for country, start, end, rate in details:
+        HTSRateDetail.objects.create(hts_code=code, country_code=country, effective_from=start, effective_to=end,
+                                     adval_pct=Decimal(rate))
+    return code
+
+
+@pytest.mark.django_db
+def test_rate_prefers_country_then_latest_then_global(complex_code):
+    sku = SKU.objects.create(sku='LAPTOP', htsus_code=complex_code)
+    override = SKU.objects.create(sku='OVERRIDE', htsus_code=complex_code, htsus_rate_pct=Decimal('1.5'))
+    plain = SKU.objects.create(sku='PLAIN')
+    rates = RateContext.load([sku.pk, override.pk, plain.pk])
+
+    def rate(sku_id, country, day):
+        return rates.rate(sku_id, country, datetime.date.fromisoformat(day))
+
+    assert rate(sku.pk, 'CN', '2022-06-01') == Decimal('25')
+    assert rate(sku.pk, 'CN', '2023-01-01') == Decimal('30')
+    assert rate(sku.pk, 'VN', '2023-06-01') == Decimal('4')  # before the VN rate took effect
+    assert rate(sku.pk, 'VN', '2024-06-01') == Decimal('6')
+    assert rate(sku.pk, 'MX', '2024-06-01') == Decimal('4')
+    assert rate(sku.pk, None, '2024-06-01') == Decimal('2')
+    assert rate(sku.pk, 'CN', '2019-06-01') == Decimal('2')  # no detail in force yet
+    assert rate(override.pk, 'CN', '2024-06-01') == Decimal('1.5')
+    assert rate(plain.pk, 'CN', '2024-06-01') == Decimal(0)
+
+
+def make_invoices(count, sku):
+    invoices = []
+    for n in range(count):
+        entry = Entry.objects.create(entry_number=f'E{sku.pk}-{n}', import_date='2023-05-01', mode='ocean',
+                                     country_origin='CN' if n % 2 else 'VN')
+        invoice = Invoice.objects.create(invoice_number=f'{sku.sku}-{n}', invoice_date='2024-03-01', entry=entry)
+        InvoiceLine.objects.create(invoice=invoice, sku=sku, quantity=2, price_vendor=Decimal('50.00'),
+                                   total_vendor=Decimal('100.00'), unit_volume_cc=1)
+        invoices.append(invoice)
+    return invoices
+
+
+@pytest.mark.django_db
+def test_htsus_uses_country_specific_rate(complex_code):
+    sku = SKU.objects.create(sku='LAPTOP', htsus_code=complex_code)
+    vietnam, china = make_invoices(2, sku)
+    service = AllocationService()
+    service.compute_htsus_for_invoice(china)
+    service.compute_htsus_for_invoice(vietnam)
+    assert CostPool.objects.get(invoice=china, name='HTSUS Tariff').amount_total == Decimal('30.00')
+    assert CostPool.objects.get(invoice=vietnam, name='HTSUS Tariff').amount_total == Decimal('6.00')
+
+
+@pytest.mark.django_db
+def test_htsus_query_count_does_not_grow_with_lines(complex_code):
+    service = AllocationService()
+    few = make_invoices(2, SKU.objects.create(sku='FEW', htsus_code=complex_code))
+    with CaptureQueriesContext(connection) as small:
+        service.compute_htsus_pools(Invoice.objects.filter(pk__in=[invoice.pk for invoice in few]))
+
+    many = make_invoices(40, SKU.objects.create(sku='MANY', htsus_code=complex_code))
+    for invoice in many:
+        InvoiceLine.objects.create(invoice=invoice, sku=SKU.objects.create(sku=f'EXTRA{invoice.pk}'), quantity=1,
+                                   price_vendor=Decimal('1.00'), total_vendor=Decimal('1.00'), unit_volume_cc=1)
+    with CaptureQueriesContext(connection) as large:
+        service.compute_htsus_pools(Invoice.objects.filter(pk__in=[invoice.pk for invoice in many]))
+    assert len(large.captured_queries) == len(small.captured_queries)
+
+
+@pytest.mark.django_db
+def test_index_lookup_matches_database_query():
+    rng = random.Random(5)
+    codes = [HTSUSCode.objects.create(code=f'99.{n}', description='', has_complex_rates=True) for n in range(3)]
+    for _ in range(60):
+        start = datetime.date(2020, 1, 1) + datetime.timedelta(days=rng.randint(0, 1500))
+        end = rng.choice([None, start + datetime.timedelta(days=rng.randint(0, 400))])
+        HTSRateDetail.objects.create(hts_code=rng.choice(codes), country_code=rng.choice(['', 'CN', 'VN']),
+                                     effective_from=start, effective_to=end, adval_pct=rng.choice([None, Decimal(rng.randint(0, 40))]))
+    index = rate_index()
+    for _ in range(300):
+        key = (rng.choice(codes).pk, rng.choice(['', 'CN', 'VN', 'MX']),
+               datetime.date(2019, 6, 1) + datetime.timedelta(days=rng.randint(0, 2200)))
+        assert index.lookup(*key) == rate_detail_from_db(*key)
+
+
+@pytest.mark.django_db
+def test_index_follows_saves_deletes_and_outside_writes(complex_code):
+    index = rate_index()
+    day = datetime.date(2025, 1, 1)
+    assert index.lookup(complex_code.pk, 'CN', day) == (True, Decimal('30'))
+
+    latest = HTSRateDetail.objects.create(hts_code=complex_code, country_code='CN', effective_from='2024-07-01',
+                                          adval_pct=Decimal('50'))
+    assert rate_index() is index  # updated in place, not rebuilt
+    assert index.lookup(complex_code.pk, 'CN', day) == (True, Decimal('50'))
+    latest.adval_pct = Decimal('45')
+    latest.save()
+    assert index.lookup(complex_code.pk, 'CN', day) == (True, Decimal('45'))
+    latest.delete()
+    assert index.lookup(complex_code.pk, 'CN', day) == (True, Decimal('30'))
+    assert rate_index() is index
+
+    # bulk_create sends no signals, like a write from another process.
+    HTSRateDetail.objects.bulk_create([HTSRateDetail(hts_code=complex_code, country_code='MX',
+                                                     effective_from='2024-01-01', adval_pct=Decimal('9'))])
+    assert rate_index().lookup(complex_code.pk, 'MX', day) == (True, Decimal('9'))
@@ -0,0 +1,63 @@
+import csv
+import io
+from django.core.files.uploadedfile import SimpleUploadedFile
+from cogs.readers import iter_text, iter_lines, csv_dict_reader, iter_csv_batches, open_table, iter_table_dicts
+
+
+def split_bytes(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def test_iter_text_handles_multibyte_characters_split_across_chunks():
+    data = 'sku,name\nA1,Café crème\n'.encode('utf-8')
+    assert ''.join(iter_text(split_bytes(data, 1))) == 'sku,name\nA1,Café crème\n'
+
+
+def test_iter_text_strips_utf8_bom():
+    data = '\ufeffsku,name\nA1,x\n'.encode('utf-8')
+    assert ''.join(iter_text(split_bytes(data, 2))) == 'sku,name\nA1,x\n'
+
+
+def test_iter_text_falls_back_to_windows_1252():
+    data = 'sku,name\nA1,Café € 5\n'.encode('cp1252')
+    assert ''.join(iter_text(split_bytes(data, 4))) == 'sku,name\nA1,Café € 5\n'
+
+
+def test_quoted_newlines_survive_line_splitting():
+    text_chunks = ['sku,name\r\nA1,"two\nli', 'nes"\r\nA2,plain\r\n']
+    rows = list(csv.DictReader(iter_lines(text_chunks)))
+    assert [row['name'] for row in rows] == ['two\nlines', 'plain']
+
+
+def test_csv_batches_from_uploaded_file():
+    body = 'sku,name\n' + ''.join(f'S{n},N{n}\n' for n in range(7))
+    upload = SimpleUploadedFile('skus.csv', body.encode('utf-8'))
+    batches = list(iter_csv_batches(upload, batch_size=3))
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    assert batches[2][0] == {'sku': 'S6', 'name': 'N6'}
+    assert csv_dict_reader(upload).fieldnames == ['sku', 'name']
+
+
+def make_workbook(rows, sheets=1):
+    from openpyxl import Workbook
+    workbook = Workbook()
+    for index in range(sheets - 1):
+        workbook.create_sheet(f'Other {index}').append(['ignored'])
+    for row in rows:
+        workbook.worksheets[0].append(row)
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def test_open_table_streams_first_worksheet():
+    data = make_workbook([['code', 'rate', None], [1234, 3.5], [None, None], ['5678', None]], sheets=2)
+    header, rows = open_table(io.BytesIO(data), 'codes.xlsx')
+    assert header == ['code', 'rate']
+    assert [tuple(row[:2]) for row in rows] == [(1234, 3.5), ('5678', None)]
+
+
+def test_open_table_reads_csv_and_workbooks_alike():
+    csv_rows = list(iter_table_dicts(SimpleUploadedFile('c.csv', b'code,rate\n1234,3.5\n\n'), 'c.csv'))
+    xlsx_rows = list(iter_table_dicts(io.BytesIO(make_workbook([['code', 'rate'], ['1234', '3.5']])), 'c.xlsx'))
+    assert csv_rows == xlsx_rows == [{'code': '1234', 'rate': '3.5'}]
@@ -0,0 +1,45 @@
+import pytest
+from cogs import jobs
+from cogs.models import AllocatedCost, Container, CostPool, Job
+from cogs.recalc import partition_pools, plan_partitions, recalculate_partitioned, reduce_pools
+from cogs.services import AllocationService
+
+
+def allocation_rows():
+    return sorted(AllocatedCost.objects.values_list('cost_pool__name', 'cost_pool__invoice_id',
+                                                    'cost_pool__container_id', 'invoice_line_id', 'amount_allocated'))
+
+
+@pytest.mark.django_db
+def test_every_pool_is_in_exactly_one_partition_or_the_reduce_step(vessel):
+    _, pools = vessel
+    partitions = plan_partitions(3)
+    assert len(partitions) == 3
+    containers = [pk for partition in partitions for pk in partition]
+    assert sorted(containers, key=str) == sorted([*Container.objects.values_list('pk', flat=True), None], key=str)
+    assigned = [pool.pk for partition in partitions for pool in partition_pools(partition)]
+    assigned += [pool.pk for pool in reduce_pools()]
+    assert sorted(assigned) == sorted(pool.pk for pool in pools)
+
+
+@pytest.mark.django_db
+def test_partitioned_recalculation_matches_serial(vessel):
+    invoices, pools = vessel
+    serial = AllocationService().recalculate_all()
+    expected = allocation_rows()
+    AllocatedCost.objects.all().delete()
+
+    progress = []
+    counts = recalculate_partitioned(workers=1, progress=lambda done, total: progress.append((done, total)))
+    assert allocation_rows() == expected
+    assert counts == {**serial, 'partitions': 4}
+    assert progress[-1] == (5, 5)
+
+
+@pytest.mark.django_db
+def test_recalculate_costs_job(vessel, settings):
+    settings.COGS_JOBS_EAGER = True
+    job = jobs.enqueue('recalculate_costs', {})
+    assert job.status == Job.Status.SUCCEEDED, job.error
+    assert job.result['invoices'] == 12
+    assert CostPool.objects.filter(name='HTSUS Tariff').count() == 12
@@ -0,0 +1,124 @@
+import csv
+import io
+import pytest
+from collections import defaultdict
+from decimal import Decimal
+from django.core.management import call_command
+from cogs.landed import group_allocations, landed_cost_rows, load_lines
+from cogs.models import AllocatedCost, Container, CostPool, HTSUSCode, Invoice, InvoiceLine, SKU
+from cogs.scenarios import Scenario, ScenarioLines, read_scenarios
+from cogs.services import AllocationService
+from tariff.models import Country
+
+
+@pytest.fixture
+def lines():
+    Country.objects.create(name='China', code='CN', section_301_rate=Decimal('7.5'))
+    Country.objects.create(name='Vietnam', code='VN', section_301_rate=Decimal('0'))
+    furniture = HTSUSCode.objects.create(code='9403.60', description='Furniture', rate_pct=Decimal('4'))
+    lamps = HTSUSCode.objects.create(code='9405.10', description='Lamps', rate_pct=None)
+    skus = [SKU.objects.create(sku='CHAIR', htsus_code=furniture), SKU.objects.create(sku='LAMP', htsus_code=lamps),
+            SKU.objects.create(sku='DESK', htsus_code=furniture, htsus_rate_pct=Decimal('1.5'))]
+    containers = [Container.objects.create(container_id=f'C{n}') for n in range(2)]
+    for n in range(5):
+        invoice = Invoice.objects.create(invoice_number=f'I{n}', invoice_date='2023-01-01',
+                                         container=containers[n % 2] if n < 4 else None,
+                                         country_origin=['CN', 'VN', '', 'MX', 'CN'][n])
+        for q in range(1, 5):
+            InvoiceLine.objects.create(invoice=invoice, sku=skus[(n + q) % 3], quantity=q,
+                                       price_vendor=Decimal('12.34') * q, total_vendor=Decimal('12.34') * q * q,
+                                       unit_volume_cc=10 * q)
+    service = AllocationService()
+    for name, method in (('Freight Cost', CostPool.Method.VOLUME), ('Drayage', CostPool.Method.QUANTITY)):
+        service.allocate_cost(CostPool.objects.create(name=name, scope=CostPool.Scope.ALL, method=method,
+                                                      amount_total=Decimal('500.00')))
+    service.compute_htsus_pools(Invoice.objects.all())
+
+
+def landed_by(dimension):
+    rows = landed_cost_rows(
+        load_lines(InvoiceLine.objects.order_by('pk')),
+        group_allocations(AllocatedCost.objects.order_by('pk').values_list(
+            'invoice_line_id', 'cost_pool__name', 'amount_allocated')),
+    )
+    key = {
+        'container': lambda line: line.invoice.container.container_id if line.invoice.container else '',
+        'invoice': lambda line: line.invoice.invoice_number,
+        'sku': lambda line: line.sku.sku,
+    }[dimension]
+    totals = defaultdict(Decimal)
+    for row in rows:
+        totals[key(row['line'])] += row['total_cost']
+    return totals
+
+
+def cube_table(cube, column):
+    table = defaultdict(dict)
+    for row in cube.rows():
+        table[row[0], row[1]][row[2]] = Decimal(row[column])
+    return table
+
+
+def assert_close(actual, expected):
+    assert actual.keys() == expected.keys()
+    for key in expected:
+        assert abs(actual[key] - expected[key]) <= Decimal('0.01'), key
+
+
+@pytest.mark.django_db
+def test_baseline_matches_results(lines):
+    cube = ScenarioLines().sweep([Scenario('current')])
+    for dimension in ('container', 'invoice', 'sku'):
+        assert_close(cube_table(cube, 3)['current', dimension], landed_by(dimension))
+    assert {row[5] for row in cube.rows()} == {'0.00'}
+
+
+@pytest.mark.django_db
+def test_sweep_matches_changed_rates(lines):
+    scenarios = [
+        Scenario('hts', hts={'9403.60': 10, '9405.10': 2.5, '0000.00': 99}),
+        Scenario('china', section_301={'CN': 25, 'MX': 5}),
+        Scenario('both', section_301={'VN': 10}, hts={'9403.60': 0}),
+    ]
+    cube = ScenarioLines().sweep(scenarios)
+    for scenario in scenarios:
+        HTSUSCode.objects.filter(code='9403.60').update(rate_pct=scenario.hts.get('9403.60', Decimal('4')))
+        HTSUSCode.objects.filter(code='9405.10').update(rate_pct=scenario.hts.get('9405.10'))
+        Country.objects.filter(code='CN').update(section_301_rate=scenario.section_301.get('CN', Decimal('7.5')))
+        Country.objects.filter(code='VN').update(section_301_rate=scenario.section_301.get('VN', 0))
+        # MX has no Country row: only scenarios charge it.
+        Country.objects.update_or_create(code='MX', defaults={'name': 'Mexico',
+                                                              'section_301_rate': scenario.section_301.get('MX', 0)})
+        for dimension in ('container', 'invoice', 'sku'):
+            assert_close(cube_table(cube, 4)[scenario.name, dimension], landed_by(dimension))
+    impact = cube_table(cube, 5)['china', 'invoice']
+    vendor = {number: sum(line.price_vendor * line.quantity for line in InvoiceLine.objects.filter(
+        invoice__invoice_number=number)) for number in ('I0', 'I3', 'I4')}
+    assert impact['I0'] == (vendor['I0'] * Decimal('0.175')).quantize(Decimal('0.01'))
+    assert impact['I3'] == (vendor['I3'] * Decimal('0.05')).quantize(Decimal('0.01'))
+    assert impact['I1'] == impact['I2'] == Decimal('0')
+
+
+def test_read_scenarios():
+    rows = [
+        {'scenario': 'A', 'kind': 'section_301', 'code': 'cn', 'rate': '25'},
+        {'scenario': 'B', 'kind': 'hts', 'code': '9403.60', 'rate': '10'},
+        {'scenario': 'A', 'kind': 'hts', 'code': '9403.60', 'rate': '7.5'},
+    ]
+    assert read_scenarios(rows) == [Scenario('A', {'CN': 25.0}, {'9403.60': 7.5}), Scenario('B', {}, {'9403.60': 10.0})]
+    with pytest.raises(ValueError, match='Row 3: kind'):
+        read_scenarios([rows[0], {**rows[1], 'kind': 'reciprocal'}])
+    with pytest.raises(ValueError, match='Row 2: rate'):
+        read_scenarios([{**rows[0], 'rate': 'high'}])
+
+
+@pytest.mark.django_db
+def test_command_writes_cube(lines, tmp_path):
+    scenarios = tmp_path / 'scenarios.csv'
+    scenarios.write_text('scenario,kind,code,rate\nA,section_301,CN,25\nB,hts,9403.60,10\n')
+    out = io.StringIO()
+    call_command('tariff_scenarios', str(scenarios), '--dimension', 'container', stdout=out, stderr=io.StringIO())
+    rows = list(csv.reader(io.StringIO(out.getvalue())))
+    assert rows[0] == ['Scenario', 'Dimension', 'Key', 'Baseline Landed Cost', 'Scenario Landed Cost', 'Impact']
+    assert [row[:3] for row in rows[1:]] == [['A', 'container', ''], ['A', 'container', 'C0'], ['A', 'container', 'C1'],
+                                            ['B', 'container', ''], ['B', 'container', 'C0'], ['B', 'container', 'C1']]
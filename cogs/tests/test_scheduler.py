@@ -0,0 +1,122 @@
+import json
+import zlib
+import pytest
+from datetime import timedelta
+from decimal import Decimal
+from django.urls import reverse
+from django.utils import timezone
+from cogs import jobs, locks
+from cogs.models import AllocatedCost, CostPool, Job, RecalcMark
+from cogs.recalc import recalculate_partitioned
+from cogs.scheduler import RECALC_KIND, results_watermark, schedule_recalculation
+
+
+@pytest.fixture
+def queued(settings, vessel):
+    settings.COGS_JOBS_EAGER = False
+    settings.COGS_RECALC_DEBOUNCE_SECONDS = 30
+    settings.COGS_RECALC_MAX_DELAY_SECONDS = 120
+    recalculate_partitioned(workers=1)
+    return vessel
+
+
+def add_cost(client, name, amount, **form):
+    form = {'cost_name': name, 'cost_amount': amount, 'allocation_scope': 'all', 'allocation_method': 'quantity', **form}
+    response = client.post(reverse('add_custom_cost'), json.dumps(form), content_type='application/json')
+    assert response.json()['success']
+    return response.json()
+
+
+@pytest.mark.django_db
+def test_a_burst_of_edits_is_one_deferred_recalculation(client, queued):
+    invoices, pools = queued
+    answer = add_cost(client, 'Drayage', '100')
+    job = Job.objects.get()
+    assert answer['message'] == 'Drayage cost of $100.0 is scheduled for allocation'
+    assert (answer['job_id'], answer['job_status']) == (job.pk, Job.Status.QUEUED)
+    assert answer['status_url'] == reverse('job_status', args=[job.pk])
+    first_run_after = job.run_after
+    assert first_run_after > timezone.now() + timedelta(seconds=25)
+
+    add_cost(client, 'Handling', '40', allocation_scope='invoice', invoice_id=str(invoices[2].pk))
+    response = client.post(reverse('add_freight_cost'), json.dumps({
+        'total_freight_cost': '900', 'allocation_scope': 'container', 'container_id': invoices[0].container_id,
+    }), content_type='application/json')
+    assert response.json()['job_id'] == job.pk
+    client.get(reverse('delete_cost_pool', args=[pools[-1].pk]))
+
+    job.refresh_from_db()
+    assert Job.objects.count() == 1
+    assert job.run_after >= first_run_after
+    assert not AllocatedCost.objects.filter(cost_pool__name__in=['Drayage', 'Handling', 'Freight Cost']).exists()
+    assert jobs.claim_next_job() is None
+
+    Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+    claimed = jobs.claim_next_job()
+    assert claimed.pk == job.pk
+    assert jobs.execute_job(job.pk) == Job.Status.SUCCEEDED
+    job.refresh_from_db()
+    assert (job.result['pools'], job.result['invoices']) == (3, 0)
+    for name, total in [('Drayage', '100'), ('Handling', '40'), ('Freight Cost', '900')]:
+        assert sum(AllocatedCost.objects.filter(cost_pool__name=name).values_list(
+            'amount_allocated', flat=True)) == Decimal(total)
+    assert results_watermark().is_current
+
+
+@pytest.mark.django_db
+def test_debounce_is_capped_by_the_maximum_delay(queued, settings):
+    job = schedule_recalculation()
+    settings.COGS_RECALC_MAX_DELAY_SECONDS = 0
+    assert schedule_recalculation().pk == job.pk
+    job.refresh_from_db()
+    assert job.run_after == job.created_at
+    assert jobs.claim_next_job().pk == job.pk
+    # Edits made while it runs wait for the next one.
+    assert schedule_recalculation().pk != job.pk
+
+
+@pytest.mark.django_db
+def test_results_page_shows_how_current_it_is(client, queued):
+    response = client.get(reverse('results'))
+    assert response.context['watermark'].is_current
+    assert b'Results are current as of' not in response.content
+
+    add_cost(client, 'Drayage', '100')
+    mark = RecalcMark.objects.get()
+    response = client.get(reverse('results'))
+    watermark = response.context['watermark']
+    assert watermark.current_as_of == mark.marked_at
+    assert watermark.job == Job.objects.get()
+    assert b'Later changes will be recalculated at' in response.content
+
+
+@pytest.mark.django_db
+def test_deleting_a_pool_leaves_the_others_alone(client, queued):
+    _, pools = queued
+    before = list(AllocatedCost.objects.exclude(cost_pool=pools[0]).values_list('pk', 'amount_allocated'))
+    client.get(reverse('delete_cost_pool', args=[pools[0].pk]))
+    assert not CostPool.objects.filter(pk=pools[0].pk).exists()
+    assert list(AllocatedCost.objects.values_list('pk', 'amount_allocated')) == before
+    assert not Job.objects.exists()
+
+
+@pytest.mark.django_db
+def test_a_job_pushed_back_after_it_was_selected_is_not_claimed(queued):
+    job = schedule_recalculation()
+    Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+    selected = Job.objects.get(pk=job.pk)
+    # An edit lands between a worker's select and its claim.
+    schedule_recalculation()
+    assert not jobs.claim_job(selected)
+    assert Job.objects.get(pk=job.pk).status == Job.Status.QUEUED
+
+
+@pytest.mark.django_db
+def test_queueing_the_first_job_is_serialized(queued, monkeypatch):
+    plans = []
+    acquire = locks._acquire
+    monkeypatch.setattr(locks, '_acquire', lambda plan: plans.append(plan) or acquire(plan))
+    first = schedule_recalculation()
+    assert schedule_recalculation().pk == first.pk
+    assert plans == [{locks.lock_key(locks.NAME, zlib.crc32(RECALC_KIND.encode())): False}] * 2
+    assert Job.objects.count() == 1
@@ -0,0 +1,132 @@
+import csv
+import io
+import pytest
+from decimal import Decimal
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.urls import reverse
+from cogs import jobs
+from cogs.ingestion import InvoiceIngestor
+from cogs.models import Container, Invoice, InvoiceLine, SKU, Job, UploadRecord
+from cogs.uploads import fingerprint_text, line_hash
+
+HEADER = 'Invoice#,Invoice date,Container ID,PO#,SKU,Quantity,Price,Total,Volume\n'
+ROWS = [
+    'I1,2023-01-01,C1,PO1,SKU1,2,5.00,10.00,100',
+    'I1,2023-01-01,C1,PO1,SKU2,1,3.00,3.00,50',
+    'I2,2023-01-01,C1,PO2,SKU1,4,5.00,20.00,100',
+]
+
+
+def upload(rows, country=None, replace=False):
+    content = (HEADER + ''.join(row + '\n' for row in rows)).encode()
+    name = jobs.save_upload(SimpleUploadedFile('inv.csv', content))
+    return jobs.enqueue('invoice_upload', {'file_name': 'inv.csv', 'country_origin': country,
+                                           'replace_lines': replace, 'files': [name]})
+
+
+def test_text_fingerprint_ignores_line_endings_and_blank_lines():
+    unix = b'a,b\n1,2\n'
+    windows = b'\xef\xbb\xbfa,b\r\n1,2  \r\n\r\n'
+    assert fingerprint_text([unix]) == fingerprint_text([windows[:5], windows[5:]])
+    assert fingerprint_text([unix]) != fingerprint_text([b'a,b\n1,3\n'])
+    assert fingerprint_text([unix]) != fingerprint_text([unix], salt='CN')
+
+
+@pytest.mark.django_db
+def test_identical_resubmission_short_circuits(eager_jobs):
+    first = upload(ROWS)
+    assert first.status == Job.Status.SUCCEEDED
+    assert InvoiceLine.objects.count() == 3
+
+    again = upload(list(ROWS))
+    assert again.status == Job.Status.SUCCEEDED
+    assert again.result['duplicate_of'] == first.pk
+    assert 'already imported' in again.result['message']
+    assert InvoiceLine.objects.count() == 3
+    assert UploadRecord.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_resubmission_after_clearing_imports_again(eager_jobs, client, django_user_model):
+    upload(ROWS)
+    client.force_login(django_user_model.objects.create_user('finance'))
+    client.get(reverse('clear_invoice_data'))
+    assert not UploadRecord.objects.exists()
+
+    again = upload(ROWS)
+    assert 'duplicate_of' not in again.result
+    assert again.result['lines_created'] == 3
+    assert InvoiceLine.objects.count() == 3
+
+
+@pytest.mark.django_db
+def test_older_file_uploaded_again_is_restored(eager_jobs):
+    first = upload(ROWS, replace=True)
+    upload([ROWS[0], 'I1,2023-01-01,C1,PO1,SKU2,3,3.00,9.00,50', ROWS[2]], replace=True)
+
+    restored = upload(ROWS, replace=True)
+    assert 'duplicate_of' not in restored.result
+    assert (restored.result['lines_created'], restored.result['lines_deleted']) == (1, 1)
+    assert sorted(InvoiceLine.objects.filter(invoice__invoice_number='I1').values_list('sku__sku', 'quantity')) == [
+        ('SKU1', 2), ('SKU2', 1)]
+    assert UploadRecord.objects.count() == 2
+    assert not UploadRecord.objects.filter(job=first).exists()
+    # Now the latest again, so a further copy is a duplicate.
+    assert upload(ROWS, replace=True).result['duplicate_of'] == restored.pk
+
+
+@pytest.mark.django_db
+def test_same_file_with_other_country_is_not_a_duplicate(eager_jobs):
+    upload(ROWS, country='CN')
+    again = upload(ROWS, country='VN')
+    assert 'duplicate_of' not in again.result
+    # Every row matches an existing line, so nothing is added.
+    assert again.result['lines_unchanged'] == 3
+    assert InvoiceLine.objects.count() == 3
+
+
+@pytest.mark.django_db
+def test_invoice_split_across_uploads_keeps_both_parts(eager_jobs):
+    upload(ROWS[:1])
+    job = upload(ROWS)
+
+    assert (job.result['lines_created'], job.result['lines_unchanged'], job.result['lines_deleted']) == (2, 1, 0)
+    assert sorted(InvoiceLine.objects.values_list('invoice__invoice_number', 'sku__sku', 'quantity')) == [
+        ('I1', 'SKU1', 2), ('I1', 'SKU2', 1), ('I2', 'SKU1', 4)]
+
+    job = upload(['I1,2023-01-01,C1,PO1,SKU3,7,1.00,7.00,10'])
+    assert (job.result['lines_created'], job.result['lines_deleted']) == (1, 0)
+    assert InvoiceLine.objects.filter(invoice__invoice_number='I1').count() == 3
+
+
+@pytest.mark.django_db
+def test_replacing_upload_applies_only_differences(eager_jobs):
+    upload(ROWS)
+    unchanged_ids = set(InvoiceLine.objects.filter(invoice__invoice_number='I2').values_list('id', flat=True))
+
+    changed = [ROWS[0], 'I1,2023-01-01,C1,PO1,SKU2,3,3.00,9.00,50', ROWS[2], ROWS[2]]
+    job = upload(changed, replace=True)
+    assert 'removed' in job.result['message']
+
+    assert (job.result['lines_created'], job.result['lines_unchanged'], job.result['lines_deleted']) == (2, 2, 1)
+    i1 = sorted(InvoiceLine.objects.filter(invoice__invoice_number='I1').values_list('sku__sku', 'quantity'))
+    assert i1 == [('SKU1', 2), ('SKU2', 3)]
+    i2_ids = set(InvoiceLine.objects.filter(invoice__invoice_number='I2').values_list('id', flat=True))
+    assert len(i2_ids) == 2 and unchanged_ids < i2_ids
+
+
+@pytest.mark.django_db
+def test_lines_without_row_hash_are_matched_by_value():
+    container = Container.objects.create(container_id='C1')
+    invoice = Invoice.objects.create(invoice_number='I1', invoice_date='2023-01-01', container=container, po_number='PO1')
+    sku = SKU.objects.create(sku='SKU1')
+    legacy = InvoiceLine.objects.create(invoice=invoice, sku=sku, quantity=2, price_vendor=Decimal('5'),
+                                        total_vendor=Decimal('10'), unit_volume_cc=100)
+    assert legacy.row_hash == ''
+
+    rows = list(csv.DictReader(io.StringIO(HEADER + ROWS[0] + '\n')))
+    result = InvoiceIngestor().ingest(rows)
+
+    assert (result.lines_created, result.lines_unchanged, result.lines_deleted) == (0, 1, 0)
+    assert list(InvoiceLine.objects.values_list('id', flat=True)) == [legacy.pk]
+    assert line_hash('SKU1', 2, '5.00', '10', 100) == line_hash('SKU1', 2.0, Decimal('5'), Decimal('10.00'), 100.0)
@@ -0,0 +1,82 @@
+import pytest
+from decimal import Decimal
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.urls import reverse
+from cogs import jobs
+from cogs.models import HTSUSCode, SKU
+from cogs.upsert import bulk_upsert, import_sku_rows, upsert_htsus_codes
+
+
+@pytest.mark.django_db
+def test_bulk_upsert_counts_created_updated_unchanged():
+    HTSUSCode.objects.create(code='1111', description='same', rate_pct=Decimal('3.5'))
+    HTSUSCode.objects.create(code='2222', description='old', rate_pct=Decimal('1'))
+
+    result = upsert_htsus_codes([
+        {'code': '1111', 'description': 'same', 'rate_pct': Decimal('3.5000')},
+        {'code': '2222', 'description': 'new', 'rate_pct': Decimal('1')},
+        {'code': '3333', 'description': 'first', 'rate_pct': None},
+        {'code': '3333', 'description': 'last wins', 'rate_pct': Decimal('2')},
+    ])
+
+    assert (result.created, result.updated, result.unchanged) == (1, 1, 1)
+    assert HTSUSCode.objects.get(code='2222').description == 'new'
+    assert HTSUSCode.objects.get(code='3333').rate_pct == Decimal('2')
+
+
+@pytest.mark.django_db
+def test_bulk_upsert_query_count_is_independent_of_row_count(django_assert_max_num_queries):
+    rows = [{'code': f'{n:04}', 'description': 'd', 'rate_pct': Decimal(n % 7)} for n in range(2500)]
+    with django_assert_max_num_queries(30):
+        result = bulk_upsert(HTSUSCode, rows, 'code', ['description', 'rate_pct'], batch_size=1000)
+    assert result.created == 2500
+    rows[0]['description'] = 'changed'
+    assert bulk_upsert(HTSUSCode, rows, 'code', ['description', 'rate_pct']).updated == 1
+
+
+@pytest.mark.django_db
+def test_import_sku_rows_resolves_hts_foreign_keys():
+    SKU.objects.create(sku='A', name='A')
+    old_hts = HTSUSCode.objects.create(code='9999', description='x', rate_pct=1)
+    SKU.objects.create(sku='B', name='Bee', htsus_code=old_hts)
+
+    sku_result, hts_result = import_sku_rows([
+        {'sku': 'A', 'name': 'Widget', 'htsus_code': '1234', 'htsus_rate_pct': '3.5', 'description': 'Widgets'},
+        {'sku': 'B', 'name': 'Bee', 'htsus_code': '9999', 'htsus_rate_pct': '1', 'description': 'x'},
+        {'sku': 'C', 'name': '', 'htsus_code': '', 'htsus_rate_pct': ''},
+        {'sku': '  ', 'name': 'skipped', 'htsus_code': '', 'htsus_rate_pct': ''},
+    ])
+
+    assert (sku_result.created, sku_result.updated, sku_result.unchanged) == (1, 1, 1)
+    assert (hts_result.created, hts_result.updated, hts_result.unchanged) == (1, 0, 1)
+    a = SKU.objects.get(sku='A')
+    assert a.name == 'Widget'
+    assert a.htsus_code.code == '1234'
+    assert a.htsus_code.rate_pct == Decimal('3.5')
+    c = SKU.objects.get(sku='C')
+    assert c.name == 'C' and c.htsus_code is None
+
+
+@pytest.mark.django_db
+def test_import_sku_rows_rejects_bad_rate():
+    with pytest.raises(ValueError, match="Invalid rate format 'abc'"):
+        import_sku_rows([{'sku': 'A', 'name': 'A', 'htsus_code': '1', 'htsus_rate_pct': 'abc'}])
+    assert not SKU.objects.exists()
+
+
+@pytest.mark.django_db
+def test_htsus_bulk_upload_job_reports_unchanged(eager_jobs):
+    HTSUSCode.objects.create(code='1111', description='same', rate_pct=Decimal('3.5'))
+    content = b'code,description,rate_pct\n1111,same,3.5\n2222,new,\n'
+    name = jobs.save_upload(SimpleUploadedFile('hts.csv', content))
+    job = jobs.enqueue('htsus_bulk_upload', {'file_name': 'hts.csv', 'files': [name]})
+    assert (job.result['created'], job.result['updated'], job.result['unchanged']) == (1, 0, 1)
+    assert HTSUSCode.objects.get(code='2222').rate_pct is None
+
+
+@pytest.mark.django_db
+def test_sku_upload_view(client):
+    content = b'sku,name,htsus_code,htsus_rate_pct\nA,Widget,1234,3.5\n'
+    response = client.post(reverse('sku_upload'), {'file': SimpleUploadedFile('skus.csv', content)})
+    assert response.status_code == 302
+    assert SKU.objects.get(sku='A').htsus_code.code == '1234'
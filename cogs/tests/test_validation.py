@@ -0,0 +1,108 @@
+import io
+import time
+import pytest
+import numpy as np
+import pandas as pd
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.urls import reverse
+from cogs import jobs
+from cogs.models import Job, InvoiceLine
+from cogs.ingestion import parse_invoice_date
+from cogs.validation import parse_dates, validate_invoice_file
+
+HEADER = 'Invoice#,Invoice date,Container ID,PO#,SKU,Quantity,Price,Total,Volume\n'
+
+
+def csv_file(*rows):
+    return io.BytesIO((HEADER + ''.join(row + '\n' for row in rows)).encode('utf-8'))
+
+
+def test_parse_dates_matches_row_by_row_parser():
+    values = ['2023-01-05', '01/05/23', '05.01.2023', '01/05/2023', '1/5/2023', '2023/01/05', '', '13/40/2023']
+    parsed = parse_dates(pd.Series(values))
+    for value, result in zip(values, parsed):
+        try:
+            expected = parse_invoice_date(value)
+        except ValueError:
+            assert pd.isna(result), value
+        else:
+            assert result.date() == expected, value
+
+
+def test_valid_file_has_no_errors():
+    report = validate_invoice_file(csv_file(
+        'I1,2023-01-01,C1,PO1,SKU1,3,3.33,10.00,100',
+        'I1,01/02/2023,C1,PO1,SKU2,2.0,5,10,50.5',
+    ))
+    assert report.rows == 2
+    assert report.is_valid
+
+
+def test_every_bad_row_is_reported():
+    report = validate_invoice_file(csv_file(
+        'I1,yesterday,C1,PO1,SKU1,2,5.00,10.00,100',
+        'I1,2023-01-01,C1,PO1,SKU1,two,5.00,10.00,100',
+        'I1,2023-01-01,C1,PO1,SKU1,2,5.00,11.00,100',
+        'I1,2023-01-01,C1,PO1,,2.5,5.00,12.50,n/a',
+    ))
+    assert [(e['row'], e['column'], e['message']) for e in report.errors] == [
+        (2, 'Invoice date', report.errors[0]['message']),
+        (3, 'Quantity', 'Not a number'),
+        (4, 'Total', 'Does not match Price × Quantity'),
+        (5, 'SKU', 'Value is required'),
+        (5, 'Quantity', 'Not a whole number'),
+        (5, 'Volume', 'Not a number'),
+    ]
+    assert report.errors[1]['value'] == 'two'
+
+
+def test_missing_column_is_reported_once():
+    source = io.BytesIO(b'Invoice#,SKU\nI1,SKU1\n')
+    report = validate_invoice_file(source)
+    assert {e['column'] for e in report.errors} >= {'Invoice date', 'Quantity'}
+    assert all(e['row'] == 1 for e in report.errors)
+
+
+def test_chunked_validation_reports_file_rows():
+    rows = ['I1,2023-01-01,C1,PO1,SKU1,2,5.00,10.00,100'] * 5
+    rows[3] = 'I1,2023-13-01,C1,PO1,SKU1,2,5.00,10.00,100'
+    report = validate_invoice_file(csv_file(*rows), chunk_rows=2)
+    assert report.rows == 5
+    assert [e['row'] for e in report.errors] == [5]
+
+
+def test_100k_rows_validate_quickly():
+    n = 100_000
+    frame = pd.DataFrame({
+        'Invoice#': [f'I{i % 100}' for i in range(n)],
+        'Invoice date': np.where(np.arange(n) % 2, '2023-01-01', '01/02/2023'),
+        'Container ID': 'C1',
+        'PO#': 'PO1',
+        'SKU': [f'SKU{i % 1000}' for i in range(n)],
+        'Quantity': '2',
+        'Price': '5.00',
+        'Total': '10.00',
+        'Volume': '100',
+    })
+    source = io.BytesIO(frame.to_csv(index=False).encode())
+    start = time.perf_counter()
+    report = validate_invoice_file(source)
+    assert report.is_valid and report.rows == n
+    # Generous bound so that slow CI machines do not flake.
+    assert time.perf_counter() - start < 5
+
+
+@pytest.mark.django_db
+def test_invalid_upload_fails_job_without_writing(eager_jobs, client):
+    content = (HEADER + 'I1,2023-01-01,C1,PO1,SKU1,2,5.00,10.00,100\n'
+               'I1,2023-01-01,C1,PO1,SKU1,2,5.00,99.00,100\n').encode()
+    name = jobs.save_upload(SimpleUploadedFile('inv.csv', content))
+    job = jobs.enqueue('invoice_upload', {'file_name': 'inv.csv', 'files': [name]})
+
+    assert job.status == Job.Status.FAILED
+    assert job.result['error_count'] == 1
+    assert job.result['errors'][0]['row'] == 3
+    assert not InvoiceLine.objects.exists()
+
+    page = client.get(reverse('job_detail', args=[job.pk]))
+    assert b'Does not match Price' in page.content
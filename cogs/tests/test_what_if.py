@@ -0,0 +1,87 @@
+import json
+import pytest
+from decimal import Decimal
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from cogs.models import AllocatedCost, Container, CostPool, HTSUSCode, Invoice, InvoiceLine, SKU
+from cogs.services import AllocationService
+from tariff.models import Country
+
+
+@pytest.fixture
+def landed():
+    Country.objects.create(name='China', code='CN', section_301_rate=Decimal('7.5'))
+    code = HTSUSCode.objects.create(code='9403.60', description='Furniture', rate_pct=Decimal('4'))
+    skus = [SKU.objects.create(sku='CHAIR', htsus_code=code), SKU.objects.create(sku='LAMP', htsus_rate_pct=Decimal('1'))]
+    containers = [Container.objects.create(container_id=f'C{n}') for n in range(2)]
+    for n in range(4):
+        invoice = Invoice.objects.create(invoice_number=f'I{n}', invoice_date='2023-01-01', container=containers[n % 2],
+                                         country_origin='CN' if n % 2 else '')
+        for q in range(1, 4):
+            InvoiceLine.objects.create(invoice=invoice, sku=skus[q % 2], quantity=q, price_vendor=Decimal('12.34') * q,
+                                       total_vendor=Decimal('12.34') * q * q, unit_volume_cc=10 * q)
+    freight = CostPool.objects.create(name='Freight Cost', scope=CostPool.Scope.ALL, method=CostPool.Method.VOLUME,
+                                      amount_total=Decimal('500.00'))
+    AllocationService().allocate_cost(freight)
+    return containers, freight
+
+
+def comparable(rows):
+    return [(row['line'].pk, {key: value for key, value in row.items() if key != 'line'}) for row in rows]
+
+
+def results_rows(client, **params):
+    return comparable(client.get(reverse('results'), params).context['results_data'])
+
+
+def writes(queries):
+    return [query['sql'] for query in queries if not query['sql'].lstrip().upper().startswith('SELECT')]
+
+
+@pytest.mark.django_db
+def test_what_if_matches_results_after_adding_the_pool(client, landed, settings):
+    settings.COGS_JOBS_EAGER = True  # run the scheduled recalculation in the request
+    containers, _ = landed
+    form = {'cost_name': 'Drayage', 'cost_amount': '321.09', 'allocation_scope': 'container',
+            'allocation_method': 'quantity', 'container_id': str(containers[1].pk)}
+    pool = CostPool(name='Drayage', scope=CostPool.Scope.CONTAINER, method=CostPool.Method.QUANTITY,
+                    amount_total=Decimal('321.09'), container_id=containers[1].pk)
+    with CaptureQueriesContext(connection) as queries:
+        preview = comparable(AllocationService().what_if([pool]))
+    assert writes(queries.captured_queries) == []
+    assert not CostPool.objects.filter(name='Drayage').exists()
+
+    response = client.post(reverse('add_custom_cost'), json.dumps(form), content_type='application/json')
+    assert response.json()['success']
+    assert preview == results_rows(client)
+    assert sum(row['other_cost_allocations'].get('Drayage', 0) for _, row in preview) == Decimal('321.09')
+
+
+@pytest.mark.django_db
+def test_what_if_replaces_a_stored_pool_and_overrides_rates(client, landed):
+    _, freight = landed
+    before = results_rows(client)
+    quote = CostPool(pk=freight.pk, name='Freight Cost', scope=CostPool.Scope.ALL, method=CostPool.Method.VOLUME,
+                     amount_total=Decimal('800.00'))
+    rows = AllocationService().what_if([quote], rate_overrides={'9403.60': Decimal('10')})
+    assert sum(row['freight_cost'] for row in rows) == Decimal('800.00')
+    for (_, old), row in zip(before, rows):
+        if row['line'].sku.sku == 'CHAIR':
+            assert row['htsus_tariff'] == old['htsus_tariff'] * Decimal('2.5')
+        else:  # the SKU's own rate still wins
+            assert row['htsus_tariff'] == old['htsus_tariff']
+    assert AllocatedCost.objects.filter(cost_pool=freight).count() == 12
+    assert results_rows(client) == before
+
+
+@pytest.mark.django_db
+def test_preview_view_filters_lines(client, landed):
+    containers, _ = landed
+    form = {'cost_name': 'Exam', 'cost_amount': '90', 'allocation_scope': 'all', 'allocation_method': 'weight',
+            'container': 'C0'}
+    data = client.post(reverse('preview_custom_cost'), json.dumps(form), content_type='application/json').json()
+    assert data['success']
+    assert len(data['lines']) == 6
+    assert {line['other_cost_allocations']['Exam'] for line in data['lines']} == {'7.50'}
+    assert not CostPool.objects.filter(name='Exam').exists()
@@ -0,0 +1,91 @@
+import io
+import pytest
+from datetime import date, datetime
+from decimal import Decimal
+from openpyxl import Workbook
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from cogs import jobs
+from cogs.models import HTSUSCode, Job
+from consolidation_app import tasks as consolidation_tasks
+from consolidation_app.models import Budget, BudgetFinancialData, ChartOfAccount, Company, FinancialData
+
+
+def workbook_upload(name, rows):
+    workbook = Workbook()
+    for row in rows:
+        workbook.active.append(row)
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return jobs.save_upload(SimpleUploadedFile(name, buffer.getvalue()))
+
+
+pytestmark = pytest.mark.usefixtures('eager_jobs')
+
+
+@pytest.mark.django_db
+def test_htsus_workbook_upload():
+    name = workbook_upload('hts.xlsx', [['code', 'description', 'rate_pct'], [1234, 'Chairs', 3.5], ['5678', None, None]])
+    job = jobs.enqueue('htsus_bulk_upload', {'file_name': 'hts.xlsx', 'files': [name]})
+    assert job.status == Job.Status.SUCCEEDED, job.error
+    assert HTSUSCode.objects.get(code='1234').rate_pct == Decimal('3.5')
+    assert HTSUSCode.objects.get(code='5678').rate_pct is None
+
+
+@pytest.mark.django_db
+def test_financial_workbook_upload_creates_accounts_and_data():
+    company = Company.objects.create(name='Acme')
+    ChartOfAccount.objects.create(account_number='4000', account_name='Sales', account_type='Income', category='Income')
+    name = workbook_upload('gl.xlsx', [
+        ['Acc#', 'Name', 'PTD'],
+        [4000, 'Sales', 100.5],
+        [5000, 'Rent', 20],
+        [5000, 'Rent', None],
+    ])
+    job = jobs.enqueue('financial_upload', {'file_name': 'gl.xlsx', 'company_id': company.pk, 'files': [name]})
+    assert job.status == Job.Status.FAILED  # duplicate GL in one period, as before
+    assert not FinancialData.objects.exists()
+
+    name = workbook_upload('gl.xlsx', [['Acc#', 'Name', 'PTD'], [4000, 'Sales', 100.5], [5000, 'Rent', None]])
+    job = jobs.enqueue('financial_upload', {'file_name': 'gl.xlsx', 'company_id': company.pk, 'files': [name]})
+    assert job.status == Job.Status.SUCCEEDED, job.error
+    assert [code['account_number'] for code in job.result['new_gl_codes']] == ['5000']
+    assert ChartOfAccount.objects.get(account_number='5000').is_new_pending_approval
+    values = dict(FinancialData.objects.values_list('chart_of_account__account_number', 'ptd_value'))
+    assert values == {'4000': Decimal('100.50'), '5000': Decimal('0')}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_financial_upload_suggests_categories_outside_the_transaction(monkeypatch):
+    company = Company.objects.create(name='Acme')
+    calls = []
+
+    def suggest(account_name):
+        calls.append((account_name, connection.in_atomic_block))
+        return 'Operating Expense'
+
+    monkeypatch.setattr(consolidation_tasks, 'get_llm_category_suggestion', suggest)
+    name = jobs.save_upload(SimpleUploadedFile('gl.csv', b'Acc#,Name,PTD\n5000,Rent,20\n6000,Travel,5\n5000,Rent,1\n'))
+    job = jobs.enqueue('financial_upload', {'file_name': 'gl.csv', 'company_id': company.pk, 'files': [name]})
+    assert job.status == Job.Status.FAILED  # duplicate GL in one period
+    # One call per distinct new code, none holding the write lock.
+    assert calls == [('Rent', False), ('Travel', False)]
+    assert not ChartOfAccount.objects.exists()
+
+
+@pytest.mark.django_db
+def test_budget_upload_updates_cells_from_csv_and_workbook():
+    company = Company.objects.create(name='Acme')
+    budget = Budget.objects.create(name='FY24', company=company, period_start_date=date(2024, 1, 1), period_end_date=date(2024, 12, 31))
+    ChartOfAccount.objects.create(account_number='4000', account_name='Sales', account_type='Income', category='Income')
+
+    csv_name = jobs.save_upload(SimpleUploadedFile('b.csv', b'Acc#,Name,2024-01-01,2024-02-01\n4000,Sales,10,\n9999,Unknown,1,1\n'))
+    job = jobs.enqueue('budget_upload', {'file_name': 'b.csv', 'budget_id': budget.pk, 'files': [csv_name]})
+    assert job.status == Job.Status.SUCCEEDED, job.error
+
+    name = workbook_upload('b.xlsx', [['Acc#', 'Name', datetime(2024, 1, 1), datetime(2024, 3, 1)], [4000, 'Sales', 12.5, 7]])
+    job = jobs.enqueue('budget_upload', {'file_name': 'b.xlsx', 'budget_id': budget.pk, 'files': [name]})
+    assert job.status == Job.Status.SUCCEEDED, job.error
+
+    cells = dict(BudgetFinancialData.objects.values_list('period_date', 'budget_value'))
+    assert cells == {date(2024, 1, 1): Decimal('12.50'), date(2024, 2, 1): Decimal('0'), date(2024, 3, 1): Decimal('7')}
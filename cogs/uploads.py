@@ -0,0 +1,152 @@
+"""Content fingerprints for uploaded files and invoice rows.
+
+Every processed upload is recorded in ``UploadRecord`` under a SHA-256 of
+its normalized content, so resubmitting the same file is answered with the
+earlier result instead of being imported again.  Text files are hashed
+after decoding, with line endings, trailing whitespace and blank lines
+normalized away, so a CSV re-saved on another platform still matches;
+binary files (Excel workbooks) are hashed byte for byte.  Zip archives of
+CSV files are hashed by member name and normalized content, so zipping
+the same files again matches too.
+
+Only the latest upload of the same data counts as a duplicate: after
+uploading file A, then B, uploading A again imports it, so an older file
+can be restored.  Clearing the imported data forgets the uploads with it
+(``forget_uploads``).
+
+Invoice lines additionally carry a ``row_hash`` of their own values, which
+lets ``InvoiceIngestor`` apply only the rows of a re-uploaded invoice that
+actually changed.
+"""
+import hashlib
+from decimal import Decimal
+
+from .models import UploadRecord
+from .readers import iter_lines, iter_text
+
+TEXT_EXTENSIONS = ('.csv', '.txt')
+CHUNK_SIZE = 64 * 1024
+CENT = Decimal('0.01')
+
+
+def fingerprint_text(chunks, salt=''):
+    """SHA-256 of the normalized text decoded from an iterable of byte chunks."""
+    digest = hashlib.sha256(salt.encode('utf-8'))
+    for line in iter_lines(iter_text(chunks)):
+        line = line.rstrip()
+        if line:
+            digest.update(line.encode('utf-8'))
+            digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def fingerprint_bytes(chunks, salt=''):
+    """SHA-256 of the raw bytes of an iterable of byte chunks."""
+    digest = hashlib.sha256(salt.encode('utf-8'))
+    for chunk in chunks:
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint_file(file, file_name, salt=''):
+    """Fingerprint a Django ``File``, streaming it with ``chunks()``.
+
+    ``salt`` folds upload options that change the outcome (such as the
+    invoice country of origin) into the fingerprint.  The file is rewound
+    afterwards.
+    """
+    if file_name.lower().endswith(TEXT_EXTENSIONS):
+        sha256 = fingerprint_text(file.chunks(), salt)
+    else:
+        sha256 = fingerprint_bytes(file.chunks(), salt)
+    file.seek(0)
+    return sha256
+
+
+def fingerprint_archive(archive, names, salt=''):
+    """Fingerprint the text members ``names`` of a ``ZipFile``.
+
+    Members are taken in name order and hashed like text files, so archive
+    timestamps, compression and member order do not matter.
+    """
+    digest = hashlib.sha256(salt.encode('utf-8'))
+    for name in sorted(names):
+        with archive.open(name) as member:
+            sha256 = fingerprint_text(iter(lambda: member.read(CHUNK_SIZE), b''))
+        digest.update(f'{name}\x00{sha256}\n'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+# Upload kinds that write the same data; a later upload of any of them
+# supersedes an earlier one.
+UPLOAD_GROUPS = [
+    ('invoice_upload', 'invoice_archive_upload'),
+    ('htsus_bulk_upload',),
+]
+INVOICE_UPLOAD_KINDS = UPLOAD_GROUPS[0]
+
+
+def upload_group(kind):
+    return next((group for group in UPLOAD_GROUPS if kind in group), (kind,))
+
+
+def previous_upload(kind, sha256):
+    """The record of an earlier import of the same content, if nothing of its kind was imported since.
+
+    A record superseded by a later upload is deleted, so the import about
+    to run can record the content again.
+    """
+    record = UploadRecord.objects.filter(kind=kind, sha256=sha256).select_related('job').first()
+    if record is None:
+        return None
+    if UploadRecord.objects.filter(kind__in=upload_group(kind), pk__gt=record.pk).exists():
+        UploadRecord.objects.filter(pk=record.pk).delete()
+        return None
+    return record
+
+
+def forget_uploads(kinds=None):
+    """Delete the upload records of ``kinds`` (all by default), after the data they imported was cleared."""
+    records = UploadRecord.objects.all()
+    if kinds is not None:
+        records = records.filter(kind__in=kinds)
+    return records.delete()
+
+
+def duplicate_result(record):
+    """Job result for a resubmission of the upload in ``record``."""
+    when = record.created_at.strftime('%Y-%m-%d %H:%M')
+    message = f'This file was already imported on {when} ({record.file_name}); nothing was changed.'
+    return {**record.result, 'message': message, 'duplicate_of': record.job_id}
+
+
+def record_upload(kind, sha256, file_name, result, job=None):
+    """Register a processed upload.
+
+    Call it inside the import's transaction so the record and the imported
+    rows commit together.  A concurrent import of the same content makes
+    this raise ``IntegrityError`` and roll the duplicate import back.
+    """
+    return UploadRecord.objects.create(
+        kind=kind,
+        sha256=sha256,
+        file_name=file_name[:255],
+        job=job,
+        result=result,
+    )
+
+
+def line_hash(sku, quantity, price_vendor, total_vendor, unit_volume_cc):
+    """Fingerprint of the values of one invoice line, as they are stored.
+
+    Amounts are quantized to the cent like ``DecimalField`` does on save, so
+    the hash of a parsed CSV row equals the hash of the line it produced.
+    """
+    values = (
+        sku,
+        str(int(quantity)),
+        str(Decimal(price_vendor).quantize(CENT)),
+        str(Decimal(total_vendor).quantize(CENT)),
+        repr(float(unit_volume_cc)),
+    )
+    return hashlib.sha256('\x1f'.join(values).encode('utf-8')).hexdigest()
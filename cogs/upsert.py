@@ -0,0 +1,162 @@
+"""Batched insert-or-update of catalogue rows (HTSUS codes, SKUs).
+
+``bulk_upsert`` replaces per-row ``update_or_create`` loops.  For each batch
+it reads the existing rows with one ``IN`` query, compares values in
+memory and sends only new and changed rows to a single
+``bulk_create(update_conflicts=True)`` statement (``INSERT ... ON CONFLICT
+DO UPDATE`` on both SQLite and PostgreSQL).  Unchanged rows are not
+written at all.
+"""
+from dataclasses import dataclass
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+
+from . import dirty
+from .ingestion import fetch_values_in
+from .models import HTSUSCode, SKU, schedule_checksum
+from .readers import iter_batches
+
+UPSERT_BATCH_SIZE = 1000
+
+
+@dataclass
+class UpsertResult:
+    created: int = 0
+    updated: int = 0
+    unchanged: int = 0
+
+    def __add__(self, other):
+        return UpsertResult(
+            self.created + other.created,
+            self.updated + other.updated,
+            self.unchanged + other.unchanged,
+        )
+
+
+def bulk_upsert(model, rows, unique_field, update_fields, batch_size=UPSERT_BATCH_SIZE, seen=None):
+    """Insert or update ``rows`` (dicts of field values) keyed on ``unique_field``.
+
+    ``update_fields`` may name foreign keys by field name or attname
+    (``htsus_code`` or ``htsus_code_id``); rows use the same keys.  When a
+    key occurs more than once the last row wins, as it would with
+    sequential ``update_or_create`` calls, and the key is counted once.
+    Returns exact created/updated/unchanged counts per distinct key.
+    Pass the same ``seen`` set to several calls to count each key only
+    once across all of them (it collects the keys counted so far).
+    Updates of fields that tariffs depend on are marked for recalculation
+    (see ``cogs.dirty``).
+    """
+    fields = [model._meta.get_field(name) for name in update_fields]
+    result = UpsertResult()
+    # Keys counted by earlier batches (or calls).  Only keys are kept across
+    # batches, never rows, so a long stream of rows is not held in memory.
+    seen = set() if seen is None else seen
+    with transaction.atomic():
+        for batch in iter_batches(rows, batch_size):
+            result += _upsert_batch(model, batch, unique_field, fields, batch_size, seen)
+    return result
+
+
+def _upsert_batch(model, rows, unique_field, fields, batch_size, seen):
+    batch = list({row[unique_field]: row for row in rows}.values())
+    attnames = [field.attname for field in fields]
+    queryset = model.objects.values_list(unique_field, *attnames)
+    keys = [row[unique_field] for row in batch]
+    existing = {values[0]: values[1:] for values in fetch_values_in(queryset, unique_field, keys)}
+
+    result = UpsertResult()
+    to_write = []
+    watched = [i for i, name in enumerate(attnames) if name in dirty.WATCHED_FIELDS.get(model, ())]
+    rate_changes = []
+    for row in batch:
+        values = tuple(
+            field.to_python(row[field.name] if field.name in row else row[field.attname])
+            for field in fields
+        )
+        key = row[unique_field]
+        current = existing.get(key)
+        if key in seen:
+            # Already counted by an earlier batch; write only if it changed again.
+            if current == values:
+                continue
+        else:
+            seen.add(key)
+            if current is None:
+                result.created += 1
+            elif current == values:
+                result.unchanged += 1
+                continue
+            else:
+                result.updated += 1
+        if current is not None and any(current[i] != values[i] for i in watched):
+            rate_changes.append(key)
+        to_write.append(model(**{unique_field: row[unique_field], **dict(zip(attnames, values))}))
+
+    if to_write:
+        model.objects.bulk_create(
+            to_write,
+            batch_size=batch_size,
+            update_conflicts=True,
+            unique_fields=[unique_field],
+            update_fields=[field.name for field in fields],
+        )
+    dirty.rows_changed(model, unique_field, rate_changes)
+    return result
+
+
+def upsert_htsus_codes(rows, batch_size=UPSERT_BATCH_SIZE, seen=None):
+    """Upsert ``{'code', 'description', 'rate_pct'}`` dicts into ``HTSUSCode``.
+
+    The schedule checksum is kept in step so a later delta import of the
+    schedule sees these values as current.
+    """
+    rows = ({**row, 'checksum': schedule_checksum(row['description'], row['rate_pct'])} for row in rows)
+    return bulk_upsert(HTSUSCode, rows, 'code', ['description', 'rate_pct', 'checksum'], batch_size, seen)
+
+
+def import_sku_rows(rows, batch_size=UPSERT_BATCH_SIZE):
+    """Import SKU catalogue CSV rows (``sku``, ``name``, ``htsus_code``, ``htsus_rate_pct``, ``description``).
+
+    HTSUS codes mentioned in the file are upserted first; SKUs then get
+    their ``htsus_code`` foreign key from an in-memory code -> id map.
+    Returns ``(sku_result, hts_result)``.
+    """
+    hts_rows = []
+    sku_rows = []
+    for row in rows:
+        sku_val = (row.get('sku') or '').strip()
+        if not sku_val:
+            continue
+
+        hts_code_str = (row.get('htsus_code') or '').strip()
+        if hts_code_str:
+            rate_str = (row.get('htsus_rate_pct') or '').strip()
+            rate_val = None
+            if rate_str:
+                try:
+                    rate_val = Decimal(rate_str)
+                except InvalidOperation:
+                    raise ValueError(f"Invalid rate format '{rate_str}' for HTSUS {hts_code_str}")
+            hts_rows.append({
+                'code': hts_code_str,
+                'description': (row.get('description') or 'Imported via SKU upload').strip(),
+                'rate_pct': rate_val,
+            })
+
+        sku_rows.append({
+            'sku': sku_val,
+            'name': (row.get('name') or '').strip() or sku_val,
+            '_hts_code': hts_code_str,
+        })
+
+    with transaction.atomic():
+        hts_result = upsert_htsus_codes(hts_rows, batch_size)
+        hts_ids = dict(fetch_values_in(
+            HTSUSCode.objects.values_list('code', 'id'), 'code',
+            {row['_hts_code'] for row in sku_rows if row['_hts_code']},
+        ))
+        for row in sku_rows:
+            row['htsus_code_id'] = hts_ids.get(row.pop('_hts_code'))
+        sku_result = bulk_upsert(SKU, sku_rows, 'sku', ['name', 'htsus_code_id'], batch_size)
+    return sku_result, hts_result
@@ -26,8 +26,11 @@ urlpatterns = [
     path('debug-base-dir/', views.debug_base_dir, name='debug_base_dir'),
     path('add-freight-cost/', views.add_freight_cost, name='add_freight_cost'),
     path('add-custom-cost/', views.add_custom_cost, name='add_custom_cost'),
+    path('preview-custom-cost/', views.preview_custom_cost, name='preview_custom_cost'),
     path('api/containers/', views.get_containers_list, name='get_containers_list'),
     path('api/invoices/', views.get_invoices_list, name='get_invoices_list'),
+    path('jobs/<int:pk>/', views.job_detail, name='job_detail'),
+    path('jobs/<int:pk>/status/', views.job_status, name='job_status'),
     path('reports/', views.reports_list, name='reports_list'),
     path('reports/custom/', views.reports_custom, name='reports_custom'),
     path('reports/<str:batch_name>/', views.reports_detail, name='reports_detail'),
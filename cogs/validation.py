@@ -0,0 +1,162 @@
+"""Vectorized pre-validation of invoice CSV uploads.
+
+The whole file is checked column by column with pandas before
+``InvoiceIngestor`` writes anything, so a file with bad rows is rejected
+with a complete error table instead of failing on the first bad row.
+The checks mirror what ``InvoiceIngestor.parse_row`` would choke on (dates
+in none of ``INVOICE_DATE_FORMATS``, non-numeric amounts) plus a
+consistency check of ``Total`` against ``Price × Quantity``.
+"""
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+from .ingestion import INVOICE_DATE_FORMATS
+
+INVOICE_COLUMNS = ('Invoice date', 'Container ID', 'SKU', 'Invoice#', 'PO#', 'Quantity', 'Price', 'Total', 'Volume')
+KEY_COLUMNS = ('Container ID', 'SKU', 'Invoice#')
+KEY_MAX_LENGTH = 100
+
+# Prices are stored to the cent, so a line total may legitimately differ
+# from price × quantity by half a cent per unit.
+TOTAL_TOLERANCE = 0.01
+TOTAL_TOLERANCE_PER_UNIT = 0.005
+# Largest value that fits DecimalField(max_digits=10, decimal_places=2).
+MAX_AMOUNT = 10 ** 8
+
+VALIDATION_CHUNK_ROWS = 100_000
+MAX_REPORTED_ERRORS = 1000
+
+
+@dataclass
+class ValidationReport:
+    rows: int = 0
+    errors: list = field(default_factory=list)
+    elapsed: float = 0.0
+
+    @property
+    def is_valid(self):
+        return not self.errors
+
+    def as_result(self, limit=MAX_REPORTED_ERRORS):
+        """JSON-serializable summary for a job result; the error list is truncated to ``limit``."""
+        return {
+            'rows': self.rows,
+            'error_count': len(self.errors),
+            'errors': self.errors[:limit],
+        }
+
+
+def parse_dates(values):
+    """Parse a string Series against ``INVOICE_DATE_FORMATS``; unparseable values become NaT.
+
+    Formats are tried in order and the first match wins, as in
+    ``parse_invoice_date``.
+    """
+    parsed = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    for fmt in INVOICE_DATE_FORMATS:
+        pending = parsed.isna()
+        if not pending.any():
+            break
+        parsed[pending] = pd.to_datetime(values[pending], format=fmt, errors='coerce')
+    return parsed
+
+
+def _per_unique(values, func):
+    """Apply the array function ``func`` to the distinct values of ``values`` only.
+
+    Invoice files repeat the same SKUs, containers, dates and prices on many
+    rows, so this is much cheaper than converting every cell.
+    """
+    codes, uniques = pd.factorize(values)
+    return np.asarray(func(pd.Series(uniques, dtype=object)))[codes]
+
+
+def validate_invoice_frame(df, first_row=2):
+    """Return the list of row errors in a frame of invoice CSV rows read as strings.
+
+    Each error is a dict with the spreadsheet ``row`` (the header is row 1),
+    the ``column``, the offending ``value`` and a ``message``.  ``first_row``
+    is the row number of the frame's first row, for chunked reads.
+    """
+    missing = [column for column in INVOICE_COLUMNS if column not in df.columns]
+    if missing:
+        return [{'row': 1, 'column': column, 'value': '', 'message': 'Missing column'} for column in missing]
+
+    rows = np.arange(first_row, first_row + len(df))
+    problems = []
+
+    def flag(mask, column, message):
+        mask = np.asarray(mask, dtype=bool)
+        if mask.any():
+            problems.append((rows[mask], column, df[column].to_numpy()[mask], message))
+
+    for column in KEY_COLUMNS:
+        flag(_per_unique(df[column], lambda u: u.str.strip() == ''), column, 'Value is required')
+    for column in KEY_COLUMNS + ('PO#',):
+        flag(_per_unique(df[column], lambda u: u.str.len() > KEY_MAX_LENGTH),
+             column, f'Longer than {KEY_MAX_LENGTH} characters')
+
+    flag(_per_unique(df['Invoice date'], lambda u: parse_dates(u).isna()), 'Invoice date',
+         f"Date format not supported (expected one of {', '.join(INVOICE_DATE_FORMATS)})")
+
+    numbers = {}
+    for column in ('Quantity', 'Price', 'Total', 'Volume'):
+        values = _per_unique(df[column], lambda u: pd.to_numeric(u, errors='coerce')).astype(float)
+        bad = ~np.isfinite(values)
+        flag(bad, column, 'Not a number')
+        numbers[column] = np.where(bad, np.nan, values)
+
+    quantity, price, total = numbers['Quantity'], numbers['Price'], numbers['Total']
+    with np.errstate(invalid='ignore'):
+        flag(np.isfinite(quantity) & (quantity != np.floor(quantity)), 'Quantity', 'Not a whole number')
+        for column in ('Price', 'Total'):
+            flag(np.abs(numbers[column]) >= MAX_AMOUNT, column, 'Amount too large')
+        tolerance = TOTAL_TOLERANCE + TOTAL_TOLERANCE_PER_UNIT * np.abs(quantity)
+        flag(np.abs(total - price * quantity) > tolerance, 'Total', 'Does not match Price × Quantity')
+
+    errors = [
+        {'row': int(row), 'column': column, 'value': str(value), 'message': message}
+        for row_numbers, column, values, message in problems
+        for row, value in zip(row_numbers, values)
+    ]
+    errors.sort(key=lambda error: (error['row'], INVOICE_COLUMNS.index(error['column'])))
+    return errors
+
+
+def read_invoice_chunks(source, encoding='utf-8-sig', chunk_rows=VALIDATION_CHUNK_ROWS):
+    """Yield string-typed DataFrame chunks of an invoice CSV file object."""
+    with pd.read_csv(source, dtype=str, keep_default_na=False, chunksize=chunk_rows,
+                     encoding=encoding, encoding_errors='replace' if encoding == 'cp1252' else 'strict') as reader:
+        yield from reader
+
+
+def validate_invoice_file(source, chunk_rows=VALIDATION_CHUNK_ROWS):
+    """Validate a whole invoice CSV file object and return a ``ValidationReport``.
+
+    The file is read in chunks of ``chunk_rows`` so memory stays bounded on
+    very large uploads; the caller should rewind it before ingesting.
+    Decoding matches ``readers.iter_text``: UTF-8 (with or without BOM),
+    falling back to cp1252 for files exported from Excel.
+    """
+    start = time.perf_counter()
+    for encoding in ('utf-8-sig', 'cp1252'):
+        source.seek(0)
+        report = ValidationReport()
+        try:
+            for chunk in read_invoice_chunks(source, encoding, chunk_rows):
+                report.errors.extend(validate_invoice_frame(chunk, first_row=report.rows + 2))
+                report.rows += len(chunk)
+                if report.errors and report.errors[0]['message'] == 'Missing column':
+                    break
+        except UnicodeDecodeError:
+            continue
+        except pd.errors.EmptyDataError:
+            report.errors.append({'row': 1, 'column': '', 'value': '', 'message': 'File is empty'})
+        except pd.errors.ParserError as e:
+            report.errors.append({'row': None, 'column': '', 'value': '', 'message': f'Malformed CSV: {e}'})
+        break
+    report.elapsed = time.perf_counter() - start
+    return report
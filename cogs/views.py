@@ -1,20 +1,28 @@
 from django.http import HttpResponse, FileResponse, JsonResponse
 from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse
 import os
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.http import require_POST
+from . import dirty, locks
 from .forms import InvoiceUploadForm, HTSUSCodeForm, SKUForm, CostPoolForm
-from .models import Invoice, InvoiceLine, SKU, Container, HTSUSCode, CostPool, AllocatedCost, SavedResults
+from .models import Invoice, InvoiceLine, SKU, Container, HTSUSCode, CostPool, AllocatedCost, SavedResults, Job
+from .landed import group_allocations, landed_cost_rows, load_lines
+from .packed import allocation_rows
 from .services import AllocationService
-from tariff.models import Country
+from .readers import csv_dict_reader
+from .scheduler import results_watermark, schedule_recalculation
+from .uploads import INVOICE_UPLOAD_KINDS, forget_uploads
+from .upsert import import_sku_rows
+from .jobs import enqueue, save_upload
 import csv
 import io
 import json
 from datetime import datetime
 from decimal import Decimal, InvalidOperation
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 from django.db.models import Count, Sum, Min, Max
 import pandas as pd
 
@@ -27,11 +35,13 @@ def clear_invoice_data(request):
     """Clear only uploaded invoice data, keep SKU and HTS reference data"""
     from cogs.models import Invoice, InvoiceLine, Container, CostPool, AllocatedCost
     # Delete in correct order due to foreign keys
-    AllocatedCost.objects.all().delete()
-    CostPool.objects.all().delete()
-    InvoiceLine.objects.all().delete()
-    Invoice.objects.all().delete()
-    Container.objects.all().delete()
+    with dirty.collecting():
+        AllocatedCost.objects.all().delete()
+        CostPool.objects.all().delete()
+        InvoiceLine.objects.all().delete()
+        Invoice.objects.all().delete()
+        Container.objects.all().delete()
+    forget_uploads(INVOICE_UPLOAD_KINDS)
     messages.success(request, 'All invoice data cleared successfully')
     return redirect('results')
 
@@ -40,15 +50,59 @@ def clear_all_data(request):
     """Clear all invoice data"""
     from cogs.models import Invoice, InvoiceLine, Container, CostPool, AllocatedCost
     # Delete all invoice-related data in correct order
-    AllocatedCost.objects.all().delete()
-    CostPool.objects.all().delete()
-    InvoiceLine.objects.all().delete()
-    Invoice.objects.all().delete()
-    Container.objects.all().delete()
+    with dirty.collecting():
+        AllocatedCost.objects.all().delete()
+        CostPool.objects.all().delete()
+        InvoiceLine.objects.all().delete()
+        Invoice.objects.all().delete()
+        Container.objects.all().delete()
+    forget_uploads(INVOICE_UPLOAD_KINDS)
     messages.success(request, 'All data cleared successfully')
     return redirect('home')
 
 
+def _job_redirect(request, job, success_url, failure_url, error_prefix='Error processing file'):
+    """Redirect after enqueueing ``job``: straight to the outcome if it already ran, else to its status page."""
+    if job.status == Job.Status.SUCCEEDED:
+        messages.success(request, job.result.get('message', 'Done'))
+        if job.result.get('files'):
+            # The job page lists the status of each file of an archive.
+            return redirect('job_detail', pk=job.pk)
+        return redirect(success_url)
+    if job.status == Job.Status.FAILED:
+        messages.error(request, f'{error_prefix}: {job.error}')
+        if job.result.get('errors'):
+            # The job page lists the rejected rows.
+            return redirect('job_detail', pk=job.pk)
+        return redirect(failure_url)
+    messages.info(request, f'Job #{job.pk} queued; this page updates when it finishes.')
+    return redirect('job_detail', pk=job.pk)
+
+
+def job_detail(request, pk):
+    job = get_object_or_404(Job, pk=pk)
+    return render(request, 'job_detail.html', {'job': job})
+
+
+def job_status(request, pk):
+    """Job status and progress; JSON for API clients, an HTML fragment for htmx polling."""
+    job = get_object_or_404(Job, pk=pk)
+    if request.htmx:
+        return render(request, 'partials/job_status.html', {'job': job})
+    return JsonResponse({
+        'id': job.pk,
+        'kind': job.kind,
+        'status': job.status,
+        'finished': job.is_finished,
+        'progress_done': job.progress_done,
+        'progress_total': job.progress_total,
+        'percent': job.percent,
+        'message': job.result.get('message') or job.progress_message,
+        'error': job.error,
+        'result': job.result,
+    })
+
+
 def invoice_upload(request):
     if request.method == 'POST':
         form = InvoiceUploadForm(request.POST, request.FILES)
@@ -57,56 +111,19 @@ def invoice_upload(request):
         if form.is_valid():
             csv_file = request.FILES['file']
             country_origin = form.cleaned_data.get('country_origin') or None
-            if not csv_file.name.endswith('.csv'):
-                messages.error(request, 'This is not a CSV file')
+            if not csv_file.name.endswith(('.csv', '.zip')):
+                messages.error(request, 'Please upload a CSV file or a zip archive of CSV files')
                 return redirect('invoice_upload')
 
-            try:
-                decoded_file = csv_file.read().decode('utf-8')
-                io_string = io.StringIO(decoded_file)
-                reader = csv.DictReader(io_string)
-
-                for row in reader:
-                    # Normalize date format
-                    invoice_date_str = row.get('Invoice date')
-                    invoice_date = None
-                    for fmt in ('%Y-%m-%d', '%m/%d/%y', '%d.%m.%Y', '%m/%d/%Y'):
-                        try:
-                            invoice_date = datetime.strptime(invoice_date_str, fmt).date()
-                            break
-                        except (ValueError, TypeError):
-                            continue
-                    if not invoice_date:
-                        raise ValueError(f"Date format for {invoice_date_str} not supported")
-
-                    container, _ = Container.objects.get_or_create(container_id=row.get('Container ID'))
-                    sku, _ = SKU.objects.get_or_create(sku=row.get('SKU'))
-
-                    invoice, _ = Invoice.objects.get_or_create(
-                        invoice_number=row.get('Invoice#'),
-                        defaults={
-                            'invoice_date': invoice_date,
-                            'container': container,
-                            'country_origin': country_origin,
-                            'po_number': row.get('PO#'),
-                        }
-                    )
-
-                    InvoiceLine.objects.create(
-                        invoice=invoice,
-                        sku=sku,
-                        quantity=int(float(row.get('Quantity'))),
-                        price_vendor=Decimal(row.get('Price')),
-                        total_vendor=Decimal(row.get('Total')),
-                        unit_volume_cc=float(row.get('Volume'))
-                    )
-
-                messages.success(request, 'Invoice uploaded successfully')
-                return redirect('results')
-
-            except Exception as e:
-                messages.error(request, f'Error processing file: {e}')
-                return redirect('invoice_upload')
+            # A zip archive holds one CSV per invoice and is imported as a whole.
+            kind = 'invoice_archive_upload' if csv_file.name.endswith('.zip') else 'invoice_upload'
+            job = enqueue(kind, {
+                'file_name': csv_file.name,
+                'country_origin': country_origin,
+                'replace_lines': form.cleaned_data.get('replace_lines', False),
+                'files': [save_upload(csv_file)],
+            }, user=request.user)
+            return _job_redirect(request, job, 'results', 'invoice_upload')
     else:
         form = InvoiceUploadForm()
     return render(request, 'invoice_upload.html', {'form': form})
@@ -143,67 +160,21 @@ def sku_upload(request):
             return redirect('sku_list')
 
         try:
-            decoded_file = csv_file.read().decode('utf-8')
-            io_string = io.StringIO(decoded_file)
-            reader = csv.DictReader(io_string)
-
-            created_skus, updated_skus = 0, 0
-            created_hts, updated_hts = 0, 0
+            reader = csv_dict_reader(csv_file)
 
             required_headers = ['sku', 'name', 'htsus_code', 'htsus_rate_pct']
             if not all(header in reader.fieldnames for header in required_headers):
                 messages.error(request, f"CSV file must contain headers: {', '.join(required_headers)}")
                 return redirect('sku_list')
 
-            for row in reader:
-                sku_val = (row.get('sku') or '').strip()
-                if not sku_val:
-                    continue
-
-                hts_code_str = (row.get('htsus_code') or '').strip()
-                rate_str = (row.get('htsus_rate_pct') or '').strip()
-                desc = (row.get('description') or 'Imported via SKU upload').strip()
-
-                hts_obj = None
-                if hts_code_str:
-                    rate_val = None
-                    if rate_str:
-                        try:
-                            rate_val = Decimal(rate_str)
-                        except InvalidOperation:
-                            raise ValueError(f"Invalid rate format '{rate_str}' for HTSUS {hts_code_str}")
-
-                    hts_obj, hts_created = HTSUSCode.objects.update_or_create(
-                        code=hts_code_str,
-                        defaults={
-                            'description': desc,
-                            'rate_pct': rate_val,
-                        }
-                    )
-                    if hts_created:
-                        created_hts += 1
-                    else:
-                        updated_hts += 1
-
-                sku_defaults = {
-                    'name': (row.get('name') or '').strip() or sku_val,
-                    'htsus_code': hts_obj
-                }
-
-
-                sku_obj, sku_created = SKU.objects.update_or_create(
-                    sku=sku_val,
-                    defaults=sku_defaults
-                )
-                if sku_created:
-                    created_skus += 1
-                else:
-                    updated_skus += 1
+            sku_result, hts_result = import_sku_rows(reader)
 
             messages.success(
                 request,
-                f"Processing complete. SKU: {created_skus} created, {updated_skus} updated. "
-                f"HTSUS: {created_hts} created, {updated_hts} updated."
+                f"Processing complete. SKU: {sku_result.created} created, {sku_result.updated} updated, "
+                f"{sku_result.unchanged} unchanged. "
+                f"HTSUS: {hts_result.created} created, {hts_result.updated} updated, "
+                f"{hts_result.unchanged} unchanged."
             )
 
         except Exception as e:
@@ -248,6 +219,7 @@ def add_cost_pool(request):
         form = CostPoolForm(request.POST)
         if form.is_valid():
             form.save()
+            schedule_recalculation(request.user)
             messages.success(request, 'Cost pool added successfully')
             return redirect('results')
     else:
@@ -256,13 +228,9 @@ def add_cost_pool(request):
 
 
 def recalculate_costs(request):
-    service = AllocationService()
-    for cost_pool in CostPool.objects.filter(auto_compute=False):
-        service.allocate_cost(cost_pool)
-    for invoice in Invoice.objects.all():
-        service.compute_htsus_for_invoice(invoice)
-    messages.success(request, 'Costs recalculated successfully')
-    return redirect('results')
+    # ?full=1 recomputes everything instead of only what changed.
+    job = enqueue('recalculate_costs', {'full': request.GET.get('full') == '1'}, user=request.user)
+    return _job_redirect(request, job, 'results', 'results', error_prefix='Error recalculating costs')
 
 
 def toggle_htsus(request, invoice_pk):
@@ -278,10 +246,9 @@ def toggle_htsus(request, invoice_pk):
     return redirect('results')
 
 
-def results(request):
-    lines = InvoiceLine.objects.all().select_related('invoice', 'sku').prefetch_related('allocatedcost_set__cost_pool')
-    
-    # Filtering logic here
+def _filtered_lines(request):
+    """Invoice lines narrowed by the container, invoice and date filters of the results page."""
+    lines = InvoiceLine.objects.all()
     container_filter = request.GET.get('container')
     invoice_filter = request.GET.get('invoice')
     date_filter = request.GET.get('date')
@@ -292,55 +259,24 @@ def results(request):
         lines = lines.filter(invoice__invoice_number=invoice_filter)
     if date_filter:
         lines = lines.filter(invoice__invoice_date=date_filter)
+    return lines
 
+
+def _results_rows(lines):
+    """Landed cost rows (see ``cogs.landed``) of ``lines`` from the stored allocations."""
+    names = dict(CostPool.objects.values_list('pk', 'name'))
+    allocations = group_allocations(
+        (line_id, names[pool_id], amount) for line_id, pool_id, amount in allocation_rows(lines)
+    )
+    return landed_cost_rows(load_lines(lines.order_by('pk')), allocations)
+
+
+def results(request):
     # Get all unique names of other custom cost pools for dynamic columns
     other_cost_pool_names = CostPool.objects.exclude(name__in=['Freight Cost', 'HTSUS Tariff']).values_list('name', flat=True).distinct()
 
     # Prepare data for template
-    results_data = []
-    for line in lines:
-        vendor_cost = line.price_vendor * line.quantity
-        freight_cost = line.allocatedcost_set.filter(cost_pool__name='Freight Cost').first()
-        freight_cost_amount = freight_cost.amount_allocated if freight_cost else 0
-        # Calculate HTSUS tariff on the fly based on SKU rates
-        htsus_rate = Decimal('0')
-        if line.sku and line.sku.htsus_rate_pct is not None:
-            htsus_rate = line.sku.htsus_rate_pct
-        elif line.sku and line.sku.htsus_code and line.sku.htsus_code.rate_pct:
-            htsus_rate = line.sku.htsus_code.rate_pct
-        htsus_tariff_amount = vendor_cost * (htsus_rate / Decimal('100'))
-        
-        # Calculate Section 301 duty based on country
-        section_301_amount = Decimal('0')
-        if line.invoice and line.invoice.country_origin:
-            try:
-                country = Country.objects.get(code=line.invoice.country_origin)
-                section_301_rate = country.section_301_rate or Decimal('0')
-                section_301_amount = vendor_cost * (section_301_rate / Decimal('100'))
-            except Country.DoesNotExist:
-                section_301_amount = Decimal('0')
-        
-        # Collect all other allocated costs for this line
-        other_cost_allocations = {}
-        current_line_other_costs_total = Decimal(0)
-        for allocated_cost in line.allocatedcost_set.all():
-            if allocated_cost.cost_pool.name not in ['Freight Cost', 'HTSUS Tariff']:
-                other_cost_allocations[allocated_cost.cost_pool.name] = allocated_cost.amount_allocated
-                current_line_other_costs_total += allocated_cost.amount_allocated
-
-        total_cost = vendor_cost + freight_cost_amount + htsus_tariff_amount + section_301_amount + current_line_other_costs_total
-        unit_total_cost = (total_cost / line.quantity).quantize(Decimal('0.01')) if line.quantity > 0 else Decimal(0)
-
-        results_data.append({
-            'line': line,
-            'vendor_cost': vendor_cost,
-            'freight_cost': freight_cost_amount,
-            'htsus_tariff': htsus_tariff_amount,
-            'section_301': section_301_amount,  # ADD THIS LINE
-            'other_cost_allocations': other_cost_allocations, # New: detailed other costs
-            'total_cost': total_cost,
-            'unit_total_cost': unit_total_cost,
-        })
+    results_data = _results_rows(_filtered_lines(request))
 
     # Get all freight costs for display
     freight_costs = CostPool.objects.filter(name='Freight Cost')
@@ -357,6 +293,7 @@ def results(request):
         'other_custom_costs': other_custom_costs, # Keep for the summary card
         'total_other_custom_costs': total_other_custom_costs, # Keep for the summary card
         'other_cost_pool_names': other_cost_pool_names, # New: for dynamic columns
+        'watermark': results_watermark(),
     })
 
 
@@ -400,87 +337,69 @@ def add_freight_cost(request):
         if total_volume == 0:
             return JsonResponse({'success': False, 'error': 'Total volume is zero. Please ensure invoice items have volume data.'})
         
-        # Create or update freight cost pool with company and invoice info
-        freight_pool, created = CostPool.objects.update_or_create(
-            name='Freight Cost',
-            defaults={
-                'scope': CostPool.Scope.CONTAINER if allocation_scope == 'container' else CostPool.Scope.INVOICE if allocation_scope == 'invoice' else CostPool.Scope.ALL,
-                'method': CostPool.Method.VOLUME if allocation_method == 'volume' else CostPool.Method.PRICE_QUANTITY,
-                'amount_total': Decimal(str(total_freight_cost)),
-                'shipment_company': shipment_company,
-                'shipment_invoice': shipment_invoice,
-                'container_id': container_id if allocation_scope == 'container' and container_id else None,
-                'invoice_id': invoice_id if allocation_scope == 'invoice' and invoice_id else None,
-                'auto_compute': False
-            }
-        )
+        # Create or update freight cost pool with company and invoice info;
+        # the name lock keeps two requests from both creating it.
+        with transaction.atomic():
+            locks.lock_names('Freight Cost')
+            freight_pool, created = CostPool.objects.update_or_create(
+                name='Freight Cost',
+                defaults={
+                    'scope': CostPool.Scope.CONTAINER if allocation_scope == 'container' else CostPool.Scope.INVOICE if allocation_scope == 'invoice' else CostPool.Scope.ALL,
+                    'method': CostPool.Method.VOLUME if allocation_method == 'volume' else CostPool.Method.PRICE_QUANTITY,
+                    'amount_total': Decimal(str(total_freight_cost)),
+                    'shipment_company': shipment_company,
+                    'shipment_invoice': shipment_invoice,
+                    'container_id': container_id if allocation_scope == 'container' and container_id else None,
+                    'invoice_id': invoice_id if allocation_scope == 'invoice' and invoice_id else None,
+                    'auto_compute': False
+                }
+            )
         
-        # Use AllocationService to distribute the cost
-        service = AllocationService()
-        service.allocate_cost(freight_pool)
+        # Allocated by the scheduled recalculation, together with other edits
+        job = schedule_recalculation(request.user)
         
-        return JsonResponse({'success': True, 'message': f'Freight cost ${total_freight_cost} from {shipment_company or "Unknown"} distributed'})
+        return _scheduled_response(job, f'Freight cost ${total_freight_cost} from {shipment_company or "Unknown"}')
         
     except Exception as e:
         return JsonResponse({'success': False, 'error': str(e)})
 
 
+def _scheduled_response(job, cost):
+    """JSON answer for a cost edit left to the recalculation ``job``; poll ``status_url`` until it has run."""
+    allocated = job.status == Job.Status.SUCCEEDED
+    return JsonResponse({
+        'success': True,
+        'message': f'{cost} {"has been allocated" if allocated else "is scheduled for allocation"}',
+        'job_id': job.pk,
+        'job_status': job.status,
+        'status_url': reverse('job_status', args=[job.pk]),
+    })
+
+
 def delete_cost_pool(request, pk):
     cost_pool = get_object_or_404(CostPool, pk=pk)
     cost_pool.delete()
     messages.success(request, f'Removed {cost_pool.name}: ${cost_pool.amount_total}')
-    
-    # Recalculate remaining costs
-    service = AllocationService()
-    for pool in CostPool.objects.filter(auto_compute=False):
-        service.allocate_cost(pool)
-    
+    # Its allocations went with it; the other pools' shares do not depend on it.
     return redirect('results')
 
 
 def htsus_bulk_upload(request):
     if request.method == 'POST' and request.FILES.get('file'):
         file = request.FILES['file']
-        
-        try:
-            # Read file based on extension
-            if file.name.endswith('.csv'):
-                df = pd.read_csv(file)
-            elif file.name.endswith(('.xlsx', '.xls')):
-                df = pd.read_excel(file)
-            else:
-                messages.error(request, 'Please upload a CSV or Excel file')
-                return redirect('htsus_code_list')
-            
-            # Process each row
-            created_count = 0
-            updated_count = 0
-            
-            for _, row in df.iterrows():
-                code = str(row.get('code', '')).strip()
-                if not code:
-                    continue
-                    
-                htsus, created = HTSUSCode.objects.update_or_create(
-                    code=code,
-                    defaults={
-                        'description': str(row.get('description', '')),
-                        'rate_pct': float(row.get('rate_pct', 0))
-                    }
-                )
-                
-                if created:
-                    created_count += 1
-                else:
-                    updated_count += 1
-            
-            messages.success(request, f'Successfully imported {created_count} new codes and updated {updated_count} existing codes')
-            
-        except Exception as e:
-            messages.error(request, f'Error processing file: {str(e)}')
-        
-        return redirect('htsus_code_list')
-    
+
+        if not file.name.endswith(('.csv', '.xlsx', '.xls')):
+            messages.error(request, 'Please upload a CSV or Excel file')
+            return redirect('htsus_code_list')
+
+        job = enqueue('htsus_bulk_upload', {
+            'file_name': file.name,
+            'files': [save_upload(file)],
+            # A full schedule retires the codes it no longer lists.
+            'retire_missing': request.POST.get('full_schedule') in ('1', 'true', 'on'),
+        }, user=request.user)
+        return _job_redirect(request, job, 'htsus_code_list', 'htsus_code_list')
+
     return redirect('htsus_code_list')
 
 
@@ -506,58 +425,93 @@ def export_htsus_codes(request):
     writer = csv.writer(response)
     writer.writerow(['code', 'description', 'rate_pct'])
     
-    for htsus in HTSUSCode.objects.all().order_by('code'):
+    for htsus in HTSUSCode.objects.filter(retired_at__isnull=True).order_by('code'):
         writer.writerow([htsus.code, htsus.description, htsus.rate_pct])
     
     return response
 
 
+def _custom_cost_pool(data):
+    """Unsaved ``CostPool`` for the fields of the add-custom-cost form."""
+    cost_name = data.get('cost_name')
+    cost_amount = float(data.get('cost_amount', 0))
+    allocation_scope = data.get('allocation_scope')
+    allocation_method = data.get('allocation_method')
+    container_id = data.get('container_id', None)
+    invoice_id = data.get('invoice_id', None)
+
+    # Map the form values to model choices
+    scope_map = {
+        'container': CostPool.Scope.CONTAINER,
+        'invoice': CostPool.Scope.INVOICE,
+        'all': CostPool.Scope.ALL
+    }
+
+    method_map = {
+        'volume': CostPool.Method.VOLUME,
+        'price': CostPool.Method.PRICE,
+        'quantity': CostPool.Method.QUANTITY,
+        'weight': CostPool.Method.EQUALLY,  # Use EQUALLY for weight for now
+        'price_quantity': CostPool.Method.PRICE_QUANTITY
+    }
+
+    return CostPool(
+        name=cost_name,
+        scope=scope_map.get(allocation_scope, CostPool.Scope.ALL),
+        method=method_map.get(allocation_method, CostPool.Method.PRICE),
+        amount_total=Decimal(str(cost_amount)),
+        container_id=container_id if allocation_scope == 'container' and container_id else None,
+        invoice_id=invoice_id if allocation_scope == 'invoice' and invoice_id else None,
+        auto_compute=False
+    )
+
+
 @require_POST
 def add_custom_cost(request):
     try:
         data = json.loads(request.body)
-        cost_name = data.get('cost_name')
-        cost_amount = float(data.get('cost_amount', 0))
-        allocation_scope = data.get('allocation_scope')
-        allocation_method = data.get('allocation_method')
-        container_id = data.get('container_id', None)
-        invoice_id = data.get('invoice_id', None)
-        
-        # Map the form values to model choices
-        scope_map = {
-            'container': CostPool.Scope.CONTAINER,
-            'invoice': CostPool.Scope.INVOICE,
-            'all': CostPool.Scope.ALL
-        }
-        
-        method_map = {
-            'volume': CostPool.Method.VOLUME,
-            'price': CostPool.Method.PRICE,
-            'quantity': CostPool.Method.QUANTITY,
-            'weight': CostPool.Method.EQUALLY,  # Use EQUALLY for weight for now
-            'price_quantity': CostPool.Method.PRICE_QUANTITY
-        }
-        
+
         # Create cost pool
-        cost_pool = CostPool.objects.create(
-            name=cost_name,
-            scope=scope_map.get(allocation_scope, CostPool.Scope.ALL),
-            method=method_map.get(allocation_method, CostPool.Method.PRICE),
-            amount_total=Decimal(str(cost_amount)),
-            container_id=container_id if allocation_scope == 'container' and container_id else None,
-            invoice_id=invoice_id if allocation_scope == 'invoice' and invoice_id else None,
-            auto_compute=False
-        )
+        cost_pool = _custom_cost_pool(data)
+        cost_pool.save()
         
-        # Allocate the cost
-        service = AllocationService()
-        service.allocate_cost(cost_pool)
+        # Allocated by the scheduled recalculation, together with other edits
+        job = schedule_recalculation(request.user)
         
-        return JsonResponse({'success': True, 'message': f'{cost_name} cost of ${cost_amount} has been allocated'})
+        return _scheduled_response(job, f'{cost_pool.name} cost of ${float(data.get("cost_amount", 0))}')
         
     except Exception as e:
         return JsonResponse({'success': False, 'error': str(e)})
 
+
+@require_POST
+def preview_custom_cost(request):
+    """Landed cost per line if the custom cost were added, without saving anything."""
+    try:
+        data = json.loads(request.body)
+        lines = InvoiceLine.objects.all()
+        if data.get('container'):
+            lines = lines.filter(invoice__container__container_id=data['container'])
+        rate_overrides = {code: Decimal(str(rate)) for code, rate in (data.get('rate_overrides') or {}).items()}
+        rows = AllocationService().what_if([_custom_cost_pool(data)], rate_overrides, lines)
+        return JsonResponse({
+            'success': True,
+            'total_cost': sum((row['total_cost'] for row in rows), Decimal(0)),
+            'lines': [
+                {
+                    'line_id': row['line'].pk,
+                    'invoice_number': row['line'].invoice.invoice_number,
+                    'sku': row['line'].sku.sku,
+                    **{key: row[key] for key in ('vendor_cost', 'freight_cost', 'htsus_tariff', 'section_301',
+                                                 'other_cost_allocations', 'total_cost', 'unit_total_cost')},
+                }
+                for row in rows
+            ],
+        })
+
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)})
+
 @login_required
 def download_results_csv(request):
     response = HttpResponse(content_type='text/csv')
@@ -577,54 +531,11 @@ def download_results_csv(request):
     ]
     writer.writerow(header)
 
-    lines = InvoiceLine.objects.all().select_related('invoice', 'sku').prefetch_related('allocatedcost_set__cost_pool')
-
-    # Filtering logic from results view
-    container_filter = request.GET.get('container')
-    invoice_filter = request.GET.get('invoice')
-    date_filter = request.GET.get('date')
-
-    if container_filter:
-        lines = lines.filter(invoice__container__container_id=container_filter)
-    if invoice_filter:
-        lines = lines.filter(invoice__invoice_number=invoice_filter)
-    if date_filter:
-        lines = lines.filter(invoice__invoice_date=date_filter)
-
-    for line in lines:
-        vendor_cost = line.price_vendor * line.quantity
-        
-        allocations = {ac.cost_pool.name: ac.amount_allocated for ac in line.allocatedcost_set.all()}
-
-        freight_cost_amount = allocations.get('Freight Cost', Decimal(0))
-        # Calculate HTSUS tariff on the fly for CSV export
-        htsus_rate = Decimal('0')
-        if line.sku and line.sku.htsus_rate_pct is not None:
-            htsus_rate = line.sku.htsus_rate_pct
-        elif line.sku and line.sku.htsus_code and line.sku.htsus_code.rate_pct:
-            htsus_rate = line.sku.htsus_code.rate_pct
-        htsus_tariff_amount = vendor_cost * (htsus_rate / Decimal('100'))
-
-        # Calculate Section 301 duty based on country
-        section_301_amount = Decimal('0')
-        if line.invoice and line.invoice.country_origin:
-            try:
-                country = Country.objects.get(code=line.invoice.country_origin)
-                section_301_rate = country.section_301_rate or Decimal('0')
-                section_301_amount = vendor_cost * (section_301_rate / Decimal('100'))
-            except Country.DoesNotExist:
-                section_301_amount = Decimal('0')
-        
-        other_costs_values = []
-        current_line_other_costs_total = Decimal(0)
-        for cost_name in other_cost_pool_names:
-            cost_value = allocations.get(cost_name, Decimal(0))
-            other_costs_values.append(f'${cost_value:.2f}')
-            current_line_other_costs_total += cost_value
-
-        total_cost = vendor_cost + freight_cost_amount + htsus_tariff_amount + section_301_amount + current_line_other_costs_total
-        unit_total_cost = (total_cost / line.quantity) if line.quantity > 0 else Decimal(0)
-
+    for result in _results_rows(_filtered_lines(request)):
+        line = result['line']
+        other_costs_values = [
+            f'${result["other_cost_allocations"].get(cost_name, Decimal(0)):.2f}' for cost_name in other_cost_pool_names
+        ]
         row = [
             line.invoice.invoice_number,
             line.invoice.invoice_date.strftime('%m/%d/%Y') if line.invoice.invoice_date else '',
@@ -633,13 +544,13 @@ def download_results_csv(request):
             line.sku.sku if line.sku else '',
             line.quantity,
             f'${line.price_vendor:.2f}' if line.price_vendor else '$0.00',
-            f'${vendor_cost:.2f}',
-            f'${freight_cost_amount:.2f}',
-            f'${htsus_tariff_amount:.2f}',
-            f'${section_301_amount:.2f}',
+            f'${result["vendor_cost"]:.2f}',
+            f'${result["freight_cost"]:.2f}',
+            f'${result["htsus_tariff"]:.2f}',
+            f'${result["section_301"]:.2f}',
         ] + other_costs_values + [
-            f'${total_cost:.2f}',
-            f'${unit_total_cost:.2f}'
+            f'${result["total_cost"]:.2f}',
+            f'${result["unit_total_cost"]:.2f}'
         ]
         writer.writerow(row)
 
@@ -705,64 +616,10 @@ def save_results_snapshot(request):
         # Generate batch name with timestamp
         batch_name = f"Results {datetime.now().strftime('%Y-%m-%d %H:%M')}"
         
-        # Get the same data that results() view uses (lines 281-293)
-        lines = InvoiceLine.objects.all().select_related('invoice', 'sku').prefetch_related('allocatedcost_set__cost_pool')
-        
-        # Apply same filtering logic as results() view
-        container_filter = request.GET.get('container')
-        invoice_filter = request.GET.get('invoice')
-        date_filter = request.GET.get('date')
-
-        if container_filter:
-            lines = lines.filter(invoice__container__container_id=container_filter)
-        if invoice_filter:
-            lines = lines.filter(invoice__invoice_number=invoice_filter)
-        if date_filter:
-            lines = lines.filter(invoice__invoice_date=date_filter)
-        
-        # Reuse the exact calculation logic from results() view (lines 300-342)
-        saved_count = 0
-        
-        for line in lines:
-            # Calculate all costs (same as results view)
-            vendor_cost = line.price_vendor * line.quantity
-            
-            # Get freight cost (same logic as results view)
-            freight_cost = line.allocatedcost_set.filter(cost_pool__name='Freight Cost').first()
-            freight_cost_amount = freight_cost.amount_allocated if freight_cost else 0
-            
-            # Calculate HTSUS tariff on the fly based on SKU rates (same logic as results view)
-            htsus_rate = Decimal('0')
-            if line.sku and line.sku.htsus_rate_pct is not None:
-                htsus_rate = line.sku.htsus_rate_pct
-            elif line.sku and line.sku.htsus_code and line.sku.htsus_code.rate_pct:
-                htsus_rate = line.sku.htsus_code.rate_pct
-            htsus_tariff_amount = vendor_cost * (htsus_rate / Decimal('100'))
-            
-            # Calculate Section 301 duty based on country (same logic as results view)
-            section_301_amount = Decimal('0')
-            if line.invoice and line.invoice.country_origin:
-                try:
-                    country = Country.objects.get(code=line.invoice.country_origin)
-                    section_301_rate = country.section_301_rate or Decimal('0')
-                    section_301_amount = vendor_cost * (section_301_rate / Decimal('100'))
-                except Country.DoesNotExist:
-                    section_301_amount = Decimal('0')
-            
-            # Collect all other allocated costs for this line (same logic as results view)
-            other_cost_allocations = {}
-            current_line_other_costs_total = Decimal(0)
-            for allocated_cost in line.allocatedcost_set.all():
-                if allocated_cost.cost_pool.name not in ['Freight Cost', 'HTSUS Tariff']:
-                    other_cost_allocations[allocated_cost.cost_pool.name] = float(allocated_cost.amount_allocated)
-                    current_line_other_costs_total += allocated_cost.amount_allocated
-
-            # Calculate totals (same logic as results view)
-            total_cost = vendor_cost + freight_cost_amount + htsus_tariff_amount + section_301_amount + current_line_other_costs_total
-            unit_total_cost = (total_cost / line.quantity).quantize(Decimal('0.01')) if line.quantity > 0 else Decimal(0)
-            
-            # Save to SavedResults
-            SavedResults.objects.create(
+        snapshot = []
+        for result in _results_rows(_filtered_lines(request)):
+            line = result['line']
+            snapshot.append(SavedResults(
                 batch_name=batch_name,
                 invoice_number=line.invoice.invoice_number,
                 invoice_date=line.invoice.invoice_date,
@@ -771,16 +628,17 @@ def save_results_snapshot(request):
                 sku=line.sku.sku if line.sku else '',
                 quantity=line.quantity,
                 vendor_price=line.price_vendor,
-                vendor_cost=vendor_cost,
-                freight_cost=freight_cost_amount,
-                htsus_tariff=htsus_tariff_amount,
-                section_301=section_301_amount,
-                other_costs=other_cost_allocations,  # JSON field
-                total_cost=total_cost,
-                unit_total_cost=unit_total_cost
-            )
-            saved_count += 1
-        
+                vendor_cost=result['vendor_cost'],
+                freight_cost=result['freight_cost'],
+                htsus_tariff=result['htsus_tariff'],
+                section_301=result['section_301'],
+                other_costs={name: float(amount) for name, amount in result['other_cost_allocations'].items()},  # JSON field
+                total_cost=result['total_cost'],
+                unit_total_cost=result['unit_total_cost'],
+            ))
+        SavedResults.objects.bulk_create(snapshot, batch_size=1000)
+        saved_count = len(snapshot)
+
         return JsonResponse({
             'success': True,
             'message': f'Saved {saved_count} results to batch "{batch_name}"',
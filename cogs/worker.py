@@ -0,0 +1,29 @@
+"""Entry points for spawned worker processes.
+
+A ``spawn`` child unpickles references to these functions before the pool
+initializer has run, so this module must stay importable without Django
+being set up: import models and services inside the functions only.
+"""
+
+
+def init_worker(progress_queue=None):
+    """``ProcessPoolExecutor`` initializer: set up Django in the child."""
+    import django
+    django.setup()
+    from cogs import jobs
+    jobs.set_progress_queue(progress_queue)
+
+
+def run_job(job_id):
+    from cogs.jobs import execute_job
+    return execute_job(job_id)
+
+
+def parse_archive_member(name, data):
+    from cogs.archive import parse_member
+    return parse_member(name, data)
+
+
+def recalculate_partition(container_ids):
+    from cogs.recalc import recalculate_partition
+    return recalculate_partition(container_ids)
@@ -0,0 +1,185 @@
+"""Background job handlers for the consolidation app (registered in cogs.jobs)."""
+import logging
+
+from django.core.files.storage import default_storage
+from django.db import transaction
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from cogs.jobs import report_progress
+from cogs.readers import is_blank, iter_batches, open_table
+from .models import Company, ChartOfAccount, FinancialData, Project, Budget, BudgetFinancialData
+from .views import get_llm_category_suggestion
+
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_BATCH_SIZE = 1000
+
+
+def _decimal_or_zero(value):
+    if is_blank(value):
+        return Decimal(0)
+    try:
+        return Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError(f"Invalid number {value!r}")
+
+
+def process_financial_upload(job):
+    company = Company.objects.get(id=job.payload['company_id'])
+    project_id = job.payload.get('project_id')
+    project = Project.objects.get(id=project_id) if project_id else None
+
+    # Determine period_date (simplified: assuming data is for current month for now)
+    # In a real scenario, you'd parse the month from the column headers or user input
+    current_month = datetime.now().replace(day=1).date()
+
+    known = set(ChartOfAccount.objects.values_list('account_number', flat=True))
+    gl_codes_in_file = set()
+    new_gl_codes = []
+
+    with default_storage.open(job.payload['files'][0], 'rb') as upload:
+        # Assuming GL Account Code is in the first column (index 0 or 'A')
+        # and Account Name is in the second column (index 1 or 'B')
+        # First pass, outside any transaction: the category suggestions are
+        # network calls, and a transaction would hold the database write
+        # lock across them.
+        _, rows = open_table(upload, job.payload['file_name'])
+        new_names = {}
+        for row in rows:
+            code = str(row[0])
+            gl_codes_in_file.add(code)
+            if code not in known and code not in new_names:
+                new_names[code] = row[1] if len(row) > 1 and not is_blank(row[1]) else "Unknown"
+        for done, (code, account_name) in enumerate(new_names.items(), start=1):
+            llm_suggested_category = get_llm_category_suggestion(account_name)
+            new_gl_codes.append({'account_number': code, 'account_name': str(account_name), 'llm_suggested_category': llm_suggested_category})
+            report_progress(job, done, len(new_names), f'{done} of {len(new_names)} new GL codes categorized')
+        suggestions = {code['account_number']: code['llm_suggested_category'] for code in new_gl_codes}
+
+        upload.seek(0)
+        with transaction.atomic():
+            coa_ids = dict(ChartOfAccount.objects.values_list('account_number', 'id'))
+            # Accounts another upload created since the first pass are reused.
+            ChartOfAccount.objects.bulk_create([
+                ChartOfAccount(
+                    account_number=code,
+                    account_name=account_name,
+                    account_type='Unknown', # Placeholder
+                    category='Unknown', # Placeholder
+                    is_new_pending_approval=True,
+                    llm_suggested_category=suggestions[code]
+                )
+                for code, account_name in new_names.items() if code not in coa_ids
+            ], batch_size=UPLOAD_BATCH_SIZE)
+            coa_ids = dict(ChartOfAccount.objects.values_list('account_number', 'id'))
+
+            _, rows = open_table(upload, job.payload['file_name'])
+            processed = 0
+            for batch in iter_batches(rows, UPLOAD_BATCH_SIZE):
+                # Save financial data (simplified for now, assuming monthly PTD values are in subsequent columns)
+                # This part needs to be expanded to correctly parse and save all monthly values
+                # For now, just saving the first value (column C) for demonstration
+                FinancialData.objects.bulk_create([
+                    FinancialData(
+                        company=company,
+                        chart_of_account_id=coa_ids[str(row[0])],
+                        period_date=current_month,
+                        ptd_value=_decimal_or_zero(row[2] if len(row) > 2 else 0),
+                        is_pnl=True, # Assuming P&L for now, needs to be determined from file type
+                        project=project # Save the linked project
+                    )
+                    for row in batch
+                ])
+                processed += len(batch)
+                report_progress(job, upload.tell(), upload.size, f'{processed} rows imported')
+
+    success_message = (f'File uploaded for {company.name}. '
+                       f'Processed {len(gl_codes_in_file)} GL codes and saved financial data.')
+    if new_gl_codes:
+        success_message += f' {len(new_gl_codes)} new GL codes detected and flagged for approval.'
+    return {'message': success_message, 'new_gl_codes': new_gl_codes}
+
+
+def _period_columns(header):
+    """Map column index -> period date for the monthly value columns (from index 2)."""
+    periods = {}
+    for col_idx in range(2, len(header)):
+        # Assuming column headers are dates or can be parsed into dates
+        # This is a simplification. A robust solution would parse headers carefully.
+        column = header[col_idx]
+        if isinstance(column, datetime):
+            periods[col_idx] = column.date()
+            continue
+        try:
+            # Try parsing as string, e.g., '2024-01-01'
+            periods[col_idx] = datetime.strptime(str(column), '%Y-%m-%d').date()
+        except ValueError as e:
+            logger.warning('Skipping column %s due to date parsing error: %s', column, e)
+    return periods
+
+
+def process_budget_upload(job):
+    budget = Budget.objects.get(id=job.payload['budget_id'])
+    coa_ids = dict(ChartOfAccount.objects.values_list('account_number', 'id'))
+    gl_codes_in_file = set()
+
+    with default_storage.open(job.payload['files'][0], 'rb') as upload, transaction.atomic():
+        # Assuming GL Account Code is in the first column (index 0 or 'A')
+        # and monthly values start from column C (index 2)
+        header, rows = open_table(upload, job.payload['file_name'])
+        periods = _period_columns(header)
+        processed = 0
+        for batch in iter_batches(rows, UPLOAD_BATCH_SIZE):
+            values = {}
+            for row in batch:
+                gl_code = str(row[0])
+                gl_codes_in_file.add(gl_code)
+                coa_id = coa_ids.get(gl_code)
+                if coa_id is None:
+                    # Handle case where GL code from budget file is not in CoA
+                    # For now, skip or log. In a real app, you might want to flag this.
+                    logger.warning('GL code %s from budget file not found in CoA. Skipping.', gl_code)
+                    continue
+                for col_idx, period_date in periods.items():
+                    value = row[col_idx] if col_idx < len(row) else None
+                    try:
+                        values[coa_id, period_date] = _decimal_or_zero(value)
+                    except ValueError:
+                        logger.warning(
+                            'Skipping column %s for GL %s due to value parsing error: %r',
+                            header[col_idx], gl_code, value,
+                        )
+            _save_budget_values(budget, values)
+            processed += len(batch)
+            report_progress(job, upload.tell(), upload.size, f'{processed} rows imported')
+
+    return {
+        'message': f'Budget file \'{job.payload["file_name"]}\' uploaded successfully for {budget.name}. '
+                   f'Processed {len(gl_codes_in_file)} GL codes.'
+    }
+
+
+def _save_budget_values(budget, values):
+    """Insert or update one batch of ``{(coa_id, period_date): value}`` budget cells."""
+    existing = {
+        (row.chart_of_account_id, row.period_date): row
+        for row in BudgetFinancialData.objects.filter(
+            budget=budget,
+            chart_of_account_id__in={coa_id for coa_id, _ in values},
+            period_date__in={period_date for _, period_date in values},
+        )
+    }
+    to_create, to_update = [], []
+    for (coa_id, period_date), value in values.items():
+        row = existing.get((coa_id, period_date))
+        if row is None:
+            to_create.append(BudgetFinancialData(
+                budget=budget, chart_of_account_id=coa_id, period_date=period_date, budget_value=value,
+            ))
+        elif row.budget_value != value:
+            row.budget_value = value
+            to_update.append(row)
+    BudgetFinancialData.objects.bulk_create(to_create)
+    BudgetFinancialData.objects.bulk_update(to_update, ['budget_value'])
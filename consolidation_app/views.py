@@ -13,6 +13,7 @@ import openai
 from datetime import datetime
 from django.db.models import Sum
 from django.db.models.functions import TruncMonth
+from cogs.jobs import enqueue, save_upload
 
 # Configure OpenAI API
 # It's recommended to set OPENAI_API_KEY as an environment variable
@@ -89,6 +90,14 @@ def get_llm_summary_suggestion(document_content):
         print(f"Error getting LLM summary suggestion: {e}")
         return None
 
+def _job_context(job):
+    """Template messages for an upload that was handed to the job queue."""
+    if job.status == job.Status.SUCCEEDED:
+        return {'success_message': job.result.get('message', '')}
+    if job.status == job.Status.FAILED:
+        return {'error_message': f'Error processing file: {job.error}'}
+    return {'success_message': f'File queued for processing (job #{job.pk}).'}
+
 def upload_file(request):
     companies = Company.objects.all() # Get all companies for the dropdown
     projects = Project.objects.all() # Get all projects for the dropdown
@@ -125,80 +134,24 @@ def upload_file(request):
                     'error_message': 'Selected project does not exist.'
                 })
 
-        # Read the file into a pandas DataFrame
-        df = None
-        if uploaded_file.name.endswith(('.xlsx', '.xls')):
-            df = pd.read_excel(uploaded_file.read())
-        elif uploaded_file.name.endswith('.csv'):
-            df = pd.read_csv(io.StringIO(uploaded_file.read().decode('utf-8')))
-        else:
+        if not uploaded_file.name.endswith(('.xlsx', '.xls', '.csv')):
             return render(request, 'consolidation_app/upload.html', {
                 'companies': companies,
                 'projects': projects,
                 'error_message': 'Unsupported file format. Please upload .xlsx, .xls, or .csv.'
             })
 
-        # Assuming GL Account Code is in the first column (index 0 or 'A')
-        # and Account Name is in the second column (index 1 or 'B')
-        gl_codes_in_file = df.iloc[:, 0].astype(str).unique() # Column A
-        raw_names_in_file = df.iloc[:, 1].astype(str).unique() # Column B
-
-        existing_coa_numbers = set(ChartOfAccount.objects.values_list('account_number', flat=True))
-
-        new_gl_codes = []
-        for code in gl_codes_in_file:
-            if code not in existing_coa_numbers:
-                account_name = "Unknown"
-                try:
-                    matching_row = df[df.iloc[:, 0].astype(str) == code].iloc[0]
-                    account_name = matching_row.iloc[1] # Column B
-                except IndexError:
-                    pass
-
-                llm_suggested_category = get_llm_category_suggestion(account_name)
-
-                new_gl_codes.append({'account_number': code, 'account_name': account_name, 'llm_suggested_category': llm_suggested_category})
-                ChartOfAccount.objects.create(
-                    account_number=code,
-                    account_name=account_name,
-                    account_type='Unknown', # Placeholder
-                    category='Unknown', # Placeholder
-                    is_new_pending_approval=True,
-                    llm_suggested_category=llm_suggested_category
-                )
-
-        # Save financial data (simplified for now, assuming monthly PTD values are in subsequent columns)
-        # This part needs to be expanded to correctly parse and save all monthly values
-        # For now, just saving the first value for demonstration
-        for index, row in df.iterrows():
-            gl_code = str(row.iloc[0])
-            coa_entry = ChartOfAccount.objects.get(account_number=gl_code)
-            # Assuming the first value column is C (index 2)
-            ptd_value = row.iloc[2] if len(row) > 2 else 0 # Get PTD value from column C
-            
-            # Determine period_date (simplified: assuming data is for current month for now)
-            # In a real scenario, you'd parse the month from the column headers or user input
-            current_month = datetime.now().replace(day=1).date()
-
-            FinancialData.objects.create(
-                company=company,
-                chart_of_account=coa_entry,
-                period_date=current_month,
-                ptd_value=ptd_value,
-                is_pnl=True, # Assuming P&L for now, needs to be determined from file type
-                project=project # Save the linked project
-            )
-
-        context = {
-            'companies': companies,
-            'projects': projects,
-            'success_message': f'File uploaded for {company.name}. '
-                               f'Processed {len(gl_codes_in_file)} GL codes and saved financial data.'
-        }
-        if new_gl_codes:
-            context['new_gl_codes'] = new_gl_codes
-            context['success_message'] += f' {len(new_gl_codes)} new GL codes detected and flagged for approval.'
-
+        job = enqueue('financial_upload', {
+            'company_id': company.id,
+            'project_id': project.id if project else None,
+            'file_name': uploaded_file.name,
+            'files': [save_upload(uploaded_file)],
+        }, user=request.user)
+
+        context = {'companies': companies, 'projects': projects, 'job': job}
+        context.update(_job_context(job))
+        if job.status == job.Status.SUCCEEDED:
+            context['new_gl_codes'] = job.result.get('new_gl_codes')
         return render(request, 'consolidation_app/upload.html', context)
 
     return render(request, 'consolidation_app/upload.html', {'companies': companies, 'projects': projects})
@@ -396,69 +349,20 @@ def upload_budget(request):
                 'error_message': 'Selected budget does not exist.'
             })
 
-        # Read the file into a pandas DataFrame
-        df = None
-        if uploaded_file.name.endswith(('.xlsx', '.xls')):
-            df = pd.read_excel(uploaded_file.read())
-        elif uploaded_file.name.endswith('.csv'):
-            df = pd.read_csv(io.StringIO(uploaded_file.read().decode('utf-8')))
-        else:
+        if not uploaded_file.name.endswith(('.xlsx', '.xls', '.csv')):
             return render(request, 'consolidation_app/upload_budget.html', {
                 'budgets': budgets,
                 'error_message': 'Unsupported file format. Please upload .xlsx, .xls, or .csv.'
             })
 
-        # Assuming GL Account Code is in the first column (index 0 or 'A')
-        # and monthly values start from column C (index 2)
-        gl_codes_in_file = df.iloc[:, 0].astype(str).unique()
-
-        # Iterate through DataFrame to save budget data
-        for index, row in df.iterrows():
-            gl_code = str(row.iloc[0])
-            try:
-                coa_entry = ChartOfAccount.objects.get(account_number=gl_code)
-            except ChartOfAccount.DoesNotExist:
-                # Handle case where GL code from budget file is not in CoA
-                # For now, skip or log. In a real app, you might want to flag this.
-                print(f"GL code {gl_codes_in_file} from budget file not found in CoA. Skipping.")
-                continue
-
-            # Iterate through monthly columns (assuming they start from index 2)
-            for col_idx in range(2, len(row)):
-                # Assuming column headers are dates or can be parsed into dates
-                # This is a simplification. A robust solution would parse headers carefully.
-                try:
-                    # Attempt to parse column header as a date (e.g., '2024-01-01')
-                    # Or you might have 'Jan-24', 'Feb-24' etc.
-                    # For now, let's assume column headers are 'YYYY-MM-DD' or similar
-                    # If headers are just month names, you'd need to infer year and day
-                    header = df.columns[col_idx]
-                    if isinstance(header, datetime):
-                        period_date = header.date()
-                    else:
-                        # Try parsing as string, e.g., '2024-01-01'
-                        period_date = datetime.strptime(str(header), '%Y-%m-%d').date()
-
-                    budget_value = row.iloc[col_idx]
-                    if pd.isna(budget_value): # Handle NaN values
-                        budget_value = 0
-
-                    BudgetFinancialData.objects.update_or_create(
-                        budget=budget,
-                        chart_of_account=coa_entry,
-                        period_date=period_date,
-                        defaults={'budget_value': budget_value}
-                    )
-                except (ValueError, TypeError) as e:
-                    print(f"Skipping column {df.columns[col_idx]} for GL {gl_code} due to date/value parsing error: {e}")
-                    continue
-
-        context = {
-            'budgets': budgets,
-            'success_message': f'Budget file \'{uploaded_file.name}\' uploaded successfully for {budget.name}. '
-                               f'Processed {len(gl_codes_in_file)} GL codes.'
-        }
+        job = enqueue('budget_upload', {
+            'budget_id': budget.id,
+            'file_name': uploaded_file.name,
+            'files': [save_upload(uploaded_file)],
+        }, user=request.user)
 
+        context = {'budgets': budgets, 'job': job}
+        context.update(_job_context(job))
         return render(request, 'consolidation_app/upload_budget.html', context)
 
     return render(request, 'consolidation_app/upload_budget.html', {'budgets': budgets})
@@ -102,6 +102,8 @@ else:
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': BASE_DIR / 'db.sqlite3',
+            # Job workers write concurrently; wait for the lock instead of failing.
+            'OPTIONS': {'timeout': 30, 'transaction_mode': 'IMMEDIATE'},
         }
     }
 
@@ -153,6 +155,29 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 LOGIN_URL = 'login'
 
+# Background jobs (cogs.jobs / manage.py run_workers)
+COGS_JOB_WORKERS = int(os.environ.get('COGS_JOB_WORKERS', '2'))
+COGS_JOBS_EAGER = os.environ.get('COGS_JOBS_EAGER', str(DEBUG)) == 'True'
+COGS_JOB_STALE_SECONDS = int(os.environ.get('COGS_JOB_STALE_SECONDS', '300'))
+COGS_JOB_MAX_ATTEMPTS = 3
+# Processes that parse the member files of a zip invoice upload.
+COGS_ARCHIVE_WORKERS = int(os.environ.get('COGS_ARCHIVE_WORKERS', '4'))
+# Where cost pools are allocated: 'kernel' (numpy, in Python), 'database'
+# (one INSERT ... SELECT per pool; line data never leaves the database) or
+# 'streaming' (the kernel, but pools over every line read and write their
+# lines in chunks, so memory stays flat).
+COGS_ALLOCATION_MODE = os.environ.get('COGS_ALLOCATION_MODE', 'kernel')
+# How allocations are stored: 'rows' (one AllocatedCost per pool and line)
+# or 'packed' (one compressed PackedAllocation per pool; kernel mode only).
+COGS_ALLOCATION_STORAGE = os.environ.get('COGS_ALLOCATION_STORAGE', 'rows')
+# Processes that recalculate container partitions (cogs.recalc); SQLite
+# always uses one, as it serializes writers anyway.
+COGS_RECALC_WORKERS = int(os.environ.get('COGS_RECALC_WORKERS', str(os.cpu_count() or 1)))
+# Cost edits schedule one recalculation (cogs.scheduler) that waits until
+# edits have paused this long, but at most the maximum delay.
+COGS_RECALC_DEBOUNCE_SECONDS = int(os.environ.get('COGS_RECALC_DEBOUNCE_SECONDS', '5'))
+COGS_RECALC_MAX_DELAY_SECONDS = int(os.environ.get('COGS_RECALC_MAX_DELAY_SECONDS', '60'))
+
 # Media files (User uploaded content)
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'